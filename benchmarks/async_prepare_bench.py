@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+# Measures how many videos yatto.py prepares per second against a local fake
+# video site, once with prepare_video one video after another as the command
+# line does, and once with AsyncPreparer preparing all of them at once.
+#
+# The fake site serves video pages, gzipped Bilibili danmaku with chunked
+# transfer encoding and media URLs answering HEAD, each response delayed by
+# --latency. Fake you-get and ffprobe commands, taking --process-delay each,
+# are put first on PATH, so no network access or real tool is needed. Every
+# video has its own page and danmaku, so no cache helps either mode. The most
+# requests the fake site saw in flight at once shows the limits of
+# AsyncPreparer at work. Unix only, as the fake commands are scripts.
+
+import argparse
+import asyncio
+import gzip
+import http.server
+import logging
+import os
+import re
+import sys
+import tempfile
+import threading
+import time
+
+DEFAULT_SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+FAKE_YOU_GET = '''#!{python}
+import sys, time
+time.sleep({delay})
+video_id = sys.argv[-1].rstrip('/').rsplit('/', 1)[-1]
+print('title: Video ' + video_id)
+print('{base}/media/' + video_id + '.mp4')
+'''
+FAKE_FFPROBE = '''#!{python}
+import time
+time.sleep({delay})
+print('{{"streams": [{{"width": 1280, "height": 720}}]}}')
+'''
+
+logger = logging.getLogger(__name__)
+
+
+class FakeSiteHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.handle_request(True)
+
+    def do_HEAD(self):
+        self.handle_request(False)
+
+    def handle_request(self, send_body):
+        server = self.server
+        with server.lock:
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+        try:
+            time.sleep(server.latency)
+            page_match = re.match(r'/video/(\d+)$', self.path)
+            comment_match = re.match(r'/comment/(\d+)\.xml$', self.path)
+            if page_match:
+                self.send_body('<html><script>var cid=' + page_match.group(1) + ';</script></html>', send_body)
+            elif comment_match:
+                self.send_comments(int(comment_match.group(1)), send_body)
+            elif self.path.startswith('/media/'):
+                self.send_body('', send_body)
+            else:
+                self.send_error(404)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def send_body(self, text, send_body):
+        body = text.encode('utf-8')
+        self.send_response(200)
+        self.send_header('Content-Length', str(len(body)))
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+    def send_comments(self, video_id, send_body):
+        lines = ['<?xml version="1.0" encoding="UTF-8"?><i><chatid>{}</chatid>'.format(video_id)]
+        for i in range(self.server.comments):
+            lines.append('<d p="{:.2f},{},25,16777215,{},0,0,{}">video {} comment {}</d>'.format(
+                i * 0.37 % 600, (1, 1, 1, 4, 5)[i % 5], 1400000000 + i, i, video_id, i))
+        lines.append('</i>')
+        body = gzip.compress('\n'.join(lines).encode('utf-8'))
+        self.send_response(200)
+        self.send_header('Content-Encoding', 'gzip')
+        self.send_header('Transfer-Encoding', 'chunked')
+        self.send_header('Cache-Control', 'no-store')
+        self.end_headers()
+        if not send_body:
+            return
+        for i in range(0, len(body), 16 * 1024):
+            chunk = body[i:i + 16 * 1024]
+            self.wfile.write('{:x}\r\n'.format(len(chunk)).encode('ascii') + chunk + b'\r\n')
+        self.wfile.write(b'0\r\n\r\n')
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_fake_site(latency, comments):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), FakeSiteHandler)
+    server.daemon_threads = True
+    server.latency = latency
+    server.comments = comments
+    server.lock = threading.Lock()
+    server.in_flight = server.max_in_flight = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+
+def install_fake_commands(directory, base, delay):
+    for name, template in (('you-get', FAKE_YOU_GET), ('ffprobe', FAKE_FFPROBE)):
+        path = os.path.join(directory, name)
+        with open(path, 'w') as f:
+            f.write(template.format(python=sys.executable, delay=delay, base=base))
+        os.chmod(path, 0o755)
+    os.environ['PATH'] = directory + os.pathsep + os.environ.get('PATH', '')
+
+
+# Result: the number of videos prepared without a comment file
+def check_results(results):
+    return sum(not video_url or not comment_file or not os.path.exists(comment_file)
+               for name, video_url, comment_file in results)
+
+
+def run_sync(yatto, urls):
+    return [yatto.prepare_video(url, '') for url in urls]
+
+
+async def run_async(yatto, urls, options):
+    async with yatto.AsyncPreparer(site_prepares=options.site_prepares, host_connections=options.host_connections,
+                                   process_jobs=options.process_jobs) as preparer:
+        return await asyncio.gather(*(preparer.prepare(url) for url in urls))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark AsyncPreparer against a local fake video site')
+    parser.add_argument('--src', default=DEFAULT_SRC,
+                        help='Directory containing the yatto.py to benchmark [default: %(default)s]')
+    parser.add_argument('--videos', default=32, type=int, help='Videos to prepare in each mode [default: %(default)s]')
+    parser.add_argument('--comments', default=2000, type=int,
+                        help='Comments in the danmaku of each video [default: %(default)s]')
+    parser.add_argument('--latency', default=0.05, type=float,
+                        help='Seconds the fake site takes to answer each request [default: %(default)s]')
+    parser.add_argument('--process-delay', default=0.3, type=float,
+                        help='Seconds the fake you-get and ffprobe take to run [default: %(default)s]')
+    parser.add_argument('--site-prepares', default=8, type=int,
+                        help='AsyncPreparer site_prepares [default: %(default)s]')
+    parser.add_argument('--host-connections', default=4, type=int,
+                        help='AsyncPreparer host_connections [default: %(default)s]')
+    parser.add_argument('--process-jobs', default=8, type=int,
+                        help='AsyncPreparer process_jobs [default: %(default)s]')
+    parser.add_argument('--skip-sync', default=False, action='store_true',
+                        help='Only run AsyncPreparer, as prepare_video takes a while on many videos')
+    parser.add_argument('-v', '--verbose', default=False, action='store_true', help='Show the logs of yatto.py')
+    args = parser.parse_args()
+    logging.basicConfig(level='INFO' if args.verbose else 'WARNING',
+                        format='%(asctime)s - %(levelname)s - %(message)s')
+    logger.setLevel('INFO')
+
+    failed = 0
+    with tempfile.TemporaryDirectory(prefix='yatto-async-bench-') as work_dir:
+        # yatto.py picks its cache directories on import
+        os.environ['XDG_CACHE_HOME'] = os.path.join(work_dir, 'cache')
+        os.environ['no_proxy'] = '*'
+        sys.path.insert(0, os.path.abspath(args.src))
+        import yatto
+
+        server, base = start_fake_site(args.latency, args.comments)
+        install_fake_commands(work_dir, base, args.process_delay)
+
+        def parse_fake_danmaku(page):
+            match = re.search(r'cid=(\d+)', page)
+            return '{}/comment/{}.xml'.format(base, match.group(1)) if match else ''
+        yatto.danmaku_parsers['127.0.0.1'] = parse_fake_danmaku
+
+        modes = [('async', lambda urls: asyncio.run(run_async(yatto, urls, args)))]
+        if not args.skip_sync:
+            modes.insert(0, ('sync', lambda urls: run_sync(yatto, urls)))
+        for i, (mode, run) in enumerate(modes):
+            urls = ['{}/video/{}'.format(base, i * args.videos + j) for j in range(args.videos)]
+            server.max_in_flight = 0
+            start = time.time()
+            results = run(urls)
+            duration = time.time() - start
+            mode_failed = check_results(results)
+            failed += mode_failed
+            logger.info('{}: {} videos in {:.2f}s, {:.2f} videos/s, {} failed, at most {} requests in flight'.format(
+                mode, len(urls), duration, len(urls) / duration, mode_failed, server.max_in_flight))
+        server.shutdown()
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+# Checks that the blocklist of a CommentFilter matches the text positioned
+# comments show, on generated Acfun and Bilibili files.
+#
+# Each file, generated like those of danmaku2ass_bench.py with a share of
+# positioned comments, is converted without a filter and with a blocklist of
+# a word of the generated text. The positioned Dialogue lines, those with
+# \org, showing the word must all be dropped, and the others kept. Bilibili
+# files are also converted with a blocklist of the font name their positioned
+# comments carry next to the text, which must not drop any of them. The exit
+# status is 1 if any check fails.
+
+import argparse
+import logging
+import os
+import sys
+import tempfile
+
+from danmaku2ass_bench import DEFAULT_SRC, generate_comment_file
+
+SHOWN_KEYWORD = '名场面'
+# Fields of the positioned comments that are not shown, by format
+HIDDEN_KEYWORDS = {'bilibili': 'SimHei'}
+
+logger = logging.getLogger(__name__)
+
+
+# Result: the texts of the positioned Dialogue lines of an ASS file
+def read_positioned_texts(path):
+    with open(path, encoding='utf-8-sig') as f:
+        return [line.split(',', 9)[9].rsplit('}', 1)[-1] for line in f if line.startswith('Dialogue:') and '\\org(' in line]
+
+
+def convert(danmaku2ass, path, output_dir, keyword):
+    name = '{}-{}.ass'.format(os.path.basename(path), 'all' if keyword is None else 'without-' + keyword)
+    output = os.path.join(output_dir, name)
+    comment_filter = danmaku2ass.CommentFilter(blocklist=danmaku2ass.CompileBlocklist([keyword])) if keyword else None
+    danmaku2ass.Danmaku2ASS([path], output, 1280, 720, comment_filter=comment_filter)
+    return read_positioned_texts(output)
+
+
+def check_file(danmaku2ass, fmt, path, output_dir):
+    name = os.path.basename(path)
+    try:
+        texts = convert(danmaku2ass, path, output_dir, None)
+        shown = convert(danmaku2ass, path, output_dir, SHOWN_KEYWORD)
+        hidden = convert(danmaku2ass, path, output_dir, HIDDEN_KEYWORDS[fmt]) if fmt in HIDDEN_KEYWORDS else None
+    except Exception as e:
+        return ['{}: {}: {}'.format(name, type(e).__name__, e)]
+    expected = [i for i in texts if SHOWN_KEYWORD not in i]
+    logger.info('{}: {} positioned comments, {} left without {}'.format(name, len(texts), len(shown), SHOWN_KEYWORD))
+    failures = []
+    if len(expected) == len(texts) or not expected:
+        failures.append('{}: no positioned comments both with and without {} to check'.format(name, SHOWN_KEYWORD))
+    if shown != expected:
+        failures.append('{}: {} positioned comments left without {}, expected {}'.format(
+            name, len(shown), SHOWN_KEYWORD, len(expected)))
+    if hidden is not None and hidden != texts:
+        failures.append('{}: {} of {} positioned comments left without {}, which they do not show'.format(
+            name, len(hidden), len(texts), HIDDEN_KEYWORDS[fmt]))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the blocklist of CommentFilter on positioned comments')
+    parser.add_argument('--src', default=DEFAULT_SRC,
+                        help='Directory containing the danmaku2ass.py to check [default: %(default)s]')
+    parser.add_argument('--comments', default=5000, type=int,
+                        help='Comments in each generated file [default: %(default)s]')
+    parser.add_argument('--positioned', default=0.1, type=float,
+                        help='Ratio of positioned comments [default: %(default)s]')
+    args = parser.parse_args()
+    logging.basicConfig(level='INFO', format='%(asctime)s - %(levelname)s - %(message)s')
+    # Leave out the warnings of Danmaku2ASS about the generated comments
+    logging.getLogger().handlers[0].addFilter(logging.Filter(__name__))
+
+    sys.path.insert(0, os.path.abspath(args.src))
+    import danmaku2ass
+
+    failures = []
+    with tempfile.TemporaryDirectory(prefix='comment-filter-check-') as work_dir:
+        for fmt in ('acfun', 'bilibili'):
+            path = generate_comment_file(work_dir, fmt, args.comments, 20, args.positioned)
+            failures += check_file(danmaku2ass, fmt, path, work_dir)
+    for failure in failures:
+        logger.error(failure)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,466 @@
+#!/usr/bin/env python3
+
+# Benchmarks Danmaku2ASS on synthetic comment files of every supported format.
+#
+# The comment files are generated deterministically from the format, the
+# number of comments, the density (comments per second of video) and the ratio
+# of positioned comments, so the same case gives the same file on every run and
+# every machine. Each case runs in a fresh process, timing the stages of a
+# conversion one after the other:
+#
+#     probe     Detecting the format of the file
+#     badchars  Passing the file through FilterBadChars alone, which read does
+#               again as it parses, so it is left out of the total
+#     read      Parsing the comments into a CommentTable
+#     sort      Sorting them along the timeline
+#     filter    Applying a CommentFilter, only with --max-density,
+#               --merge-window or --blocklist
+#     layout    Placing the comments and formatting the Dialogue lines in memory
+#     write     Encoding the lines into the output file
+#
+# The results are written as JSON, and --compare prints the ratios against the
+# results of an earlier run, e.g. of another commit checked out with --src.
+# Older trees without CommentTable or ASSWriter, such as upstream
+# danmaku2ass.py, read the comments into a list and write a text file, as
+# their own conversion does.
+
+import argparse
+import concurrent.futures
+import datetime
+import inspect
+import io
+import json
+import logging
+import multiprocessing
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    import resource
+except ImportError:
+    resource = None  # Windows, peak RSS is then not reported
+
+DEFAULT_SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+DEFAULT_FORMATS = ['bilibili', 'acfun', 'tudou', 'tudou2', 'niconico', 'miomio', 'sh5v']
+DEFAULT_SIZES = '10k,100k'
+DEFAULT_DENSITIES = '20'
+DEFAULT_POSITIONED = '0.01'
+DEFAULT_STAGE = '1920x1080'
+
+RESULT_VERSION = 1
+
+# Comments repeated all over real files, the rest are made up from words
+COMMON_COMMENTS = ['233333', '2333333333', '哈哈哈哈哈哈', '前方高能', '前方高能！！！', 'awsl', 'AWSL', '泪目',
+                   '？？？', '草', 'www', 'ｗｗｗｗｗ', '好きです', 'lol', 'hhhhhh', '66666', '打卡', '来了来了']
+WORDS = ['弹幕', '这个', '真的', '好看', '主播', '太强了', '哈哈', 'op', 'ed', 'bgm', '名场面', 'hello', 'world',
+         'nice', '全角ＡＢＣ', 'かわいい', '!', '?', '~']
+COMMON_RATIO = 0.4
+MULTILINE_RATIO = 0.01
+
+logger = logging.getLogger(__name__)
+
+
+def parse_count(text):
+    text = text.strip().lower()
+    scale = 1
+    if text.endswith('k'):
+        text, scale = text[:-1], 1000
+    elif text.endswith('m'):
+        text, scale = text[:-1], 1000000
+    return int(float(text) * scale)
+
+
+def parse_list(text, parse):
+    return [parse(i) for i in text.split(',') if i.strip()]
+
+
+def xml_escape(text):
+    return text.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;').replace('"', '&quot;')
+
+
+# A generator of comments shared by all formats: (time, text, mode, positioned)
+# where mode is 0 for scrolling, 1 for bottom, 2 for top and 3 for reversed
+class CommentSource:
+    def __init__(self, fmt, count, density, positioned):
+        self.random = random.Random('%s-%d-%s-%s' % (fmt, count, density, positioned))
+        self.count = count
+        self.duration = count / density
+        self.positioned = positioned
+
+    def __iter__(self):
+        rand = self.random
+        for no in range(self.count):
+            if rand.random() < COMMON_RATIO:
+                text = rand.choice(COMMON_COMMENTS)
+            else:
+                text = ''.join(rand.choice(WORDS) for i in range(rand.randint(1, 6)))
+                if rand.random() < MULTILINE_RATIO:
+                    text += '\n' + rand.choice(WORDS)
+            mode = rand.choice((0, 0, 0, 0, 0, 0, 0, 1, 2, 3))
+            yield no, rand.uniform(0, self.duration), text, mode, rand.random() < self.positioned
+
+
+# Each writer streams a comment file of its format to f, with the positioned
+# comments it supports, and must give files that danmaku2ass probes correctly
+
+def write_bilibili(f, source):
+    rand = source.random
+    f.write('<?xml version="1.0" encoding="UTF-8"?><i><chatserver>chat.bilibili.com</chatserver><chatid>1</chatid>')
+    for no, at, text, mode, positioned in source:
+        if positioned:
+            mode_code = '7'
+            text = json.dumps([rand.randint(0, 1280), rand.randint(0, 720), '1-0.3', '4.5', text, rand.choice([0, 30]),
+                               rand.choice([0, 45]), rand.randint(0, 1280), rand.randint(0, 720), 500, 100, 'false',
+                               'SimHei'], ensure_ascii=False)
+        else:
+            mode_code = ('1', '4', '5', '6')[mode]
+            text = text.replace('\n', '/n')
+        f.write('<d p="%.5f,%s,%s,%d,%d,0,%08x,%d">%s</d>' % (
+            at, mode_code, rand.choice(('25', '25', '18', '36')), rand.choice((0xffffff, 0xffffff, 0xff0000, 0)),
+            1400000000 + no, rand.getrandbits(32), no, xml_escape(text)))
+    f.write('</i>')
+
+
+def write_acfun(f, source):
+    rand = source.random
+    f.write('[[')
+    for no, at, text, mode, positioned in source:
+        if positioned:
+            mode_code = '7'
+            text = json.dumps({'n': text, 'c': rand.randint(0, 8), 'p': {'x': rand.randint(0, 1000),
+                                                                        'y': rand.randint(0, 1000)},
+                               'a': 0.8, 'l': 3.0, 'r': rand.choice([0, 30]), 'k': 0}, ensure_ascii=False)
+        else:
+            mode_code = ('1', '4', '5', '1')[mode]
+        comment = {'c': '%.3f,%d,%s,%s,user,%d,c%d' % (at, rand.choice((0xffffff, 0xffffff, 0xabcdef)), mode_code,
+                                                      rand.choice(('25', '18')), 1400000000 + no, no),
+                   'm': text}
+        f.write((',' if no else '') + json.dumps(comment, ensure_ascii=False))
+    f.write('],[]]')
+
+
+def write_tudou(f, source):
+    rand = source.random
+    f.write('{"status_code":0,"comment_list":[')
+    for no, at, text, mode, positioned in source:
+        comment = {'pos': (3, 6, 4, 3)[mode], 'data': text, 'size': rand.choice((1, 1, 0, 2)),
+                   'replay_time': int(at * 1000), 'commit_time': 1400000000 + no,
+                   'color': rand.choice((0xffffff, 0xffffff, 0x00ff00))}
+        f.write((',' if no else '') + json.dumps(comment, ensure_ascii=False))
+    f.write(']}')
+
+
+def write_tudou2(f, source):
+    rand = source.random
+    f.write('{"result":[')
+    for no, at, text, mode, positioned in source:
+        propertis = json.dumps({'size': rand.choice((1, 1, 0, 2)), 'pos': (3, 6, 4, 3)[mode],
+                                'color': rand.choice((0xffffff, 0xffffff, 0x123456))})
+        comment = {'content': text, 'propertis': propertis, 'playat': int(at * 1000),
+                   'createtime': (1400000000 + no) * 1000}
+        f.write((',' if no else '') + json.dumps(comment, ensure_ascii=False))
+    f.write('],"count":%d}' % source.count)
+
+
+def write_niconico(f, source):
+    rand = source.random
+    f.write('<?xml version="1.0" encoding="UTF-8"?><packet>')
+    for no, at, text, mode, positioned in source:
+        mail = ' '.join(filter(None, (('', 'shita', 'ue', '')[mode], rand.choice(('', '', 'big', 'small')),
+                                      rand.choice(('', '', 'red', 'blue2')))))
+        f.write('<chat thread="1" no="%d" vpos="%d" date="%d" mail="%s" user_id="u%d">%s</chat>' % (
+            no, int(at * 100), 1400000000 + no, mail, no % 1000, xml_escape(text)))
+    f.write('</packet>')
+
+
+def write_miomio(f, source):
+    rand = source.random
+    f.write('<?xml version="1.0" encoding="UTF-8"?>\n<comments>')
+    for no, at, text, mode, positioned in source:
+        f.write('<data><playTime>%.2f</playTime><message fontsize="%s" color="%d" mode="%s">%s</message>'
+                '<times>2014-01-01 %02d:%02d:%02d</times></data>' % (
+                    at, rand.choice(('25', '18')), rand.choice((0xffffff, 0xff)), ('1', '4', '5', '1')[mode],
+                    xml_escape(text), no // 3600 % 24, no // 60 % 60, no % 60))
+    f.write('</comments>')
+
+
+def write_sh5v(f, source):
+    rand = source.random
+    f.write('{"root":{"total":%d,"bgs":[' % source.count)
+    for no, at, text, mode, positioned in source:
+        comment = {'at': round(at, 3), 'type': '7' if positioned else ('0', '4', '5', '1')[mode],
+                   'timestamp': 1400000000 + no, 'color': '#%06x' % rand.choice((0xffffff, 0xffffff, 0xff0000)),
+                   'text': text}
+        if positioned:
+            comment.update({'x': rand.random(), 'y': rand.random(), 'size': 30, 'dur': 3000, 'data1': 0.5,
+                            'data2': 0.8, 'data3': 10, 'data4': 20})
+        f.write((',' if no else '') + json.dumps(comment, ensure_ascii=False))
+    f.write(']}}')
+
+
+WRITERS = {'bilibili': (write_bilibili, '.xml'), 'acfun': (write_acfun, '.json'), 'tudou': (write_tudou, '.json'),
+           'tudou2': (write_tudou2, '.json'), 'niconico': (write_niconico, '.xml'),
+           'miomio': (write_miomio, '.xml'), 'sh5v': (write_sh5v, '.json')}
+
+
+# Writes the comment file of a case into data_dir, unless it is there already
+def generate_comment_file(data_dir, fmt, count, density, positioned):
+    writer, suffix = WRITERS[fmt]
+    path = os.path.join(data_dir, '%s-%d-%g-%g%s' % (fmt, count, density, positioned, suffix))
+    if not os.path.exists(path):
+        logger.info('Generating {}'.format(path))
+        with open(path + '.tmp', 'w', encoding='utf-8') as f:
+            writer(f, CommentSource(fmt, count, density, positioned))
+        os.replace(path + '.tmp', path)
+    return path
+
+
+# Result: the peak resident set size of this process in bytes since the last
+# call, or since it started if that cannot be reset
+def read_peak_rss(reset=False):
+    try:
+        with open('/proc/self/status') as f:
+            peak = next(int(line.split()[1]) * 1024 for line in f if line.startswith('VmHWM:'))
+        if reset:
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')  # Resets VmHWM to the current RSS
+        return peak
+    except (OSError, StopIteration, ValueError):
+        pass
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+# Collects the Dialogue lines in memory, so that the layout is timed apart
+# from encoding and writing them
+class LineSink:
+    def __init__(self):
+        self.chunks = []
+        self.write = self.chunks.append
+
+    def flush(self):
+        pass
+
+
+# Result: the seconds of a conversion, without the badchars stage that read
+#         repeats
+def get_total_seconds(stages):
+    return sum(info['seconds'] for stage, info in stages.items() if stage != 'badchars')
+
+
+# Runs in a fresh process, so that the peak RSS belongs to this case only
+def run_case(src, case, options):
+    sys.path.insert(0, src)
+    logging.disable(logging.ERROR)  # Such as positioned comments rotated behind the camera
+    import danmaku2ass
+
+    stages = {}
+    read_peak_rss(reset=True)
+
+    def timed(stage, function, *args, **kwargs):
+        start = time.perf_counter()
+        result = function(*args, **kwargs)
+        stages[stage] = {'seconds': time.perf_counter() - start, 'peak_rss': read_peak_rss(reset=True)}
+        return result
+
+    def filter_bad_chars(path):
+        with open(path, 'r', encoding='utf-8', errors='replace') as f:
+            filtered = danmaku2ass.FilterBadChars(f)
+            while filtered.read(io.DEFAULT_BUFFER_SIZE * 64):
+                pass
+
+    def read(path):
+        with open(path, 'r', encoding='utf-8', errors='replace') as f:
+            parsed = processor(danmaku2ass.FilterBadChars(f), options['font_size'])
+            if not hasattr(danmaku2ass, 'CommentTable'):
+                return list(parsed)
+            comments = danmaku2ass.CommentTable()
+            comments.Extend(parsed)
+        return comments
+
+    def write(output_file, chunks):
+        if hasattr(danmaku2ass, 'ASSWriter'):
+            f = danmaku2ass.ASSWriter(open(output_file, 'wb'))
+        else:
+            f = open(output_file, 'w', encoding='utf-8-sig', errors='replace', newline='\r\n')
+        with f:
+            for chunk in chunks:
+                f.write(chunk)
+
+    def probe(path):
+        with open(path, 'r', encoding='utf-8', errors='replace') as f:
+            return danmaku2ass.GetCommentProcessor(f)
+
+    path = case['file']
+    processor = timed('probe', probe, path)
+    timed('badchars', filter_bad_chars, path)
+    comments = timed('read', read, path)
+    count_read = len(comments)
+    timed('sort', comments.sort if isinstance(comments, list) else comments.Sort)
+    if options['max_density'] is not None or options['merge_window'] is not None or options['blocklist']:
+        if not hasattr(danmaku2ass, 'CommentFilter'):
+            raise RuntimeError('{} has no CommentFilter, leave out --max-density, --merge-window and --blocklist'.format(
+                danmaku2ass.__file__))
+        blocklist = danmaku2ass.ReadBlocklist(options['blocklist']) if options['blocklist'] else None
+        comment_filter = danmaku2ass.CommentFilter(options['max_density'], options['duration_marquee'],
+                                                   options['merge_window'], blocklist)
+        comments = timed('filter', comment_filter.Apply, comments)
+    sink = LineSink()
+    width, height = options['stage']
+    # Older trees have a single layout and no layout_engine argument
+    layout_kwargs = {}
+    if 'layout_engine' in inspect.signature(danmaku2ass.ProcessComments).parameters:
+        layout_kwargs['layout_engine'] = options['layout']
+    timed('layout', danmaku2ass.ProcessComments, comments, sink, width, height, 0, 'SimHei', options['font_size'],
+          1.0, options['duration_marquee'], options['duration_still'], options['reduce'], None, **layout_kwargs)
+    output_file = os.path.join(options['data_dir'], 'output-%d.ass' % os.getpid())
+    try:
+        timed('write', write, output_file, sink.chunks)
+        output_size = os.path.getsize(output_file)
+    finally:
+        os.remove(output_file)
+    lines = sum(chunk.count('\n') for chunk in sink.chunks)
+    return dict(case, stages=stages, comments_read=count_read, comments_laid_out=len(comments),
+                output_size=output_size, output_lines=lines,
+                total_seconds=get_total_seconds(stages),
+                peak_rss=max(filter(None, (stage['peak_rss'] for stage in stages.values())), default=None))
+
+
+def get_git_commit(src):
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=src, stdout=subprocess.PIPE,
+                              stderr=subprocess.DEVNULL, universal_newlines=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def case_key(result):
+    return (result['format'], result['comments'], result['density'], result['positioned'])
+
+
+def format_size(size):
+    return '-' if size is None else '%.0fM' % (size / 1048576)
+
+
+def print_result(result):
+    times = ' '.join('{}={:.3f}s'.format(stage, info['seconds']) for stage, info in result['stages'].items())
+    logger.info('{format} n={comments} density={density:g}/s positioned={positioned:g}: {times}, '
+                '{rate:.0f} comments/s, peak RSS {rss}'.format(
+                    times=times, rate=result['comments_read'] / max(result['total_seconds'], 1e-9),
+                    rss=format_size(result['peak_rss']), **result))
+
+
+def print_comparison(results, baseline_file):
+    with open(baseline_file, 'r', encoding='utf-8') as f:
+        baseline = {case_key(i): i for i in json.load(f)['results']}
+    for result in results:
+        old = baseline.get(case_key(result))
+        if not old:
+            logger.info('{format} n={comments}: not in {file}'.format(file=baseline_file, **result))
+            continue
+        ratios = []
+        for stage, info in result['stages'].items():
+            if stage in old['stages'] and old['stages'][stage]['seconds'] > 0:
+                ratios.append('{}={:.2f}x'.format(stage, info['seconds'] / old['stages'][stage]['seconds']))
+        logger.info('{format} n={comments} density={density:g}/s positioned={positioned:g} against baseline: {ratios}, '
+                    'total={total:.2f}x, peak RSS {old_rss} -> {rss}'.format(
+                        ratios=' '.join(ratios), total=result['total_seconds'] / max(old['total_seconds'], 1e-9),
+                        old_rss=format_size(old['peak_rss']), rss=format_size(result['peak_rss']), **result))
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark Danmaku2ASS on synthetic comment files')
+    parser.add_argument('--src', default=DEFAULT_SRC,
+                        help='Directory containing the danmaku2ass.py to benchmark [default: %(default)s]')
+    parser.add_argument('--formats', default=','.join(DEFAULT_FORMATS),
+                        help='Comment formats, separated with commas [default: %(default)s]')
+    parser.add_argument('--sizes', default=DEFAULT_SIZES,
+                        help='Numbers of comments, separated with commas, like 10k,1M,5M [default: %(default)s]')
+    parser.add_argument('--densities', default=DEFAULT_DENSITIES,
+                        help='Comments per second of video, separated with commas [default: %(default)s]')
+    parser.add_argument('--positioned', default=DEFAULT_POSITIONED,
+                        help='Ratios of positioned comments, separated with commas, where the format has them '
+                             '[default: %(default)s]')
+    parser.add_argument('--stage', default=DEFAULT_STAGE, help='Stage size [default: %(default)s]')
+    parser.add_argument('--layout', default='interval', help='Layout engine [default: %(default)s]')
+    parser.add_argument('--reduce', default=False, action='store_true', help='Reduce comments if the stage is full')
+    parser.add_argument('--max-density', type=int, help='Filter with this CommentFilter max_density')
+    parser.add_argument('--merge-window', type=float, help='Filter with this CommentFilter merge_window')
+    parser.add_argument('--blocklist', help='Filter with this blocklist file')
+    parser.add_argument('--repeat', default=1, type=int,
+                        help='Runs of each case, keeping the fastest of each stage [default: %(default)s]')
+    parser.add_argument('--data-dir',
+                        help='Directory to keep the generated comment files in, to reuse them between runs '
+                             '[default: a temporary directory]')
+    parser.add_argument('-o', '--output', default='danmaku2ass-bench.json',
+                        help='JSON file to write the results to [default: %(default)s]')
+    parser.add_argument('--compare', metavar='JSON', help='Results of an earlier run to compare with')
+    args = parser.parse_args()
+    logging.basicConfig(level='INFO', format='%(asctime)s - %(levelname)s - %(message)s')
+
+    formats = parse_list(args.formats, str.strip)
+    for fmt in formats:
+        if fmt not in WRITERS:
+            parser.error('unknown format {}, choose from {}'.format(fmt, ', '.join(DEFAULT_FORMATS)))
+    width, height = (int(i) for i in args.stage.lower().split('x'))
+    temp_dir = None
+    data_dir = args.data_dir
+    if not data_dir:
+        temp_dir = tempfile.TemporaryDirectory(prefix='danmaku2ass-bench-')
+        data_dir = temp_dir.name
+    os.makedirs(data_dir, exist_ok=True)
+    options = {'stage': (width, height), 'layout': args.layout, 'reduce': args.reduce, 'font_size': height / 21.6,
+               'duration_marquee': 8.0, 'duration_still': 5.0, 'max_density': args.max_density,
+               'merge_window': args.merge_window, 'blocklist': args.blocklist and os.path.abspath(args.blocklist),
+               'data_dir': data_dir}
+
+    src = os.path.abspath(args.src)
+    results = []
+    try:
+        for fmt in formats:
+            for count in parse_list(args.sizes, parse_count):
+                for density in parse_list(args.densities, float):
+                    for positioned in parse_list(args.positioned, float):
+                        path = generate_comment_file(data_dir, fmt, count, density, positioned)
+                        case = {'format': fmt, 'comments': count, 'density': density, 'positioned': positioned,
+                                'file': path, 'file_size': os.path.getsize(path)}
+                        best = None
+                        for i in range(args.repeat):
+                            # A new process for each run, with nothing imported but what the case needs
+                            with concurrent.futures.ProcessPoolExecutor(
+                                    max_workers=1, mp_context=multiprocessing.get_context('spawn')) as executor:
+                                result = executor.submit(run_case, src, case, options).result()
+                            if best is None:
+                                best = result
+                            else:
+                                for stage, info in result['stages'].items():
+                                    if info['seconds'] < best['stages'][stage]['seconds']:
+                                        best['stages'][stage] = info
+                                best['total_seconds'] = get_total_seconds(best['stages'])
+                        del best['file']
+                        print_result(best)
+                        results.append(best)
+    finally:
+        if temp_dir:
+            temp_dir.cleanup()
+
+    report = {'version': RESULT_VERSION, 'date': datetime.datetime.now().isoformat(timespec='seconds'),
+              'git_commit': get_git_commit(src), 'python': platform.python_version(),
+              'platform': platform.platform(), 'cpu_count': os.cpu_count(),
+              'options': dict(options, data_dir=None), 'results': results}
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    logger.info('Results written to {}'.format(args.output))
+    if args.compare:
+        print_comparison(results, args.compare)
+
+
+if __name__ == '__main__':
+    main()
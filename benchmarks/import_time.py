@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+
+# Checks the cold-start import cost of yatto.py with python -X importtime.
+#
+# Each path runs in fresh processes, doing what a run of yatto does before its
+# first external command, and the time of the imports it adds to a bare
+# interpreter is compared with a cap:
+#
+#     info    Importing yatto and decoding the output of you-get, as -i does
+#     play    Also sending a request through the HTTP client and converting a
+#             small danmaku file, as a play does without the daemon
+#
+# The modules a path must not import at all, such as danmaku2ass for -i or the
+# charset detection for UTF-8 output, are checked as well, since they do not
+# depend on the speed of the machine. The exit status is 1 if any check fails.
+
+import argparse
+import logging
+import os
+import subprocess
+import sys
+import tempfile
+
+DEFAULT_SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+SAMPLE_DANMAKU = ('<?xml version="1.0" encoding="UTF-8"?><i>'
+                  '<d p="1.5,1,25,16777215,1400000000,0,0,0">弹幕</d>'
+                  '<d p="3.0,5,25,16711680,1400000001,0,0,0">top</d></i>')
+
+# Older trees without decode_output decoded the output at import time already
+DECODE_OUTPUT = 'if hasattr(yatto, "decode_output"): yatto.decode_output("title: 弹幕".encode("utf-8"))\n'
+PATHS = {
+    'info': 'import yatto\n' + DECODE_OUTPUT,
+    'play': 'import yatto\n' + DECODE_OUTPUT +
+            'yatto.is_media_url_alive("http://127.0.0.1:9/")\n'
+            'yatto.convert_comments({!r}.encode("utf-8"), (1280, 720))\n'.format(SAMPLE_DANMAKU),
+}
+DEFAULT_CAPS_MS = {'info': 100, 'play': 200}
+FORBIDDEN_MODULES = {
+    'info': ['danmaku2ass', 'chardet', 'pip', 'urllib.request', 'http.client', 'hashlib'],
+    'play': ['chardet', 'pip'],
+}
+
+logger = logging.getLogger(__name__)
+
+
+# Result: {module: cumulative microseconds} of the imports not nested in
+#         another one, and the set of every module imported
+def run_importtime(src, code, env):
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import sys\nsys.path.insert(0, {!r})\n{}'.format(src, code)],
+                             stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, env=env)
+    if process.returncode:
+        raise RuntimeError('{} failed:\n{}'.format(code, process.stderr.decode('utf-8', 'replace')))
+    top_level, modules = {}, set()
+    for line in process.stderr.decode('utf-8', 'replace').splitlines():
+        if not line.startswith('import time:'):
+            continue
+        fields = line[len('import time:'):].split('|')
+        if len(fields) != 3 or not fields[1].strip().isdigit():
+            continue  # The header line
+        name = fields[2].strip()
+        modules.add(name)
+        if len(fields[2]) - len(fields[2].lstrip()) == 1:
+            top_level[name] = int(fields[1])
+    return top_level, modules
+
+
+def check_path(src, path, cap_ms, repeat, env):
+    baseline, baseline_modules = run_importtime(src, 'pass', env)
+    best = None
+    for i in range(repeat):
+        top_level, modules = run_importtime(src, PATHS[path], env)
+        added = {name: usec for name, usec in top_level.items() if name not in baseline}
+        if best is None or sum(added.values()) < sum(best[0].values()):
+            best = added, modules - baseline_modules
+    added, modules = best
+    # Without a line for yatto itself the output was not parsed, and the time
+    # would pass any cap as 0ms
+    if 'yatto' not in added:
+        return ['{}: no import time of yatto found in the output of python -X importtime'.format(path)]
+    total_ms = sum(added.values()) / 1000
+    slowest = sorted(added.items(), key=lambda i: i[1], reverse=True)[:5]
+    logger.info('{}: {:.1f}ms of a {:g}ms cap for {} modules, slowest {}'.format(
+        path, total_ms, cap_ms, len(modules),
+        ', '.join('{} {:.1f}ms'.format(name, usec / 1000) for name, usec in slowest)))
+    failures = []
+    if total_ms > cap_ms:
+        failures.append('{}: imports take {:.1f}ms, over the cap of {:g}ms set by --max-{}-ms'.format(
+            path, total_ms, cap_ms, path))
+    for name in FORBIDDEN_MODULES[path]:
+        imported = sorted(i for i in modules if i == name or i.startswith(name + '.'))
+        if imported:
+            failures.append('{}: imports {} ({} modules)'.format(path, name, len(imported)))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the cold-start import cost of yatto.py')
+    parser.add_argument('--src', default=DEFAULT_SRC,
+                        help='Directory containing the yatto.py to check [default: %(default)s]')
+    parser.add_argument('--paths', default=','.join(PATHS),
+                        help='Paths to check, separated with commas [default: %(default)s]')
+    parser.add_argument('--max-info-ms', default=DEFAULT_CAPS_MS['info'], type=float,
+                        help='Cap on the import time of the info path [default: %(default)s]')
+    parser.add_argument('--max-play-ms', default=DEFAULT_CAPS_MS['play'], type=float,
+                        help='Cap on the import time of the play path [default: %(default)s]')
+    parser.add_argument('--repeat', default=5, type=int,
+                        help='Runs of each path, keeping the fastest [default: %(default)s]')
+    args = parser.parse_args()
+    logging.basicConfig(level='INFO', format='%(asctime)s - %(levelname)s - %(message)s')
+
+    caps = {'info': args.max_info_ms, 'play': args.max_play_ms}
+    for path, cap_ms in caps.items():
+        if cap_ms <= 0:
+            parser.error('--max-{}-ms must be positive'.format(path))
+    src = os.path.abspath(args.src)
+    failures = []
+    with tempfile.TemporaryDirectory(prefix='yatto-import-time-') as cache_dir:
+        # Keep the converted danmaku out of the real cache, and the request off any proxy
+        env = dict(os.environ, XDG_CACHE_HOME=cache_dir, LOCALAPPDATA=cache_dir, no_proxy='*')
+        for path in args.paths.split(','):
+            path = path.strip()
+            if path not in PATHS:
+                parser.error('unknown path {}, choose from {}'.format(path, ', '.join(PATHS)))
+            failures += check_path(src, path, caps[path], max(args.repeat, 1), env)
+    for failure in failures:
+        logger.error(failure)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+
+# Checks that play_video_early of yatto.py starts the player before the
+# danmaku is ready and loads the danmaku into it over mpv's JSON IPC.
+#
+# A fake mpv command, put first on PATH, serves the --input-ipc-server socket,
+# answers every command as mpv would, with an event mixed into the replies,
+# and records the commands it receives with their time. It exits once yatto
+# closes the IPC connection. The video comes from the fake site and the fake
+# you-get and ffprobe commands of async_prepare_bench.py. The same video is
+# played twice:
+#
+#     convert  The danmaku is converted while the video plays, so the player
+#              must start before the first sub-add, which loads the first time
+#              window, and the finished file is loaded with sub-reload
+#     cached   The converted danmaku comes from the cache and is loaded with a
+#              single sub-add
+#
+# The exit status is 1 if any check fails. Unix only, as the fake commands are
+# scripts.
+
+import argparse
+import json
+import logging
+import os
+import re
+import sys
+import tempfile
+import time
+
+from async_prepare_bench import DEFAULT_SRC, install_fake_commands, start_fake_site
+
+FAKE_MPV = '''#!{python}
+import json, os, socket, sys, time
+record = open({record!r}, 'a')
+def log(**kwargs):
+    record.write(json.dumps(dict(kwargs, time=time.time())) + '\\n')
+    record.flush()
+args = sys.argv[1:]
+log(event='start', args=args)
+path = [i.split('=', 1)[1] for i in args if i.startswith('--input-ipc-server=')][0]
+if os.path.exists(path):
+    os.remove(path)
+server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+server.bind(path)
+server.listen(1)
+server.settimeout({timeout})
+conn = server.accept()[0]
+conn.settimeout({timeout})
+stream = conn.makefile('rwb', buffering=0)
+sub_id = 0
+for line in stream:
+    request = json.loads(line.decode('utf-8'))
+    command = request['command']
+    log(event='command', command=command, exists=os.path.exists(command[1]) if command[0] == 'sub-add' else None)
+    data = None
+    if command[0] == 'sub-add':
+        sub_id += 1
+    elif command == ['get_property', 'sid']:
+        data = sub_id
+    stream.write(json.dumps({{'event': 'playback-restart'}}).encode('utf-8') + b'\\n')
+    stream.write(json.dumps({{'request_id': request['request_id'], 'error': 'success', 'data': data}}).encode('utf-8') + b'\\n')
+log(event='exit')
+os.remove(path)
+'''
+
+logger = logging.getLogger(__name__)
+
+
+def install_fake_mpv(directory, record, timeout):
+    path = os.path.join(directory, 'mpv')
+    with open(path, 'w') as f:
+        f.write(FAKE_MPV.format(python=sys.executable, record=record, timeout=timeout))
+    os.chmod(path, 0o755)
+
+
+def read_record(record):
+    with open(record, 'r', encoding='utf-8') as f:
+        return [json.loads(line) for line in f]
+
+
+def check_run(run, played, events):
+    failures = []
+    if not played:
+        return ['{}: play_video_early found no video'.format(run)]
+    starts = [i for i in events if i['event'] == 'start']
+    commands = [i for i in events if i['event'] == 'command']
+    if len(starts) != 1:
+        return ['{}: the player started {} times'.format(run, len(starts))]
+    args = starts[0]['args']
+    if '--sub-file' in args or '--' not in args or not any(i.startswith('--input-ipc-server=') for i in args):
+        failures.append('{}: unexpected player arguments {}'.format(run, args))
+    if not commands or commands[0]['command'][0] != 'sub-add':
+        return failures + ['{}: no sub-add received, got {}'.format(run, [i['command'] for i in commands])]
+    sub_add = commands[0]
+    logger.info('{}: player started, first sub-add {:.2f}s later, commands {}'.format(
+        run, sub_add['time'] - starts[0]['time'], ' '.join(i['command'][0] for i in commands)))
+    if not sub_add['exists'] or not sub_add['command'][1].endswith('.ass') or sub_add['command'][2] != 'select':
+        failures.append('{}: bad sub-add {}'.format(run, sub_add['command']))
+    if sub_add['time'] < starts[0]['time']:
+        failures.append('{}: the danmaku was ready before the player started'.format(run))
+    names = [i['command'][0] for i in commands]
+    expected = ['sub-add', 'get_property', 'sub-reload'] if run == 'convert' else ['sub-add', 'get_property']
+    if names != expected:
+        failures.append('{}: commands {}, expected {}'.format(run, names, expected))
+    elif run == 'convert' and commands[2]['command'] != ['sub-reload', 1]:
+        failures.append('{}: sub-reload of the wrong track {}'.format(run, commands[2]['command']))
+    if events[-1]['event'] != 'exit':
+        failures.append('{}: the player did not see the IPC connection closed'.format(run))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the early start of the player and the danmaku loaded over IPC')
+    parser.add_argument('--src', default=DEFAULT_SRC,
+                        help='Directory containing the yatto.py to check [default: %(default)s]')
+    parser.add_argument('--comments', default=5000, type=int,
+                        help='Comments in the danmaku of the video [default: %(default)s]')
+    parser.add_argument('--latency', default=0.05, type=float,
+                        help='Seconds the fake site takes to answer each request [default: %(default)s]')
+    parser.add_argument('--process-delay', default=0.3, type=float,
+                        help='Seconds the fake you-get and ffprobe take to run [default: %(default)s]')
+    parser.add_argument('--timeout', default=30, type=float,
+                        help='Seconds the fake mpv waits for yatto before giving up [default: %(default)s]')
+    args = parser.parse_args()
+    logging.basicConfig(level='INFO', format='%(asctime)s - %(levelname)s - %(message)s')
+    logging.getLogger().handlers[0].addFilter(logging.Filter(__name__))
+
+    failures = []
+    with tempfile.TemporaryDirectory(prefix='yatto-mpv-ipc-check-') as work_dir:
+        # yatto.py picks its cache directories on import
+        os.environ['XDG_CACHE_HOME'] = os.path.join(work_dir, 'cache')
+        os.environ['no_proxy'] = '*'
+        sys.path.insert(0, os.path.abspath(args.src))
+        import yatto
+
+        server, base = start_fake_site(args.latency, args.comments)
+        install_fake_commands(work_dir, base, args.process_delay)
+        record = os.path.join(work_dir, 'mpv-commands.jsonl')
+        install_fake_mpv(work_dir, record, args.timeout)
+
+        def parse_fake_danmaku(page):
+            match = re.search(r'cid=(\d+)', page)
+            return '{}/comment/{}.xml'.format(base, match.group(1)) if match else ''
+        yatto.danmaku_parsers['127.0.0.1'] = parse_fake_danmaku
+
+        for run in ('convert', 'cached'):
+            open(record, 'w').close()
+            start = time.time()
+            played = yatto.play_video_early('{}/video/1'.format(base), '')
+            logger.info('{}: played in {:.2f}s'.format(run, time.time() - start))
+            failures += check_run(run, played, read_record(record))
+        server.shutdown()
+    for failure in failures:
+        logger.error(failure)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,169 @@
+#!/usr/bin/env python3
+
+# Checks that yatto.py downloads the danmaku segments of Youku and Tudou videos
+# concurrently, against a local stand-in for their danmaku service.
+#
+# The stand-in serves the 5 minute segments of a --minutes long video, each
+# answering after its own latency, picked at random between --min-latency and
+# --max-latency, and some of them failing their first request with 503 to
+# exercise the retries. fetch_danmaku_segments downloads all of them once with
+# a single job, as the segments used to be fetched one after another, and once
+# with --jobs. Both runs must merge the same comments in segment order, and the
+# concurrent run must take no longer than the schedule of the latencies over
+# --jobs workers, about the slowest segment when there are as many jobs as
+# segments, rather than their sum. The exit status is 1 if any check fails.
+
+import argparse
+import heapq
+import http.server
+import json
+import logging
+import math
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+
+DEFAULT_SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+logger = logging.getLogger(__name__)
+
+
+class SegmentHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        server = self.server
+        query = urllib.parse.parse_qs(urllib.parse.urlparse(self.path).query)
+        try:
+            segment, run = int(query['mat'][0]) // 5, query['iid'][0]
+            latency = server.latencies[segment]
+        except (KeyError, ValueError, IndexError):
+            self.send_error(404)
+            return
+        with server.lock:
+            server.requests += 1
+            server.in_flight += 1
+            server.max_in_flight = max(server.max_in_flight, server.in_flight)
+            first_try = (run, segment) not in server.seen
+            server.seen.add((run, segment))
+        try:
+            time.sleep(latency)
+            if first_try and segment in server.failing:
+                self.send_error(503)
+                return
+            comments = [{'playat': (segment * 300 + i) * 1000, 'content': 'segment {} comment {}'.format(segment, i),
+                         'propertis': '{"size":2,"color":16777215,"pos":3}'} for i in range(server.comments)]
+            body = json.dumps({'count': len(comments), 'result': comments}).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.send_header('Cache-Control', 'no-store')
+            self.end_headers()
+            self.wfile.write(body)
+        finally:
+            with server.lock:
+                server.in_flight -= 1
+
+    def log_message(self, format, *args):
+        pass
+
+
+def start_segment_server(latencies, failing, comments):
+    server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), SegmentHandler)
+    server.daemon_threads = True
+    server.latencies = latencies
+    server.failing = failing
+    server.comments = comments
+    server.lock = threading.Lock()
+    server.seen = set()
+    server.requests = server.in_flight = server.max_in_flight = 0
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, 'http://127.0.0.1:{}'.format(server.server_address[1])
+
+
+# Result: the seconds the latencies take when jobs workers take them in order,
+#         each worker the next one as soon as it is free
+def get_schedule_seconds(latencies, jobs):
+    workers = [0.0] * max(min(jobs, len(latencies)), 1)
+    for latency in latencies:
+        heapq.heappush(workers, heapq.heappop(workers) + latency)
+    return max(workers)
+
+
+def check_merged(danmaku, segments, comments):
+    contents = [comment['content'] for comment in json.loads(danmaku.decode('utf-8'))['result']]
+    expected = ['segment {} comment {}'.format(segment, i) for segment in range(segments) for i in range(comments)]
+    return contents == expected
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check the concurrent download of danmaku segments')
+    parser.add_argument('--src', default=DEFAULT_SRC,
+                        help='Directory containing the yatto.py to check [default: %(default)s]')
+    parser.add_argument('--minutes', default=120, type=int,
+                        help='Length of the video, one segment every 5 minutes [default: %(default)s]')
+    parser.add_argument('--jobs', default=8, type=int,
+                        help='Segments downloaded at the same time [default: %(default)s]')
+    parser.add_argument('--min-latency', default=0.1, type=float,
+                        help='Least seconds a segment takes to answer [default: %(default)s]')
+    parser.add_argument('--max-latency', default=0.5, type=float,
+                        help='Most seconds a segment takes to answer [default: %(default)s]')
+    parser.add_argument('--failing', default=2, type=int,
+                        help='Segments failing their first request [default: %(default)s]')
+    parser.add_argument('--comments', default=200, type=int,
+                        help='Comments in each segment [default: %(default)s]')
+    parser.add_argument('--tolerance', default=0.5, type=float,
+                        help='Seconds the concurrent run may take beyond its schedule [default: %(default)s]')
+    parser.add_argument('--seed', default=0, type=int, help='Seed of the latencies [default: %(default)s]')
+    args = parser.parse_args()
+    logging.basicConfig(level='INFO', format='%(asctime)s - %(levelname)s - %(message)s')
+    # Leave out the progress of every merged segment
+    logging.getLogger().handlers[0].addFilter(logging.Filter(__name__))
+
+    segments = args.minutes // 5 + 1
+    rng = random.Random(args.seed)
+    latencies = [rng.uniform(args.min_latency, args.max_latency) for i in range(segments)]
+    failing = set(rng.sample(range(segments), min(args.failing, segments)))
+
+    failures = []
+    with tempfile.TemporaryDirectory(prefix='yatto-segment-bench-') as cache_dir:
+        # yatto.py picks its cache directories on import
+        os.environ['XDG_CACHE_HOME'] = cache_dir
+        os.environ['no_proxy'] = '*'
+        sys.path.insert(0, os.path.abspath(args.src))
+        import yatto
+
+        server, base = start_segment_server(latencies, failing, args.comments)
+        # A retry waits for yatto's backoff, once per failing segment
+        retry_seconds = yatto.DANMAKU_SEGMENT_BACKOFF + max(latencies)
+        for run, jobs in (('serial', 1), ('concurrent', args.jobs)):
+            urls = ['{}/list?mat={}&mcount=5&ct=1001&uid=0&iid={}'.format(base, i * 5, run) for i in range(segments)]
+            server.requests = server.max_in_flight = 0
+            start = time.time()
+            danmaku = yatto.fetch_danmaku_segments(urls, jobs)
+            duration = time.time() - start
+            schedule = get_schedule_seconds(latencies, jobs)
+            logger.info('{}: {} segments with {} jobs in {:.2f}s, {} requests, at most {} in flight, '
+                        'scheduled {:.2f}s, slowest segment {:.2f}s, all segments {:.2f}s'.format(
+                            run, segments, jobs, duration, server.requests, server.max_in_flight, schedule,
+                            max(latencies), sum(latencies)))
+            if not check_merged(danmaku, segments, args.comments):
+                failures.append('{}: the merged comments are missing or out of segment order'.format(run))
+            if server.requests != segments + len(failing):
+                failures.append('{}: {} requests, expected {} with one retry of each failing segment'.format(
+                    run, server.requests, segments + len(failing)))
+            bound = schedule + retry_seconds * math.ceil(len(failing) / max(jobs, 1)) + args.tolerance
+            if run == 'concurrent' and duration > bound:
+                failures.append('{}: took {:.2f}s, more than the {:.2f}s its schedule allows'.format(run, duration, bound))
+        server.shutdown()
+    for failure in failures:
+        logger.error(failure)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,102 @@
+#!/usr/bin/env python3
+
+# Checks that Danmaku2ASS converts comment files with positioned comments under
+# every text width model.
+#
+# The Acfun and Bilibili files are generated like those of
+# danmaku2ass_bench.py, with a share of positioned comments, whose text is not
+# a plain string and whose width the models must leave alone. Each file is
+# converted under the length and eastasian models, and under the font file
+# model if a font is given or found, and the positioned Dialogue lines, those
+# with \org, must come out the same under all of them, but for their random
+# style name. The exit status is 1 if any check fails.
+
+import argparse
+import glob
+import logging
+import os
+import sys
+import tempfile
+
+from danmaku2ass_bench import DEFAULT_SRC, generate_comment_file
+
+FONT_DIRS = ['/usr/share/fonts', '/usr/local/share/fonts', os.path.expanduser('~/.fonts'), '/Library/Fonts',
+             '/System/Library/Fonts', os.path.join(os.environ.get('WINDIR', 'C:\\Windows'), 'Fonts')]
+
+logger = logging.getLogger(__name__)
+
+
+def find_font_file():
+    for font_dir in FONT_DIRS:
+        for pattern in ('**/*.ttf', '**/*.otf'):
+            found = sorted(glob.glob(os.path.join(font_dir, pattern), recursive=True))
+            if found:
+                return found[0]
+    return None
+
+
+# Result: the positioned Dialogue lines of an ASS file, without their style
+# name, which is random
+def read_positioned_lines(path):
+    with open(path, encoding='utf-8-sig') as f:
+        return [fields[:3]+fields[4:] for fields in (line.split(',', 9) for line in f if line.startswith('Dialogue:') and '\\org(' in line)]
+
+
+def check_file(danmaku2ass, path, models, output_dir):
+    failures = []
+    baseline = None
+    for name, width_model, font_file in models:
+        output = os.path.join(output_dir, '{}-{}.ass'.format(os.path.basename(path), name))
+        try:
+            danmaku2ass.Danmaku2ASS([path], output, 1280, 720, width_model=width_model, font_file=font_file)
+        except Exception as e:
+            failures.append('{} under {}: {}: {}'.format(os.path.basename(path), name, type(e).__name__, e))
+            continue
+        lines = read_positioned_lines(output)
+        logger.info('{} under {}: {} positioned comments'.format(os.path.basename(path), name, len(lines)))
+        if not lines:
+            failures.append('{} under {}: no positioned comments in the output'.format(os.path.basename(path), name))
+        elif baseline is None:
+            baseline = name, lines
+        elif lines != baseline[1]:
+            failures.append('{} under {}: positioned comments differ from those under {}'.format(
+                os.path.basename(path), name, baseline[0]))
+    return failures
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Check Danmaku2ASS on positioned comments under every width model')
+    parser.add_argument('--src', default=DEFAULT_SRC,
+                        help='Directory containing the danmaku2ass.py to check [default: %(default)s]')
+    parser.add_argument('--font-file', help='Font file for the font width model [default: the first font found]')
+    parser.add_argument('--comments', default=5000, type=int,
+                        help='Comments in each generated file [default: %(default)s]')
+    parser.add_argument('--positioned', default=0.1, type=float,
+                        help='Ratio of positioned comments [default: %(default)s]')
+    args = parser.parse_args()
+    logging.basicConfig(level='INFO', format='%(asctime)s - %(levelname)s - %(message)s')
+    # Leave out the warnings of Danmaku2ASS about the generated comments
+    logging.getLogger().handlers[0].addFilter(logging.Filter(__name__))
+
+    sys.path.insert(0, os.path.abspath(args.src))
+    import danmaku2ass
+
+    models = [('length', 'length', None), ('eastasian', 'eastasian', None)]
+    font_file = args.font_file or find_font_file()
+    if font_file:
+        models.append(('font', 'length', font_file))
+    else:
+        logger.warning('No font file found, skipping the font width model, use --font-file to give one')
+
+    failures = []
+    with tempfile.TemporaryDirectory(prefix='width-model-check-') as work_dir:
+        for fmt in ('acfun', 'bilibili'):
+            path = generate_comment_file(work_dir, fmt, args.comments, 20, args.positioned)
+            failures += check_file(danmaku2ass, path, models, work_dir)
+    for failure in failures:
+        logger.error(failure)
+    sys.exit(1 if failures else 0)
+
+
+if __name__ == '__main__':
+    main()
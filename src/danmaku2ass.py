@@ -11,19 +11,28 @@
 #   https://github.com/m13253/danmaku2ass
 # Please update to the latest version before complaining.
 
-import argparse
-import calendar
+# argparse, calendar, concurrent.futures, hashlib, orjson and
+# xml.etree.ElementTree are imported where they are needed, as most runs only
+# use some of them and importing them all would slow down every start
+import array
+import bisect
+import collections
+import functools
 import gettext
+import glob
 import io
 import json
 import logging
 import math
+import mmap
 import os
 import random
 import re
+import struct
 import sys
+import threading
 import time
-import xml.dom.minidom
+import unicodedata
 
 
 if sys.version_info < (3,):
@@ -54,14 +63,22 @@ def EOFAsNone(function):
 @SeekZero
 @EOFAsNone
 def ProbeCommentFormat(f):
-    tmp = f.read(1)
+    return ProbeCommentFormatPrefix(f.read(ProbePrefixLength))
+
+
+# The number of characters ProbeCommentFormatPrefix needs
+ProbePrefixLength = 60
+
+
+def ProbeCommentFormatPrefix(prefix):
+    tmp = prefix[:1]
     if tmp == '[':
         return 'Acfun'
         # It is unwise to wrap a JSON object in an array!
         # See this: http://haacked.com/archive/2008/11/20/anatomy-of-a-subtle-json-vulnerability.aspx/
         # Do never follow what Acfun developers did!
     elif tmp == '{':
-        tmp = f.read(14)
+        tmp = prefix[1:15]
         if tmp == '"status_code":':
             return 'Tudou'
         elif tmp == '"root":{"total':
@@ -69,9 +86,9 @@ def ProbeCommentFormat(f):
         elif tmp.strip().startswith('"result'):
             return 'Tudou2'
     elif tmp == '<':
-        tmp = f.read(1)
+        tmp = prefix[1:2]
         if tmp == '?':
-            tmp = f.read(38)
+            tmp = prefix[2:40]
             if tmp == 'xml version="1.0" encoding="UTF-8"?><p':
                 return 'Niconico'
             elif tmp == 'xml version="1.0" encoding="UTF-8"?><i':
@@ -81,7 +98,7 @@ def ProbeCommentFormat(f):
             elif tmp == 'xml version="1.0" encoding="Utf-8"?>\n<':
                 return 'Bilibili'  # Komica, with the same file format as Bilibili
             elif tmp == 'xml version="1.0" encoding="UTF-8"?>\n<':
-                tmp = f.read(20)
+                tmp = prefix[40:60]
                 if tmp == '!-- BoonSutazioData=':
                     return 'Niconico'  # Niconico videos downloaded with NicoFox
                 else:
@@ -90,6 +107,14 @@ def ProbeCommentFormat(f):
             return 'Niconico'  # Himawari Douga, with the same file format as Niconico Douga
 
 
+# Same as ProbeCommentFormat, for a comment file held in a bytes-like object
+def ProbeCommentFormatBuffer(data):
+    # Enough bytes for ProbePrefixLength characters of UTF-8
+    prefix = bytes(memoryview(data)[:ProbePrefixLength*4]).decode('utf-8', 'replace')
+    # Translate newlines like reading a file in text mode
+    return ProbeCommentFormatPrefix(io.StringIO(prefix, newline=None).read(ProbePrefixLength))
+
+
 #
 # ReadComments**** protocol
 #
@@ -114,7 +139,8 @@ def ProbeCommentFormat(f):
 #     height:    The estimated height in pixels
 #                i.e. (comment.count('\n')+1)*size
 #     width:     The estimated width in pixels
-#                i.e. CalculateLength(comment)*size
+#                i.e. CalculateLength(comment)*size, ReadComments may measure
+#                it again with a TextWidthModel
 #
 # After implementing ReadComments****, make sure to update ProbeCommentFormat
 # and CommentFormatMap.
@@ -123,17 +149,15 @@ def ProbeCommentFormat(f):
 
 def ReadCommentsNiconico(f, fontsize):
     NiconicoColorMap = {'red': 0xff0000, 'pink': 0xff8080, 'orange': 0xffcc00, 'yellow': 0xffff00, 'green': 0x00ff00, 'cyan': 0x00ffff, 'blue': 0x0000ff, 'purple': 0xc000ff, 'black': 0x000000, 'niconicowhite': 0xcccc99, 'white2': 0xcccc99, 'truered': 0xcc0033, 'red2': 0xcc0033, 'passionorange': 0xff6600, 'orange2': 0xff6600, 'madyellow': 0x999900, 'yellow2': 0x999900, 'elementalgreen': 0x00cc66, 'green2': 0x00cc66, 'marineblue': 0x33ffcc, 'blue2': 0x33ffcc, 'nobleviolet': 0x6633cc, 'purple2': 0x6633cc}
-    dom = xml.dom.minidom.parse(f)
-    comment_element = dom.getElementsByTagName('chat')
-    for comment in comment_element:
+    for comment in IterXMLElements(f, 'chat'):
         try:
-            c = str(comment.childNodes[0].wholeText)
+            c = str(GetElementText(comment))
             if c.startswith('/'):
                 continue  # ignore advanced comments
             pos = 0
             color = 0xffffff
             size = fontsize
-            for mailstyle in str(comment.getAttribute('mail')).split():
+            for mailstyle in str(comment.get('mail', '')).split():
                 if mailstyle == 'ue':
                     pos = 1
                 elif mailstyle == 'shita':
@@ -144,17 +168,15 @@ def ReadCommentsNiconico(f, fontsize):
                     size = fontsize*0.64
                 elif mailstyle in NiconicoColorMap:
                     color = NiconicoColorMap[mailstyle]
-            yield (max(int(comment.getAttribute('vpos')), 0)*0.01, int(comment.getAttribute('date')), int(comment.getAttribute('no')), c, pos, color, size, (c.count('\n')+1)*size, CalculateLength(c)*size)
+            yield (max(int(comment.get('vpos', '')), 0)*0.01, int(comment.get('date', '')), int(comment.get('no', '')), c, pos, color, size, (c.count('\n')+1)*size, CalculateLength(c)*size)
         except (AssertionError, AttributeError, IndexError, TypeError, ValueError):
-            logging.warning(_('Invalid comment: %s') % comment.toxml())
+            logging.warning(_('Invalid comment: %s') % ElementToXML(comment))
             continue
 
 
 def ReadCommentsAcfun(f, fontsize):
-    comment_element = json.load(f)
-    # after load acfun comment json file as python list, flatten the list
-    comment_element = [c for sublist in comment_element for c in sublist]
-    for i, comment in enumerate(comment_element):
+    # Acfun comment files are lists of lists, walk them flattened
+    for i, comment in enumerate(IterJSONElements(f, ('*', '*'))):
         try:
             p = str(comment['c']).split(',')
             assert len(p) >= 6
@@ -164,7 +186,7 @@ def ReadCommentsAcfun(f, fontsize):
                 c = str(comment['m']).replace('\\r', '\n').replace('\r', '\n')
                 yield (float(p[0]), int(p[5]), i, c, {'1': 0, '2': 0, '4': 2, '5': 1}[p[2]], int(p[1]), size, (c.count('\n')+1)*size, CalculateLength(c)*size)
             else:
-                c = dict(json.loads(comment['m']))
+                c = dict(DecodeJSON(comment['m']))
                 yield (float(p[0]), int(p[5]), i, c, 'acfunpos', int(p[1]), size, 0, 0)
         except (AssertionError, AttributeError, IndexError, TypeError, ValueError):
             logging.warning(_('Invalid comment: %r') % comment)
@@ -172,30 +194,27 @@ def ReadCommentsAcfun(f, fontsize):
 
 
 def ReadCommentsBilibili(f, fontsize):
-    dom = xml.dom.minidom.parse(f)
-    comment_element = dom.getElementsByTagName('d')
-    for i, comment in enumerate(comment_element):
+    for i, comment in enumerate(IterXMLElements(f, 'd')):
         try:
-            p = str(comment.getAttribute('p')).split(',')
+            p = str(comment.get('p', '')).split(',')
             assert len(p) >= 5
             assert p[1] in ('1', '4', '5', '6', '7', '8')
             if p[1] in ('1', '4', '5', '6'):
-                c = str(comment.childNodes[0].wholeText).replace('/n', '\n')
+                c = str(GetElementText(comment)).replace('/n', '\n')
                 size = int(p[2])*fontsize/25.0
                 yield (float(p[0]), int(p[4]), i, c, {'1': 0, '4': 2, '5': 1, '6': 3}[p[1]], int(p[3]), size, (c.count('\n')+1)*size, CalculateLength(c)*size)
             elif p[1] == '7':  # positioned comment
-                c = str(comment.childNodes[0].wholeText)
+                c = str(GetElementText(comment))
                 yield (float(p[0]), int(p[4]), i, c, 'bilipos', int(p[3]), int(p[2]), 0, 0)
             elif p[1] == '8':
                 pass  # ignore scripted comment
         except (AssertionError, AttributeError, IndexError, TypeError, ValueError):
-            logging.warning(_('Invalid comment: %s') % comment.toxml())
+            logging.warning(_('Invalid comment: %s') % ElementToXML(comment))
             continue
 
 
 def ReadCommentsTudou(f, fontsize):
-    comment_element = json.load(f)
-    for i, comment in enumerate(comment_element['comment_list']):
+    for i, comment in enumerate(IterJSONElements(f, ('comment_list', '*'))):
         try:
             assert comment['pos'] in (3, 4, 6)
             c = str(comment['data'])
@@ -208,11 +227,10 @@ def ReadCommentsTudou(f, fontsize):
 
 
 def ReadCommentsTudou2(f, fontsize):
-    comment_element = json.load(f)
-    for i, comment in enumerate(comment_element['result']):
+    for i, comment in enumerate(IterJSONElements(f, ('result', '*'))):
         try:
             c = str(comment['content'])
-            prop = json.loads(str(comment['propertis']) or '{}')
+            prop = DecodeJSONCached(str(comment['propertis']) or '{}')
             size = int(prop.get('size', 1))
             assert size in (0, 1, 2)
             size = {0: 0.64, 1: 1, 2: 1.44}[size] * fontsize
@@ -228,24 +246,22 @@ def ReadCommentsTudou2(f, fontsize):
 
 
 def ReadCommentsMioMio(f, fontsize):
+    import calendar
     NiconicoColorMap = {'red': 0xff0000, 'pink': 0xff8080, 'orange': 0xffc000, 'yellow': 0xffff00, 'green': 0x00ff00, 'cyan': 0x00ffff, 'blue': 0x0000ff, 'purple': 0xc000ff, 'black': 0x000000}
-    dom = xml.dom.minidom.parse(f)
-    comment_element = dom.getElementsByTagName('data')
-    for i, comment in enumerate(comment_element):
+    for i, comment in enumerate(IterXMLElements(f, 'data')):
         try:
-            message = comment.getElementsByTagName('message')[0]
-            c = str(message.childNodes[0].wholeText)
+            message = comment.findall('.//message')[0]
+            c = str(GetElementText(message))
             pos = 0
-            size = int(message.getAttribute('fontsize'))*fontsize/25.0
-            yield (float(comment.getElementsByTagName('playTime')[0].childNodes[0].wholeText), int(calendar.timegm(time.strptime(comment.getElementsByTagName('times')[0].childNodes[0].wholeText, '%Y-%m-%d %H:%M:%S')))-28800, i, c, {'1': 0, '4': 2, '5': 1}[message.getAttribute('mode')], int(message.getAttribute('color')), size, (c.count('\n')+1)*size, CalculateLength(c)*size)
+            size = int(message.get('fontsize', ''))*fontsize/25.0
+            yield (float(GetElementText(comment.findall('.//playTime')[0])), int(calendar.timegm(time.strptime(GetElementText(comment.findall('.//times')[0]), '%Y-%m-%d %H:%M:%S')))-28800, i, c, {'1': 0, '4': 2, '5': 1}[message.get('mode', '')], int(message.get('color', '')), size, (c.count('\n')+1)*size, CalculateLength(c)*size)
         except (AssertionError, AttributeError, IndexError, TypeError, ValueError):
-            logging.warning(_('Invalid comment: %s') % comment.toxml())
+            logging.warning(_('Invalid comment: %s') % ElementToXML(comment))
             continue
 
 
 def ReadCommentsSH5V(f, fontsize):
-    comment_element = json.load(f)
-    for i, comment in enumerate(comment_element["root"]["bgs"]):
+    for i, comment in enumerate(IterJSONElements(f, ('root', 'bgs', '*'))):
         try:
             c_at = str(comment['at'])
             c_type = str(comment['type'])
@@ -270,106 +286,367 @@ def ReadCommentsSH5V(f, fontsize):
             continue
 
 
+# Yield every element named tag in document order, then detach it from the
+# tree, so that memory usage does not grow with the size of the document
+def IterXMLElements(f, tag):
+    import xml.etree.ElementTree
+    parents = []
+    for event, element in xml.etree.ElementTree.iterparse(f, events=('start', 'end')):
+        if event == 'start':
+            parents.append(element)
+            continue
+        parents.pop()
+        if element.tag == tag:
+            yield element
+            element.clear()
+            if parents and len(parents[-1]) and parents[-1][-1] is element:
+                del parents[-1][-1]
+
+
+# Same as element.childNodes[0].wholeText in DOM
+def GetElementText(element):
+    if element.text is None:
+        raise IndexError('element has no leading text')
+    return element.text
+
+
+def ElementToXML(element):
+    import xml.etree.ElementTree
+    return xml.etree.ElementTree.tostring(element, encoding='unicode')
+
+
+# Yield the values found at path in a JSON document, decoding one of them at
+# a time instead of the whole document
+#
+# path is a sequence of object keys, or '*' for every element of an array,
+# e.g. ('root', 'bgs', '*') for every element of document['root']['bgs']
+def IterJSONElements(f, path):
+    return JSONStreamReader(f).Iter(tuple(path))
+
+
+class JSONStreamReader(object):
+    ChunkSize = 65536
+    Whitespace = re.compile('[ \t\n\r]*')
+    NumberPart = re.compile('[-+.eE0-9]*')
+    LongNumber = re.compile('[0-9]{19}')  # orjson rounds integers beyond 64 bits to floats
+
+    def __init__(self, f):
+        self.f = f
+        self.buffer = ''
+        self.pos = 0
+        self.eof = False
+        self.scan_once = json.JSONDecoder().scan_once
+
+    def Fill(self):
+        chunk = self.f.read(max(self.ChunkSize, len(self.buffer)-self.pos))
+        if not chunk:
+            self.eof = True
+        self.buffer = self.buffer[self.pos:]+chunk
+        self.pos = 0
+
+    # Result: the next character that is not whitespace, or '' at the end
+    def Peek(self):
+        while True:
+            self.pos = self.Whitespace.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer) or self.eof:
+                return self.buffer[self.pos:self.pos+1]
+            self.Fill()
+
+    def Expect(self, chars):
+        char = self.Peek()
+        if not char or char not in chars:
+            raise json.JSONDecodeError('Expecting one of %r' % chars, self.buffer, self.pos)
+        self.pos += 1
+        return char
+
+    def Decode(self):
+        self.Peek()
+        while True:
+            try:
+                value, end = self.scan_once(self.buffer, self.pos)
+                # A number at the end of the buffer may go on in the next chunk
+                if self.NumberPart.match(self.buffer, end).end() < len(self.buffer) or self.eof:
+                    self.pos = end
+                    return value
+            except (StopIteration, ValueError):
+                # The value may go on in the next chunk
+                if self.eof:
+                    raise json.JSONDecodeError('Expecting value', self.buffer, self.pos) from None
+            self.Fill()
+
+    def Iter(self, path):
+        if not path:
+            yield self.Decode()
+        elif path[0] == '*':
+            if self.Peek() != '[':
+                raise TypeError('JSON value at %r is not an array' % (path,))
+            self.pos += 1
+            if self.Peek() == ']':
+                self.pos += 1
+                return
+            if len(path) == 1:
+                yield from self.IterArray()
+                return
+            while True:
+                yield from self.Iter(path[1:])
+                if self.Expect(',]') == ']':
+                    return
+        else:
+            if self.Peek() != '{':
+                raise TypeError('JSON value at %r is not an object' % (path,))
+            self.pos += 1
+            if self.Peek() == '}':
+                raise KeyError(path[0])
+            while True:
+                key = self.Decode()
+                self.Expect(':')
+                if key == path[0]:
+                    yield from self.Iter(path[1:])
+                    return
+                self.Decode()
+                if self.Expect(',}') == '}':
+                    raise KeyError(path[0])
+
+
+    # Yield the elements of the array being read, whose first element is next
+    def IterArray(self):
+        orjson = GetOrjson()
+        if orjson:
+            yield from self.IterArrayFast(orjson)
+            return
+        scan_once, skip_whitespace = self.scan_once, self.Whitespace.match
+        while True:
+            # Fast path, when both the element and the separator after it are
+            # in the buffer
+            buffer = self.buffer
+            try:
+                value, end = scan_once(buffer, skip_whitespace(buffer, self.pos).end())
+                end = skip_whitespace(buffer, end).end()
+            except (StopIteration, ValueError):
+                end = len(buffer)
+            if end < len(buffer) and buffer[end] in ',]':
+                self.pos = end+1
+                yield value
+                if buffer[end] == ']':
+                    return
+                continue
+            yield self.Decode()
+            if self.Expect(',]') == ']':
+                return
+
+    # Same as IterArray, decoding a chunk of elements at once with orjson
+    #
+    # The buffer is cut at a comma: it is a list of whole elements if and
+    # only if the result parses as an array, since a cut in a string or in a
+    # nested value leaves it unterminated. Whatever orjson rejects, such as
+    # NaN, and long runs of digits, which may be integers orjson would round,
+    # are left to the standard decoder one element at a time.
+    def IterArrayFast(self, orjson):
+        while True:
+            if len(self.buffer)-self.pos < self.ChunkSize and not self.eof:
+                self.Fill()
+            values = None
+            for doc, end in self.IterChunkCuts():
+                try:
+                    values = orjson.loads(doc)
+                    break
+                except orjson.JSONDecodeError as e:
+                    # The array may end before the cut, then orjson stops
+                    # right after it
+                    if 0 < e.pos <= len(doc) and doc[e.pos-1] == ']':
+                        try:
+                            values = orjson.loads(doc[:e.pos])
+                        except orjson.JSONDecodeError:
+                            continue
+                        self.pos += e.pos-1
+                        yield from values
+                        return
+            if values is not None:
+                self.pos = end
+                yield from values
+                continue
+            yield self.Decode()
+            if self.Expect(',]') == ']':
+                return
+
+    # Result: ('[' + the buffer up to a comma + ']', position after the comma),
+    #         trying first the commas most likely between elements
+    def IterChunkCuts(self):
+        buffer, pos = self.buffer, self.pos
+        limit = pos+self.ChunkSize
+        long_number = self.LongNumber.search(buffer, pos, limit)
+        if long_number:
+            limit = long_number.start()
+        tried = set()
+        for separator in ('},', '],', ','):
+            cut = buffer.rfind(separator, pos, limit)
+            if cut < 0:
+                continue
+            cut += len(separator)-1
+            if cut > pos and cut not in tried:
+                tried.add(cut)
+                yield '['+buffer[pos:cut]+']', cut+1
+
+
+# Result: the orjson module, or None if it is not installed
+@functools.lru_cache(maxsize=None)
+def GetOrjson():
+    try:
+        import orjson
+    except ImportError:
+        return None
+    return orjson
+
+
+# Decodes a small JSON document, such as the properties of a comment, with
+# orjson if available
+def DecodeJSON(s):
+    orjson = GetOrjson()
+    if orjson and not JSONStreamReader.LongNumber.search(s):
+        try:
+            return orjson.loads(s)
+        except orjson.JSONDecodeError:
+            pass  # Such as NaN, which orjson rejects
+    return json.loads(s)
+
+
+# The properties of comments repeat a lot, so keep them decoded
+# Callers must not modify the result
+@functools.lru_cache(maxsize=1024)
+def DecodeJSONCached(s):
+    return DecodeJSON(s)
+
+
 CommentFormatMap = {None: None, 'Niconico': ReadCommentsNiconico, 'Acfun': ReadCommentsAcfun, 'Bilibili': ReadCommentsBilibili, 'Tudou': ReadCommentsTudou, 'Tudou2': ReadCommentsTudou2, 'MioMio': ReadCommentsMioMio, 'sH5V': ReadCommentsSH5V}
 
 
-def WriteCommentBilibiliPositioned(f, c, width, height, styleid):
+#
+# PositionedCommentRenderer
+#
+# Writes the positioned comments of Bilibili (bilipos), Acfun (acfunpos) and
+# sH5V (sH5Vpos) for one stage size. The zoom factors from each player size and
+# the other per-stage values are computed once, when the renderer is created,
+# instead of for every comment; get the renderer with GetPositionedRenderer.
+#
+
+class PositionedCommentRenderer(object):
     #BiliPlayerSize = (512, 384)  # Bilibili player version 2010
     #BiliPlayerSize = (540, 384)  # Bilibili player version 2012
     BiliPlayerSize = (672, 438)  # Bilibili player version 2014
-    ZoomFactor = GetZoomFactor(BiliPlayerSize, (width, height))
+    AcfunPlayerSize = (560, 400)
+
+    def __init__(self, width, height):
+        self.width = width
+        self.height = height
+        self.origin_style = '\\org(%d, %d)' % (width/2, height/2)
+        self.bili_zoom = GetZoomFactor(self.BiliPlayerSize, (width, height))
+        # Player size times zoom, for positions given as a ratio of the player
+        self.bili_scale = (self.BiliPlayerSize[0]*self.bili_zoom[0], self.BiliPlayerSize[1]*self.bili_zoom[0])
+        self.acfun_zoom = GetZoomFactor(self.AcfunPlayerSize, (width, height))
+        self.acfun_scale = (self.AcfunPlayerSize[0]*self.acfun_zoom[0], self.AcfunPlayerSize[1]*self.acfun_zoom[0])
+        self.sh5v_font_scale = math.sqrt(width*height/307200)
+        self.writers = {'bilipos': self.WriteBilibili, 'acfunpos': self.WriteAcfun, 'sH5Vpos': self.WriteSH5V}
+
+    # Result: False if c is not a positioned comment
+    def Write(self, f, c, styleid):
+        writer = self.writers.get(c[4])
+        if writer is None:
+            return False
+        writer(f, c, styleid)
+        return True
+
+    def FlushCommentLine(self, f, text, styles, start_time, end_time, styleid):
+        if end_time > start_time:
+            f.write('Dialogue: -1,%s,%s,%s,,0,0,0,,{%s}%s\n' % (ConvertTimestamp(start_time), ConvertTimestamp(end_time), styleid, ''.join(styles), text))
 
-    def GetPosition(InputPos, isHeight):
+    def GetBilibiliPosition(self, InputPos, isHeight):
         isHeight = int(isHeight)  # True -> 1
         if isinstance(InputPos, int):
-            return ZoomFactor[0]*InputPos+ZoomFactor[isHeight+1]
+            return self.bili_zoom[0]*InputPos+self.bili_zoom[isHeight+1]
         elif isinstance(InputPos, float):
             if InputPos > 1:
-                return ZoomFactor[0]*InputPos+ZoomFactor[isHeight+1]
+                return self.bili_zoom[0]*InputPos+self.bili_zoom[isHeight+1]
             else:
-                return BiliPlayerSize[isHeight]*ZoomFactor[0]*InputPos+ZoomFactor[isHeight+1]
+                return self.bili_scale[isHeight]*InputPos+self.bili_zoom[isHeight+1]
         else:
             try:
                 InputPos = int(InputPos)
             except ValueError:
                 InputPos = float(InputPos)
-            return GetPosition(InputPos, isHeight)
+            return self.GetBilibiliPosition(InputPos, isHeight)
 
-    try:
-        comment_args = safe_list(json.loads(c[3]))
-        text = ASSEscape(str(comment_args[4]).replace('/n', '\n'))
-        from_x = comment_args.get(0, 0)
-        from_y = comment_args.get(1, 0)
-        to_x = comment_args.get(7, from_x)
-        to_y = comment_args.get(8, from_y)
-        from_x = GetPosition(from_x, False)
-        from_y = GetPosition(from_y, True)
-        to_x = GetPosition(to_x, False)
-        to_y = GetPosition(to_y, True)
-        alpha = safe_list(str(comment_args.get(2, '1')).split('-'))
-        from_alpha = float(alpha.get(0, 1))
-        to_alpha = float(alpha.get(1, from_alpha))
-        from_alpha = 255-round(from_alpha*255)
-        to_alpha = 255-round(to_alpha*255)
-        rotate_z = int(comment_args.get(5, 0))
-        rotate_y = int(comment_args.get(6, 0))
-        lifetime = float(comment_args.get(3, 4500))
-        duration = int(comment_args.get(9, lifetime*1000))
-        delay = int(comment_args.get(10, 0))
-        fontface = comment_args.get(12)
-        isborder = comment_args.get(11, 'true')
-        from_rotarg = ConvertFlashRotation(rotate_y, rotate_z, from_x, from_y, width, height)
-        to_rotarg = ConvertFlashRotation(rotate_y, rotate_z, to_x, to_y, width, height)
-        styles = ['\\org(%d, %d)' % (width/2, height/2)]
-        if from_rotarg[0:2] == to_rotarg[0:2]:
-            styles.append('\\pos(%.0f, %.0f)' % (from_rotarg[0:2]))
-        else:
-            styles.append('\\move(%.0f, %.0f, %.0f, %.0f, %.0f, %.0f)' % (from_rotarg[0:2]+to_rotarg[0:2]+(delay, delay+duration)))
-        styles.append('\\frx%.0f\\fry%.0f\\frz%.0f\\fscx%.0f\\fscy%.0f' % (from_rotarg[2:7]))
-        if (from_x, from_y) != (to_x, to_y):
-            styles.append('\\t(%d, %d, ' % (delay, delay+duration))
-            styles.append('\\frx%.0f\\fry%.0f\\frz%.0f\\fscx%.0f\\fscy%.0f' % (to_rotarg[2:7]))
-            styles.append(')')
-        if fontface:
-            styles.append('\\fn%s' % ASSEscape(fontface))
-        styles.append('\\fs%.0f' % (c[6]*ZoomFactor[0]))
-        if c[5] != 0xffffff:
-            styles.append('\\c&H%s&' % ConvertColor(c[5]))
-            if c[5] == 0x000000:
-                styles.append('\\3c&HFFFFFF&')
-        if from_alpha == to_alpha:
-            styles.append('\\alpha&H%02X' % from_alpha)
-        elif (from_alpha, to_alpha) == (255, 0):
-            styles.append('\\fad(%.0f,0)' % (lifetime*1000))
-        elif (from_alpha, to_alpha) == (0, 255):
-            styles.append('\\fad(0, %.0f)' % (lifetime*1000))
-        else:
-            styles.append('\\fade(%(from_alpha)d, %(to_alpha)d, %(to_alpha)d, 0, %(end_time).0f, %(end_time).0f, %(end_time).0f)' % {'from_alpha': from_alpha, 'to_alpha': to_alpha, 'end_time': lifetime*1000})
-        if isborder == 'false':
-            styles.append('\\bord0')
-        f.write('Dialogue: -1,%(start)s,%(end)s,%(styleid)s,,0,0,0,,{%(styles)s}%(text)s\n' % {'start': ConvertTimestamp(c[0]), 'end': ConvertTimestamp(c[0]+lifetime), 'styles': ''.join(styles), 'text': text, 'styleid': styleid})
-    except (IndexError, ValueError) as e:
+    def WriteBilibili(self, f, c, styleid):
+        width, height = self.width, self.height
         try:
-            logging.warning(_('Invalid comment: %r') % c[3])
-        except IndexError:
-            logging.warning(_('Invalid comment: %r') % c)
-
-
-def WriteCommentAcfunPositioned(f, c, width, height, styleid):
-    AcfunPlayerSize = (560, 400)
-    ZoomFactor = GetZoomFactor(AcfunPlayerSize, (width, height))
+            comment_args = safe_list(json.loads(c[3]))
+            text = ASSEscape(str(comment_args[4]).replace('/n', '\n'))
+            from_x = comment_args.get(0, 0)
+            from_y = comment_args.get(1, 0)
+            to_x = comment_args.get(7, from_x)
+            to_y = comment_args.get(8, from_y)
+            from_x = self.GetBilibiliPosition(from_x, False)
+            from_y = self.GetBilibiliPosition(from_y, True)
+            to_x = self.GetBilibiliPosition(to_x, False)
+            to_y = self.GetBilibiliPosition(to_y, True)
+            alpha = safe_list(str(comment_args.get(2, '1')).split('-'))
+            from_alpha = float(alpha.get(0, 1))
+            to_alpha = float(alpha.get(1, from_alpha))
+            from_alpha = 255-round(from_alpha*255)
+            to_alpha = 255-round(to_alpha*255)
+            rotate_z = int(comment_args.get(5, 0))
+            rotate_y = int(comment_args.get(6, 0))
+            lifetime = float(comment_args.get(3, 4500))
+            duration = int(comment_args.get(9, lifetime*1000))
+            delay = int(comment_args.get(10, 0))
+            fontface = comment_args.get(12)
+            isborder = comment_args.get(11, 'true')
+            from_rotarg = ConvertFlashRotation(rotate_y, rotate_z, from_x, from_y, width, height)
+            to_rotarg = ConvertFlashRotation(rotate_y, rotate_z, to_x, to_y, width, height)
+            styles = [self.origin_style]
+            if from_rotarg[0:2] == to_rotarg[0:2]:
+                styles.append('\\pos(%.0f, %.0f)' % (from_rotarg[0:2]))
+            else:
+                styles.append('\\move(%.0f, %.0f, %.0f, %.0f, %.0f, %.0f)' % (from_rotarg[0:2]+to_rotarg[0:2]+(delay, delay+duration)))
+            styles.append('\\frx%.0f\\fry%.0f\\frz%.0f\\fscx%.0f\\fscy%.0f' % (from_rotarg[2:7]))
+            if (from_x, from_y) != (to_x, to_y):
+                styles.append('\\t(%d, %d, ' % (delay, delay+duration))
+                styles.append('\\frx%.0f\\fry%.0f\\frz%.0f\\fscx%.0f\\fscy%.0f' % (to_rotarg[2:7]))
+                styles.append(')')
+            if fontface:
+                styles.append('\\fn%s' % ASSEscape(fontface))
+            styles.append('\\fs%.0f' % (c[6]*self.bili_zoom[0]))
+            if c[5] != 0xffffff:
+                styles.append('\\c&H%s&' % ConvertColor(c[5]))
+                if c[5] == 0x000000:
+                    styles.append('\\3c&HFFFFFF&')
+            if from_alpha == to_alpha:
+                styles.append('\\alpha&H%02X' % from_alpha)
+            elif (from_alpha, to_alpha) == (255, 0):
+                styles.append('\\fad(%.0f,0)' % (lifetime*1000))
+            elif (from_alpha, to_alpha) == (0, 255):
+                styles.append('\\fad(0, %.0f)' % (lifetime*1000))
+            else:
+                styles.append('\\fade(%(from_alpha)d, %(to_alpha)d, %(to_alpha)d, 0, %(end_time).0f, %(end_time).0f, %(end_time).0f)' % {'from_alpha': from_alpha, 'to_alpha': to_alpha, 'end_time': lifetime*1000})
+            if isborder == 'false':
+                styles.append('\\bord0')
+            f.write('Dialogue: -1,%s,%s,%s,,0,0,0,,{%s}%s\n' % (ConvertTimestamp(c[0]), ConvertTimestamp(c[0]+lifetime), styleid, ''.join(styles), text))
+        except (IndexError, ValueError) as e:
+            try:
+                logging.warning(_('Invalid comment: %r') % c[3])
+            except IndexError:
+                logging.warning(_('Invalid comment: %r') % c)
 
-    def GetPosition(InputPos, isHeight):
+    def GetAcfunPosition(self, InputPos, isHeight):
         isHeight = int(isHeight)  # True -> 1
-        return AcfunPlayerSize[isHeight]*ZoomFactor[0]*InputPos*0.001+ZoomFactor[isHeight+1]
+        return self.acfun_scale[isHeight]*InputPos*0.001+self.acfun_zoom[isHeight+1]
 
-    def GetTransformStyles(x=None, y=None, scale_x=None, scale_y=None, rotate_z=None, rotate_y=None, color=None, alpha=None):
+    def GetAcfunTransformStyles(self, x=None, y=None, scale_x=None, scale_y=None, rotate_z=None, rotate_y=None, color=None, alpha=None):
         styles = []
         out_x, out_y = x, y
         if rotate_z is not None and rotate_y is not None:
             assert x is not None
             assert y is not None
-            rotarg = ConvertFlashRotation(rotate_y, rotate_z, x, y, width, height)
+            rotarg = ConvertFlashRotation(rotate_y, rotate_z, x, y, self.width, self.height)
             out_x, out_y = rotarg[0:2]
             if scale_x is None:
                 scale_x = 1
@@ -390,88 +667,83 @@ def WriteCommentAcfunPositioned(f, c, width, height, styleid):
             styles.append('\\alpha&H%02X' % alpha)
         return out_x, out_y, styles
 
-    def FlushCommentLine(f, text, styles, start_time, end_time, styleid):
-        if end_time > start_time:
-            f.write('Dialogue: -1,%(start)s,%(end)s,%(styleid)s,,0,0,0,,{%(styles)s}%(text)s\n' % {'start': ConvertTimestamp(start_time), 'end': ConvertTimestamp(end_time), 'styles': ''.join(styles), 'text': text, 'styleid': styleid})
-
-    try:
-        comment_args = c[3]
-        text = ASSEscape(str(comment_args['n']).replace('\r', '\n'))
-        common_styles = ['\org(%d, %d)' % (width/2, height/2)]
-        anchor = {0: 7, 1: 8, 2: 9, 3: 4, 4: 5, 5: 6, 6: 1, 7: 2, 8: 3}.get(comment_args.get('c', 0), 7)
-        if anchor != 7:
-            common_styles.append('\\an%s' % anchor)
-        font = comment_args.get('w')
-        if font:
-            font = dict(font)
-            fontface = font.get('f')
-            if fontface:
-                common_styles.append('\\fn%s' % ASSEscape(str(fontface)))
-            fontbold = bool(font.get('b'))
-            if fontbold:
-                common_styles.append('\\b1')
-        common_styles.append('\\fs%.0f' % (c[6]*ZoomFactor[0]))
-        isborder = bool(comment_args.get('b', True))
-        if not isborder:
-            common_styles.append('\\bord0')
-        to_pos = dict(comment_args.get('p', {'x': 0, 'y': 0}))
-        to_x = round(GetPosition(int(to_pos.get('x', 0)), False))
-        to_y = round(GetPosition(int(to_pos.get('y', 0)), True))
-        to_scale_x = float(comment_args.get('e', 1.0))
-        to_scale_y = float(comment_args.get('f', 1.0))
-        to_rotate_z = float(comment_args.get('r', 0.0))
-        to_rotate_y = float(comment_args.get('k', 0.0))
-        to_color = c[5]
-        to_alpha = float(comment_args.get('a', 1.0))
-        from_time = float(comment_args.get('t', 0.0))
-        action_time = float(comment_args.get('l', 3.0))
-        actions = list(comment_args.get('z', []))
-        to_out_x, to_out_y, transform_styles = GetTransformStyles(to_x, to_y, to_scale_x, to_scale_y, to_rotate_z, to_rotate_y, to_color, to_alpha)
-        FlushCommentLine(f, text, common_styles+['\\pos(%.0f, %.0f)' % (to_out_x, to_out_y)]+transform_styles, c[0]+from_time, c[0]+from_time+action_time, styleid)
-        action_styles = transform_styles
-        for action in actions:
-            action = dict(action)
-            from_x, from_y = to_x, to_y
-            from_out_x, from_out_y = to_out_x, to_out_y
-            from_scale_x, from_scale_y = to_scale_x, to_scale_y
-            from_rotate_z, from_rotate_y = to_rotate_z, to_rotate_y
-            from_color, from_alpha = to_color, to_alpha
-            transform_styles, action_styles = action_styles, []
-            from_time += action_time
-            action_time = float(action.get('l', 0.0))
-            if 'x' in action:
-                to_x = round(GetPosition(int(action['x']), False))
-            if 'y' in action:
-                to_y = round(GetPosition(int(action['y']), True))
-            if 'f' in action:
-                to_scale_x = float(action['f'])
-            if 'g' in action:
-                to_scale_y = float(action['g'])
-            if 'c' in action:
-                to_color = int(action['c'])
-            if 't' in action:
-                to_alpha = float(action['t'])
-            if 'd' in action:
-                to_rotate_z = float(action['d'])
-            if 'e' in action:
-                to_rotate_y = float(action['e'])
-            to_out_x, to_out_y, action_styles = GetTransformStyles(to_x, to_y, from_scale_x, from_scale_y, to_rotate_z, to_rotate_y, from_color, from_alpha)
-            if (from_out_x, from_out_y) == (to_out_x, to_out_y):
-                pos_style = '\\pos(%.0f, %.0f)' % (to_out_x, to_out_y)
-            else:
-                pos_style = '\\move(%.0f, %.0f, %.0f, %.0f)' % (from_out_x, from_out_y, to_out_x, to_out_y)
-            styles = common_styles+transform_styles
-            styles.append(pos_style)
-            if action_styles:
-                styles.append('\\t(%s)' % (''.join(action_styles)))
-            FlushCommentLine(f, text, styles, c[0]+from_time, c[0]+from_time+action_time, styleid)
-    except (IndexError, ValueError) as e:
-        logging.warning(_('Invalid comment: %r') % c[3])
-
-
-def WriteCommentSH5VPositioned(f, c, width, height, styleid):
+    def WriteAcfun(self, f, c, styleid):
+        GetPosition, GetTransformStyles = self.GetAcfunPosition, self.GetAcfunTransformStyles
+        try:
+            comment_args = c[3]
+            text = ASSEscape(str(comment_args['n']).replace('\r', '\n'))
+            common_styles = [self.origin_style]
+            anchor = {0: 7, 1: 8, 2: 9, 3: 4, 4: 5, 5: 6, 6: 1, 7: 2, 8: 3}.get(comment_args.get('c', 0), 7)
+            if anchor != 7:
+                common_styles.append('\\an%s' % anchor)
+            font = comment_args.get('w')
+            if font:
+                font = dict(font)
+                fontface = font.get('f')
+                if fontface:
+                    common_styles.append('\\fn%s' % ASSEscape(str(fontface)))
+                fontbold = bool(font.get('b'))
+                if fontbold:
+                    common_styles.append('\\b1')
+            common_styles.append('\\fs%.0f' % (c[6]*self.acfun_zoom[0]))
+            isborder = bool(comment_args.get('b', True))
+            if not isborder:
+                common_styles.append('\\bord0')
+            to_pos = dict(comment_args.get('p', {'x': 0, 'y': 0}))
+            to_x = round(GetPosition(int(to_pos.get('x', 0)), False))
+            to_y = round(GetPosition(int(to_pos.get('y', 0)), True))
+            to_scale_x = float(comment_args.get('e', 1.0))
+            to_scale_y = float(comment_args.get('f', 1.0))
+            to_rotate_z = float(comment_args.get('r', 0.0))
+            to_rotate_y = float(comment_args.get('k', 0.0))
+            to_color = c[5]
+            to_alpha = float(comment_args.get('a', 1.0))
+            from_time = float(comment_args.get('t', 0.0))
+            action_time = float(comment_args.get('l', 3.0))
+            actions = list(comment_args.get('z', []))
+            to_out_x, to_out_y, transform_styles = GetTransformStyles(to_x, to_y, to_scale_x, to_scale_y, to_rotate_z, to_rotate_y, to_color, to_alpha)
+            self.FlushCommentLine(f, text, common_styles+['\\pos(%.0f, %.0f)' % (to_out_x, to_out_y)]+transform_styles, c[0]+from_time, c[0]+from_time+action_time, styleid)
+            action_styles = transform_styles
+            for action in actions:
+                action = dict(action)
+                from_x, from_y = to_x, to_y
+                from_out_x, from_out_y = to_out_x, to_out_y
+                from_scale_x, from_scale_y = to_scale_x, to_scale_y
+                from_rotate_z, from_rotate_y = to_rotate_z, to_rotate_y
+                from_color, from_alpha = to_color, to_alpha
+                transform_styles, action_styles = action_styles, []
+                from_time += action_time
+                action_time = float(action.get('l', 0.0))
+                if 'x' in action:
+                    to_x = round(GetPosition(int(action['x']), False))
+                if 'y' in action:
+                    to_y = round(GetPosition(int(action['y']), True))
+                if 'f' in action:
+                    to_scale_x = float(action['f'])
+                if 'g' in action:
+                    to_scale_y = float(action['g'])
+                if 'c' in action:
+                    to_color = int(action['c'])
+                if 't' in action:
+                    to_alpha = float(action['t'])
+                if 'd' in action:
+                    to_rotate_z = float(action['d'])
+                if 'e' in action:
+                    to_rotate_y = float(action['e'])
+                to_out_x, to_out_y, action_styles = GetTransformStyles(to_x, to_y, from_scale_x, from_scale_y, to_rotate_z, to_rotate_y, from_color, from_alpha)
+                if (from_out_x, from_out_y) == (to_out_x, to_out_y):
+                    pos_style = '\\pos(%.0f, %.0f)' % (to_out_x, to_out_y)
+                else:
+                    pos_style = '\\move(%.0f, %.0f, %.0f, %.0f)' % (from_out_x, from_out_y, to_out_x, to_out_y)
+                styles = common_styles+transform_styles
+                styles.append(pos_style)
+                if action_styles:
+                    styles.append('\\t(%s)' % (''.join(action_styles)))
+                self.FlushCommentLine(f, text, styles, c[0]+from_time, c[0]+from_time+action_time, styleid)
+        except (IndexError, ValueError) as e:
+            logging.warning(_('Invalid comment: %r') % c[3])
 
-    def GetTransformStyles(x=None, y=None, fsize=None, rotate_z=None, rotate_y=None, color=None, alpha=None):
+    def GetSH5VTransformStyles(self, x=None, y=None, fsize=None, rotate_z=None, rotate_y=None, color=None, alpha=None):
         styles = []
         if x is not None and y is not None:
             styles.append('\\pos(%.0f, %.0f)' % (x, y))
@@ -489,66 +761,76 @@ def WriteCommentSH5VPositioned(f, c, width, height, styleid):
             styles.append('\\alpha&H%02X' % alpha)
         return styles
 
-    def FlushCommentLine(f, text, styles, start_time, end_time, styleid):
-        if end_time > start_time:
-            f.write('Dialogue: -1,%(start)s,%(end)s,%(styleid)s,,0,0,0,,{%(styles)s}%(text)s\n' % {'start': ConvertTimestamp(start_time), 'end': ConvertTimestamp(end_time), 'styles': ''.join(styles), 'text': text, 'styleid': styleid})
+    def WriteSH5V(self, f, c, styleid):
+        try:
+            text = ASSEscape(str(c[3]))
+            to_x = float(c[9])*self.width
+            to_y = float(c[10])*self.height
+            to_rotate_z = -int(c[14])
+            to_rotate_y = -int(c[15])
+            to_color = c[5]
+            to_alpha = float(c[12])
+            # Note: Alpha transition hasn't been worked out yet.
+            to_size = int(c[6])*self.sh5v_font_scale
+            # Note: Because sH5V's data is the absolute size of font,temporarily solve by it at present.[*math.sqrt(width/640*height/480)]
+            # But it seems to be working fine...
+            from_time = float(c[0])
+            action_time = float(c[11])/1000
+            transform_styles = self.GetSH5VTransformStyles(to_x, to_y, to_size, to_rotate_z, to_rotate_y, to_color, to_alpha)
+            self.FlushCommentLine(f, text, transform_styles, from_time, from_time+action_time, styleid)
+        except (IndexError, ValueError) as e:
+            logging.warning(_('Invalid comment: %r') % c[3])
 
+
+@functools.lru_cache(maxsize=16)
+def GetPositionedRenderer(width, height):
+    return PositionedCommentRenderer(width, height)
+
+
+# Result: the text a positioned comment shows, as its writer above takes it
+#         from c[3], or None if it cannot be found
+def GetPositionedText(comment, pos):
     try:
-        text = ASSEscape(str(c[3]))
-        to_x = float(c[9])*width
-        to_y = float(c[10])*height
-        to_rotate_z = -int(c[14])
-        to_rotate_y = -int(c[15])
-        to_color = c[5]
-        to_alpha = float(c[12])
-        # Note: Alpha transition hasn't been worked out yet.
-        to_size = int(c[6])*math.sqrt(width*height/307200)
-        # Note: Because sH5V's data is the absolute size of font,temporarily solve by it at present.[*math.sqrt(width/640*height/480)]
-        # But it seems to be working fine...
-        from_time = float(c[0])
-        action_time = float(c[11])/1000
-        transform_styles = GetTransformStyles(to_x, to_y, to_size, to_rotate_z, to_rotate_y, to_color, to_alpha)
-        FlushCommentLine(f, text, transform_styles, from_time, from_time+action_time, styleid)
-    except (IndexError, ValueError) as e:
-        logging.warning(_('Invalid comment: %r') % c[3])
+        if pos == 'bilipos':
+            return str(json.loads(comment)[4]).replace('/n', '\n')
+        elif pos == 'acfunpos':
+            return str(comment['n']).replace('\r', '\n')
+        elif pos == 'sH5Vpos':
+            return str(comment)
+    except (IndexError, KeyError, TypeError, ValueError):
+        pass
+    return None
 
 
 # Result: (f, dx, dy)
 # To convert: NewX = f*x+dx, NewY = f*y+dy
+@functools.lru_cache(maxsize=64)
 def GetZoomFactor(SourceSize, TargetSize):
-    try:
-        if (SourceSize, TargetSize) == GetZoomFactor.Cached_Size:
-            return GetZoomFactor.Cached_Result
-    except AttributeError:
-        pass
-    GetZoomFactor.Cached_Size = (SourceSize, TargetSize)
     try:
         SourceAspect = SourceSize[0]/SourceSize[1]
         TargetAspect = TargetSize[0]/TargetSize[1]
         if TargetAspect < SourceAspect:  # narrower
             ScaleFactor = TargetSize[0]/SourceSize[0]
-            GetZoomFactor.Cached_Result = (ScaleFactor, 0, (TargetSize[1]-TargetSize[0]/SourceAspect)/2)
+            return (ScaleFactor, 0, (TargetSize[1]-TargetSize[0]/SourceAspect)/2)
         elif TargetAspect > SourceAspect:  # wider
             ScaleFactor = TargetSize[1]/SourceSize[1]
-            GetZoomFactor.Cached_Result = (ScaleFactor, (TargetSize[0]-TargetSize[1]*SourceAspect)/2, 0)
+            return (ScaleFactor, (TargetSize[0]-TargetSize[1]*SourceAspect)/2, 0)
         else:
-            GetZoomFactor.Cached_Result = (TargetSize[0]/SourceSize[0], 0, 0)
-        return GetZoomFactor.Cached_Result
+            return (TargetSize[0]/SourceSize[0], 0, 0)
     except ZeroDivisionError:
-        GetZoomFactor.Cached_Result = (1, 0, 0)
-        return GetZoomFactor.Cached_Result
+        return (1, 0, 0)
 
 
-# Calculation is based on https://github.com/jabbany/CommentCoreLibrary/issues/5#issuecomment-40087282
-#                     and https://github.com/m13253/danmaku2ass/issues/7#issuecomment-41489422
-# ASS FOV = width*4/3.0
-# But Flash FOV = width/math.tan(100*math.pi/360.0)/2 will be used instead
-# Result: (transX, transY, rotX, rotY, rotZ, scaleX, scaleY)
-def ConvertFlashRotation(rotY, rotZ, X, Y, width, height):
-    def WrapAngle(deg):
-        return 180-((180-deg) % 360)
-    rotY = WrapAngle(rotY)
-    rotZ = WrapAngle(rotZ)
+def WrapFlashAngle(deg):
+    return 180-((180-deg) % 360)
+
+
+# The part of ConvertFlashRotation that depends on the angles only, as the same few rotations are used over and over
+# Result: (rotY, rotZ, outX, outY, outZ, cos(rotY), sin(rotY), cos(rotZ), sin(rotZ)), with rotY and rotZ in radians
+@functools.lru_cache(maxsize=4096, typed=True)
+def FlashRotationMatrix(rotY, rotZ):
+    rotY = WrapFlashAngle(rotY)
+    rotZ = WrapFlashAngle(rotZ)
     if rotY in (90, -90):
         rotY -= 1
     if rotY == 0 or rotZ == 0:
@@ -563,9 +845,19 @@ def ConvertFlashRotation(rotY, rotZ, X, Y, width, height):
         outY = math.atan2(-math.sin(rotY)*math.cos(rotZ), math.cos(rotY))*180/math.pi
         outZ = math.atan2(-math.cos(rotY)*math.sin(rotZ), math.cos(rotZ))*180/math.pi
         outX = math.asin(math.sin(rotY)*math.sin(rotZ))*180/math.pi
-    trX = (X*math.cos(rotZ)+Y*math.sin(rotZ))/math.cos(rotY)+(1-math.cos(rotZ)/math.cos(rotY))*width/2-math.sin(rotZ)/math.cos(rotY)*height/2
-    trY = Y*math.cos(rotZ)-X*math.sin(rotZ)+math.sin(rotZ)*width/2+(1-math.cos(rotZ))*height/2
-    trZ = (trX-width/2)*math.sin(rotY)
+    return (rotY, rotZ, outX, outY, outZ, math.cos(rotY), math.sin(rotY), math.cos(rotZ), math.sin(rotZ))
+
+
+# Calculation is based on https://github.com/jabbany/CommentCoreLibrary/issues/5#issuecomment-40087282
+#                     and https://github.com/m13253/danmaku2ass/issues/7#issuecomment-41489422
+# ASS FOV = width*4/3.0
+# But Flash FOV = width/math.tan(100*math.pi/360.0)/2 will be used instead
+# Result: (transX, transY, rotX, rotY, rotZ, scaleX, scaleY)
+def ConvertFlashRotation(rotY, rotZ, X, Y, width, height):
+    rotY, rotZ, outX, outY, outZ, cosY, sinY, cosZ, sinZ = FlashRotationMatrix(rotY, rotZ)
+    trX = (X*cosZ+Y*sinZ)/cosY+(1-cosZ/cosY)*width/2-sinZ/cosY*height/2
+    trY = Y*cosZ-X*sinZ+sinZ*width/2+(1-cosZ)*height/2
+    trZ = (trX-width/2)*sinY
     FOV = width*math.tan(2*math.pi/9.0)/2
     try:
         scaleXY = FOV/(FOV+trZ)
@@ -579,44 +871,63 @@ def ConvertFlashRotation(rotY, rotZ, X, Y, width, height):
         outX += 180
         outY += 180
         logging.error('Rotation makes object behind the camera: trZ == %.0f < %.0f' % (trZ, FOV))
-    return (trX, trY, WrapAngle(outX), WrapAngle(outY), WrapAngle(outZ), scaleXY*100, scaleXY*100)
+    return (trX, trY, WrapFlashAngle(outX), WrapFlashAngle(outY), WrapFlashAngle(outZ), scaleXY*100, scaleXY*100)
 
 
-def ProcessComments(comments, f, width, height, bottomReserved, fontface, fontsize, alpha, duration_marquee, duration_still, reduced, progress_callback):
+def ProcessComments(comments, f, width, height, bottomReserved, fontface, fontsize, alpha, duration_marquee, duration_still, reduced, progress_callback, layout_engine='interval', stream_window=None, window_callback=None, jobs=1, exact_layout=True, stats=None):
     styleid = 'Danmaku2ASS_%04x' % random.randint(0, 0xffff)
     WriteASSHead(f, width, height, fontface, fontsize, alpha, styleid)
-    rows = [[None]*(height-bottomReserved+1) for i in range(4)]
+    rows = GetLayoutEngine(layout_engine)(width, height, bottomReserved, duration_marquee, duration_still)
+    if jobs > 1 and not stream_window and len(comments) >= ShardMinComments*2:
+        ProcessCommentsSharded(comments, f, rows, width, height, bottomReserved, fontsize, duration_marquee, duration_still, reduced, styleid, progress_callback, jobs, exact_layout)
+        return
+    if stats:
+        rows = InstrumentedRowEngine(rows, stats, reduced)
+    window_end = None
     for idx, i in enumerate(comments):
         if progress_callback and idx % 1000 == 0:
             progress_callback(idx, len(comments))
-        if isinstance(i[4], int):
-            row = 0
-            rowmax = height-bottomReserved-i[7]
-            while row <= rowmax:
-                freerows = TestFreeRows(rows, i, row, width, height, bottomReserved, duration_marquee, duration_still)
-                if freerows >= i[7]:
-                    MarkCommentRow(rows, i, row)
-                    WriteComment(f, i, row, width, height, bottomReserved, fontsize, duration_marquee, duration_still, styleid)
-                    break
-                else:
-                    row += freerows or 1
-            else:
-                if not reduced:
-                    row = FindAlternativeRow(rows, i, height, bottomReserved)
-                    MarkCommentRow(rows, i, row)
-                    WriteComment(f, i, row, width, height, bottomReserved, fontsize, duration_marquee, duration_still, styleid)
-        elif i[4] == 'bilipos':
-            WriteCommentBilibiliPositioned(f, i, width, height, styleid)
-        elif i[4] == 'acfunpos':
-            WriteCommentAcfunPositioned(f, i, width, height, styleid)
-        elif i[4] == 'sH5Vpos':
-            WriteCommentSH5VPositioned(f, i, width, height, styleid)
-        else:
-            logging.warning(_('Invalid comment: %r') % i[3])
+        if stream_window:
+            # Comments are sorted, so every window is complete once a later comment shows up
+            if window_end is not None and i[0] >= window_end:
+                FlushWindow(f, window_end, window_callback)
+            if window_end is None or i[0] >= window_end:
+                window_end = (max(i[0], 0)//stream_window+1)*stream_window
+        PlaceComment(f, i, rows, width, height, bottomReserved, fontsize, duration_marquee, duration_still, reduced, styleid)
+    if stream_window:
+        FlushWindow(f, None, window_callback)
+    if stats:
+        rows.Close()
     if progress_callback:
         progress_callback(len(comments), len(comments))
 
 
+def PlaceComment(f, c, rows, width, height, bottomReserved, fontsize, duration_marquee, duration_still, reduced, styleid):
+    if isinstance(c[4], int):
+        row = LayoutComment(c, rows, reduced)
+        if row is not None:
+            WriteComment(f, c, row, width, height, bottomReserved, fontsize, duration_marquee, duration_still, styleid)
+    elif not GetPositionedRenderer(width, height).Write(f, c, styleid):
+        logging.warning(_('Invalid comment: %r') % c[3])
+
+
+# Result: the row taken by comment c, or None if it is dropped
+def LayoutComment(c, rows, reduced):
+    row = rows.FindFreeRow(c)
+    if row is None and not reduced:
+        row = rows.FindAlternativeRow(c)
+    if row is not None:
+        rows.MarkCommentRow(c, row)
+    return row
+
+
+# window_end is None once all the comments have been written
+def FlushWindow(f, window_end, window_callback):
+    f.flush()
+    if window_callback:
+        window_callback(window_end)
+
+
 def TestFreeRows(rows, c, row, width, height, bottomReserved, duration_marquee, duration_still):
     res = 0
     rowmax = height-bottomReserved
@@ -665,6 +976,509 @@ def MarkCommentRow(rows, c, row):
         pass
 
 
+#
+# Layout engine protocol
+#
+# A layout engine remembers which comment was last placed on every pixel row
+# of the stage, separately for each of the four comment types.
+#
+# Constructor:
+#     Engine(width, height, bottomReserved, duration_marquee, duration_still)
+#
+# Methods:
+#     FindFreeRow(c):         The topmost row where comment c fits without
+#                             colliding, or None if the stage is full
+#     FindAlternativeRow(c):  The row to overlap when the stage is full
+#     MarkCommentRow(c, row): Record that comment c occupies the rows
+#                             starting from row
+#     GetSpans(pos):          The rows of comment type pos as a list of
+#                             (start, end, comment) covering the whole stage
+#                             with end exclusive, comment being None if free
+#     SetSpan(pos, start, end, c):
+#                             Record that comment c occupies rows [start, end)
+#
+# Every engine must place comments exactly like PixelRowEngine does.
+# After implementing a new engine, make sure to update LayoutEngineMap.
+#
+
+
+class PixelRowEngine(object):
+    # The reference engine, storing one reference per pixel row
+    def __init__(self, width, height, bottomReserved, duration_marquee, duration_still):
+        self.width = width
+        self.height = height
+        self.bottomReserved = bottomReserved
+        self.duration_marquee = duration_marquee
+        self.duration_still = duration_still
+        self.rows = [[None]*(height-bottomReserved+1) for i in range(4)]
+
+    def FindFreeRow(self, c):
+        row = 0
+        rowmax = self.height-self.bottomReserved-c[7]
+        while row <= rowmax:
+            freerows = self.TestFreeRows(c, row)
+            if freerows >= c[7]:
+                return row
+            row += freerows or 1
+        return None
+
+    def TestFreeRows(self, c, row):
+        return TestFreeRows(self.rows, c, row, self.width, self.height, self.bottomReserved, self.duration_marquee, self.duration_still)
+
+    def FindAlternativeRow(self, c):
+        return FindAlternativeRow(self.rows, c, self.height, self.bottomReserved)
+
+    def MarkCommentRow(self, c, row):
+        MarkCommentRow(self.rows, c, row)
+
+    def GetSpans(self, pos):
+        rows = self.rows[pos]
+        res = []
+        start = 0
+        for row in range(1, len(rows)+1):
+            if row == len(rows) or rows[row] is not rows[start]:
+                res.append((start, row, rows[start]))
+                start = row
+        return res
+
+    def SetSpan(self, pos, start, end, c):
+        self.rows[pos][start:end] = [c]*(end-start)
+
+
+class IntervalRowEngine(object):
+    # Stores the rows as sorted spans of equal occupants, span k covering
+    # [starts[k], starts[k+1]), so the cost of a lookup depends on the number
+    # of comments on the stage instead of its height in pixels
+    def __init__(self, width, height, bottomReserved, duration_marquee, duration_still):
+        self.width = width
+        self.height = height
+        self.bottomReserved = bottomReserved
+        self.duration_marquee = duration_marquee
+        self.duration_still = duration_still
+        self.size = height-bottomReserved+1
+        self.starts = [[0] for i in range(4)]
+        self.owners = [[None] for i in range(4)]
+
+    def IsBlocking(self, owner, c, thresholdTime):
+        if c[4] in (1, 2):
+            return owner[0]+self.duration_still > c[0]
+        try:
+            return owner[0] > thresholdTime or owner[0]+owner[8]*self.duration_marquee/(owner[8]+self.width) > c[0]
+        except ZeroDivisionError:
+            return False
+
+    # Result: (freerows, nextrow)
+    # nextrow is the next row worth testing if the comment does not fit here
+    def TestFreeRows(self, c, row, thresholdTime):
+        starts, owners = self.starts[c[4]], self.owners[c[4]]
+        limit = min(self.height-self.bottomReserved, row+max(math.ceil(c[7]), 0))
+        if row >= limit:
+            return 0, row+1
+        k = bisect.bisect_right(starts, row)-1
+        while k < len(starts) and starts[k] < limit:
+            owner = owners[k]
+            if owner and self.IsBlocking(owner, c, thresholdTime):
+                if starts[k] > row:
+                    return starts[k]-row, starts[k]
+                elif k+1 < len(starts):
+                    return 0, starts[k+1]
+                else:
+                    return 0, self.size
+            k += 1
+        return limit-row, limit
+
+    def FindFreeRow(self, c):
+        if c[4] in (1, 2):
+            thresholdTime = None
+        else:
+            try:
+                thresholdTime = c[0]-self.duration_marquee*(1-self.width/(c[8]+self.width))
+            except ZeroDivisionError:
+                thresholdTime = c[0]-self.duration_marquee
+        row = 0
+        rowmax = self.height-self.bottomReserved-c[7]
+        while row <= rowmax:
+            freerows, row_next = self.TestFreeRows(c, row, thresholdTime)
+            if freerows >= c[7]:
+                return row
+            row = row_next
+        return None
+
+    def FindAlternativeRow(self, c):
+        starts, owners = self.starts[c[4]], self.owners[c[4]]
+        rowmax = self.height-self.bottomReserved-math.ceil(c[7])
+        res, resowner = 0, owners[0]
+        for k in range(len(starts)):
+            if starts[k] >= rowmax:
+                break
+            if not owners[k]:
+                return starts[k]
+            elif owners[k][0] < resowner[0]:
+                res, resowner = starts[k], owners[k]
+        return res
+
+    def MarkCommentRow(self, c, row):
+        self.SetSpan(c[4], row, min(row+math.ceil(c[7]), self.size), c)
+
+    def GetSpans(self, pos):
+        starts, owners = self.starts[pos], self.owners[pos]
+        return [(starts[k], starts[k+1] if k+1 < len(starts) else self.size, owners[k]) for k in range(len(starts))]
+
+    def SetSpan(self, pos, row, rowend, c):
+        starts, owners = self.starts[pos], self.owners[pos]
+        if row >= rowend:
+            return
+        first = bisect.bisect_right(starts, row)-1
+        last = bisect.bisect_right(starts, rowend-1)-1
+        lastend = starts[last+1] if last+1 < len(starts) else self.size
+        new_starts, new_owners = [row], [c]
+        if starts[first] < row:
+            new_starts.insert(0, starts[first])
+            new_owners.insert(0, owners[first])
+        if lastend > rowend:
+            new_starts.append(rowend)
+            new_owners.append(owners[last])
+        starts[first:last+1] = new_starts
+        owners[first:last+1] = new_owners
+
+
+LayoutEngineMap = {'pixel': PixelRowEngine, 'interval': IntervalRowEngine}
+
+
+def GetLayoutEngine(layout_engine):
+    try:
+        return LayoutEngineMap[layout_engine]
+    except KeyError:
+        raise ValueError(_('Unknown layout engine: %s') % layout_engine)
+
+
+class InstrumentedRowEngine(object):
+    # Wraps a layout engine for ConversionStats, timing the calls into it and
+    # counting the row probes and where the comments go; the counts are added
+    # to the stats by Close
+    def __init__(self, rows, stats, reduced):
+        self.rows = rows
+        self.stats = stats
+        self.reduced = reduced
+        self.time = 0.0
+        self.probe_counter = RowProbeCounter(rows)
+        self.placed = 0
+        self.fallbacks = 0
+        self.dropped = 0
+
+    def FindFreeRow(self, c):
+        start = time.perf_counter()
+        # The FindFreeRow of the engine, run on the counter standing in for it
+        row = type(self.rows).FindFreeRow(self.probe_counter, c)
+        self.time += time.perf_counter()-start
+        if row is not None:
+            self.placed += 1
+        elif self.reduced:
+            self.dropped += 1
+        return row
+
+    def FindAlternativeRow(self, c):
+        start = time.perf_counter()
+        row = self.rows.FindAlternativeRow(c)
+        self.time += time.perf_counter()-start
+        self.fallbacks += 1
+        return row
+
+    def MarkCommentRow(self, c, row):
+        start = time.perf_counter()
+        self.rows.MarkCommentRow(c, row)
+        self.time += time.perf_counter()-start
+
+    def Close(self):
+        self.stats.AddTime('layout', self.time)
+        self.stats.Count('row_probes', self.probe_counter.probes)
+        self.stats.Count('free_row_placements', self.placed)
+        self.stats.Count('fallback_placements', self.fallbacks)
+        self.stats.Count('comments_dropped', self.dropped)
+
+
+class RowProbeCounter(object):
+    # Stands in for a layout engine in its own FindFreeRow, counting the calls
+    # to TestFreeRows without replacing the method of the engine
+    def __init__(self, rows):
+        self.rows = rows
+        self.probes = 0
+
+    def __getattr__(self, name):
+        return getattr(self.rows, name)
+
+    def TestFreeRows(self, *args):
+        self.probes += 1
+        return self.rows.TestFreeRows(*args)
+
+
+#
+# Parallel layout
+#
+# The sorted comments are cut into shards, preferably at quiet points where
+# nothing is left on the stage, and worker processes lay out the shards on
+# their own. A worker cannot know which rows are taken when its shard begins,
+# so it first replays the comments shown during the ShardWarmup durations
+# before the cut to rebuild them.
+#
+# The main process then checks the shards in order against the exact rows
+# left by the previous ones. A shard is kept if the comments still on the
+# stage at the cut were rebuilt on the same rows, and FindAlternativeRow,
+# which also considers comments gone from the stage, never looks at a row
+# that differs before it is written again. Otherwise, the comments are laid
+# out again from the exact rows until the same check passes at one of the
+# checkpoints of the worker, from where its output is used again. Either
+# way, the output is the same as the sequential one.
+#
+# With exact_layout=False, only the rows of the comments still on the stage
+# are checked at each checkpoint, as is the trust of the shard in the widths,
+# while the rows left by comments gone from the stage are not replayed against
+# the calls to FindAlternativeRow. Such a call, made when every row is taken,
+# may then choose another row than the sequential layout, and the comments
+# placed while that comment is on the stage, at most one comment duration, may
+# follow it onto other rows (or, when reduced, be dropped instead of others).
+# The time, text and style of comments are never affected. On generated
+# Bilibili and Acfun files of 20000 comments at up to 5000 comments per
+# second, no line differed from the sequential output.
+#
+
+ShardMinComments = 2000
+ShardsPerJob = 4
+ShardWarmup = 2
+ShardCheckpoint = 256
+
+
+def ProcessCommentsSharded(comments, f, rows, width, height, bottomReserved, fontsize, duration_marquee, duration_still, reduced, styleid, progress_callback, jobs, exact_layout=True):
+    import concurrent.futures
+    duration = max(duration_marquee, duration_still)
+    timelines, bounds = FindShardBounds(comments, jobs*ShardsPerJob, duration)
+    # Each worker gets the comments once, through the initializer: forked
+    # workers share them, under spawn or forkserver (the default on Windows,
+    # macOS and from Python 3.14 on) they are pickled to every worker
+    with concurrent.futures.ProcessPoolExecutor(max_workers=jobs, initializer=InitShardWorker, initargs=(comments,)) as executor:
+        futures = []
+        for start, end in bounds:
+            warmup_start = bisect.bisect_left(timelines, timelines[start]-duration*ShardWarmup, 0, start)
+            shard_rows = type(rows)(width, height, bottomReserved, duration_marquee, duration_still)
+            futures.append(executor.submit(LayoutShard, (start, end, warmup_start, shard_rows, width, height, bottomReserved, fontsize, duration_marquee, duration_still, reduced, styleid)))
+        for (start, end), future in zip(bounds, futures):
+            texts, checkpoints, events, written_spans, alt_end, unsafe = future.result()
+            event_idx = [event[0] for event in events]
+            for checkpoint in range(len(texts)):
+                offset = checkpoint*ShardCheckpoint
+                first_event = bisect.bisect_left(event_idx, offset)
+                if not unsafe and ShardStateMatches(rows, checkpoints[checkpoint], events, first_event, alt_end, timelines[start+offset], duration, exact_layout):
+                    f.write(''.join(texts[checkpoint:]))
+                    ApplyShardEvents(rows, written_spans, first_event)
+                    break
+                for idx in range(start+offset, min(start+offset+ShardCheckpoint, end)):
+                    PlaceComment(f, comments[idx], rows, width, height, bottomReserved, fontsize, duration_marquee, duration_still, reduced, styleid)
+            if progress_callback:
+                progress_callback(end, len(comments))
+
+
+# Result: (timelines, [(start, end)]) for about shard_count shards
+def FindShardBounds(comments, shard_count, duration):
+    if isinstance(comments, CommentTable):
+        # Read the columns instead of building every tuple
+        order = comments.order if comments.order is not None else range(len(comments))
+        timelines = list(map(comments.timeline.__getitem__, order))
+        columns = zip(timelines, map(comments.pos.__getitem__, order), map(comments.width.__getitem__, order))
+        is_row = (0).__le__
+    else:
+        timelines = [c[0] for c in comments]
+        columns = ((c[0], c[4], c[8]) for c in comments)
+        is_row = lambda pos: isinstance(pos, int)
+    quiet = []
+    last_end = -math.inf
+    for idx, (timeline, pos, width) in enumerate(columns):
+        if timeline >= last_end:
+            quiet.append(idx)
+        if is_row(pos):
+            last_end = max(last_end, timeline+duration if width >= 0 else math.inf)
+    count = len(timelines)
+    shard_count = max(min(shard_count, count//ShardMinComments), 1)
+    slack = count//(shard_count*4)
+    cuts = [0]
+    for i in range(1, shard_count):
+        cut = count*i//shard_count
+        # Take the nearest quiet point if there is one close enough
+        k = bisect.bisect_left(quiet, cut)
+        nearby = [quiet[j] for j in (k-1, k) if 0 <= j < len(quiet) and abs(quiet[j]-cut) <= slack]
+        if nearby:
+            cut = min(nearby, key=lambda j: abs(j-cut))
+        if cut > cuts[-1]:
+            cuts.append(cut)
+    cuts.append(count)
+    return timelines, list(zip(cuts[:-1], cuts[1:]))
+
+
+ShardComments = None
+
+
+def InitShardWorker(comments):
+    global ShardComments
+    ShardComments = comments
+
+
+# Runs in a worker process
+# Result: (ASS text of every ShardCheckpoint comments, rows at the start of
+#          each of them, then the events, last writes, FindAlternativeRow
+#          extent and trust logged by ShardRowTracker)
+def LayoutShard(task):
+    start, end, warmup_start, rows, width, height, bottomReserved, fontsize, duration_marquee, duration_still, reduced, styleid = task
+    for idx in range(warmup_start, start):
+        c = ShardComments[idx]
+        if isinstance(c[4], int):
+            LayoutComment(c, rows, reduced)
+    tracker = ShardRowTracker(rows)
+    texts = []
+    checkpoints = []
+    f = None
+    for idx in range(end-start):
+        if idx % ShardCheckpoint == 0:
+            if f:
+                texts.append(f.getvalue())
+            checkpoints.append([rows.GetSpans(pos) for pos in range(4)])
+            f = io.StringIO()
+        tracker.idx = idx
+        PlaceComment(f, ShardComments[start+idx], tracker, width, height, bottomReserved, fontsize, duration_marquee, duration_still, reduced, styleid)
+    if f:
+        texts.append(f.getvalue())
+    return texts, checkpoints, tracker.events, [tracker.last_written.GetSpans(pos) for pos in range(4)], tracker.alt_end, tracker.unsafe
+
+
+class ShardRowTracker(object):
+    # Wraps the layout engine of a shard, logging (idx, pos, start, end, c)
+    # for every comment c written on rows [start, end), and with c being None
+    # for every call to FindAlternativeRow looking at rows [0, end)
+    #
+    # last_written is only used as a map of spans, to (event index, c) of the
+    # last comment written, and alt_end is the furthest end of the calls to
+    # FindAlternativeRow for each type
+    def __init__(self, rows):
+        self.rows = rows
+        self.size = rows.height-rows.bottomReserved+1
+        self.idx = 0
+        self.events = []
+        self.last_written = IntervalRowEngine(rows.width, rows.height, rows.bottomReserved, rows.duration_marquee, rows.duration_still)
+        self.alt_end = [0]*4
+        self.unsafe = False
+
+    def FindFreeRow(self, c):
+        # IsOnStage relies on the width of comments not being negative
+        if not c[8] >= 0:
+            self.unsafe = True
+        return self.rows.FindFreeRow(c)
+
+    def FindAlternativeRow(self, c):
+        rowmax = self.rows.height-self.rows.bottomReserved-math.ceil(c[7])
+        self.alt_end[c[4]] = max(self.alt_end[c[4]], rowmax)
+        self.events.append((self.idx, c[4], 0, rowmax, None))
+        return self.rows.FindAlternativeRow(c)
+
+    def MarkCommentRow(self, c, row):
+        self.rows.MarkCommentRow(c, row)
+        rowend = min(row+math.ceil(c[7]), self.size)
+        self.last_written.SetSpan(c[4], row, rowend, (len(self.events), c))
+        self.events.append((self.idx, c[4], row, rowend, c))
+
+
+# Whether a shard laid out from the given spans, logging the given events,
+# gives the same output as laying it out from the exact rows
+def ShardStateMatches(rows, spans, events, first_event, alt_end, time, duration, exact=True):
+    stale = [RowRanges() for i in range(4)]
+    for pos in range(4):
+        for start, end, exact_c, shard_c in IterSpanPairs(rows.GetSpans(pos), spans[pos]):
+            if exact_c is shard_c or exact_c == shard_c:
+                continue
+            if IsOnStage(exact_c, time, duration) or IsOnStage(shard_c, time, duration):
+                return False
+            if start < alt_end[pos]:
+                stale[pos].Add(start, min(end, alt_end[pos]))
+    if not exact:
+        return True
+    # Rows differing by comments gone from the stage only matter to
+    # FindAlternativeRow, until they are written again
+    for event_idx in range(first_event, len(events)):
+        idx, pos, start, end, c = events[event_idx]
+        if not stale[pos]:
+            if not any(stale):
+                break
+        elif c is None:
+            if stale[pos].starts[0] < end:
+                return False
+        else:
+            stale[pos].Remove(start, end)
+    return True
+
+
+# Copies the rows last written from event first_event on to the exact rows
+def ApplyShardEvents(rows, written_spans, first_event):
+    for pos in range(4):
+        for start, end, written in written_spans[pos]:
+            if written is not None and written[0] >= first_event:
+                rows.SetSpan(pos, start, end, written[1])
+
+
+class RowRanges(object):
+    # A set of rows, kept as sorted disjoint ranges [starts[k], ends[k])
+    def __init__(self):
+        self.starts = []
+        self.ends = []
+
+    def __bool__(self):
+        return bool(self.starts)
+
+    # Ranges must be added in order
+    def Add(self, start, end):
+        if self.ends and self.ends[-1] == start:
+            self.ends[-1] = end
+        else:
+            self.starts.append(start)
+            self.ends.append(end)
+
+    # Result: the ranges removed
+    def Remove(self, start, end):
+        lo = bisect.bisect_right(self.ends, start)
+        hi = bisect.bisect_left(self.starts, end)
+        if lo >= hi:
+            return []
+        removed = list(zip(self.starts[lo:hi], self.ends[lo:hi]))
+        new_starts, new_ends = [], []
+        if removed[0][0] < start:
+            new_starts.append(removed[0][0])
+            new_ends.append(start)
+            removed[0] = (start, removed[0][1])
+        if removed[-1][1] > end:
+            new_starts.append(end)
+            new_ends.append(removed[-1][1])
+            removed[-1] = (removed[-1][0], end)
+        self.starts[lo:hi] = new_starts
+        self.ends[lo:hi] = new_ends
+        return removed
+
+
+# Whether comment c may still block another comment shown at or after time
+def IsOnStage(c, time, duration):
+    return c is not None and not (c[8] >= 0 and c[0]+duration <= time)
+
+
+# Result: (start, end, a, b) for each range of rows over which both span lists
+#         are constant
+def IterSpanPairs(spans_a, spans_b):
+    i, j = 0, 0
+    start = 0
+    while i < len(spans_a) and j < len(spans_b):
+        end = min(spans_a[i][1], spans_b[j][1])
+        yield start, end, spans_a[i][2], spans_b[j][2]
+        start = end
+        if spans_a[i][1] == end:
+            i += 1
+        if spans_b[j][1] == end:
+            j += 1
+
+
 def WriteASSHead(f, width, height, fontface, fontsize, alpha, styleid):
     f.write(
 '''[Script Info]
@@ -691,30 +1505,34 @@ Format: Layer, Start, End, Style, Name, MarginL, MarginR, MarginV, Effect, Text
 
 
 def WriteComment(f, c, row, width, height, bottomReserved, fontsize, duration_marquee, duration_still, styleid):
-    text = ASSEscape(c[3])
-    styles = []
     if c[4] == 1:
-        styles.append('\\an8\\pos(%(halfwidth)d, %(row)d)' % {'halfwidth': width/2, 'row': row})
+        styles = '\\an8\\pos(%d, %d)' % (width/2, row)
         duration = duration_still
     elif c[4] == 2:
-        styles.append('\\an2\\pos(%(halfwidth)d, %(row)d)' % {'halfwidth': width/2, 'row': ConvertType2(row, height, bottomReserved)})
+        styles = '\\an2\\pos(%d, %d)' % (width/2, ConvertType2(row, height, bottomReserved))
         duration = duration_still
     elif c[4] == 3:
-        styles.append('\\move(%(neglen)d, %(row)d, %(width)d, %(row)d)' % {'width': width, 'row': row, 'neglen': -math.ceil(c[8])})
+        styles = '\\move(%d, %d, %d, %d)' % (-math.ceil(c[8]), row, width, row)
         duration = duration_marquee
     else:
-        styles.append('\\move(%(width)d, %(row)d, %(neglen)d, %(row)d)' % {'width': width, 'row': row, 'neglen': -math.ceil(c[8])})
+        styles = '\\move(%d, %d, %d, %d)' % (width, row, -math.ceil(c[8]), row)
         duration = duration_marquee
     if not (-1 < c[6]-fontsize < 1):
-        styles.append('\\fs%.0f' % c[6])
+        styles += '\\fs%.0f' % c[6]
     if c[5] != 0xffffff:
-        styles.append('\\c&H%s&' % ConvertColor(c[5]))
+        styles += '\\c&H%s&' % ConvertColor(c[5])
         if c[5] == 0x000000:
-            styles.append('\\3c&HFFFFFF&')
-    f.write('Dialogue: 2,%(start)s,%(end)s,%(styleid)s,,0000,0000,0000,,{%(styles)s}%(text)s\n' % {'start': ConvertTimestamp(c[0]), 'end': ConvertTimestamp(c[0]+duration), 'styles': ''.join(styles), 'text': text, 'styleid': styleid})
+            styles += '\\3c&HFFFFFF&'
+    f.write('Dialogue: 2,%s,%s,%s,,0000,0000,0000,,{%s}%s\n' % (ConvertTimestamp(c[0]), ConvertTimestamp(c[0]+duration), styleid, styles, ASSEscape(c[3])))
+
+
+ASSSpecialChars = re.compile('[\\\\{}\n]|^ | $')
 
 
 def ASSEscape(s):
+    s = str(s)
+    if s and not ASSSpecialChars.search(s):
+        return s  # Most comments are plain text
     def ReplaceLeadingSpace(s):
         sstrip = s.strip(' ')
         slen = len(s)
@@ -724,21 +1542,164 @@ def ASSEscape(s):
             llen = slen-len(s.lstrip(' '))
             rlen = slen-len(s.rstrip(' '))
             return ''.join(('\u2007'*llen, sstrip, '\u2007'*rlen))
-    return '\\N'.join((ReplaceLeadingSpace(i) or ' ' for i in str(s).replace('\\', '\\\\').replace('{', '\\{').replace('}', '\\}').split('\n')))
+    return '\\N'.join((ReplaceLeadingSpace(i) or ' ' for i in s.replace('\\', '\\\\').replace('{', '\\{').replace('}', '\\}').split('\n')))
 
 
 def CalculateLength(s):
     return max(map(len, s.split('\n')))  # May not be accurate
 
 
+#
+# TextWidthModel
+#
+# Measures comments more closely than CalculateLength, which counts every
+# character as one em. The widths of characters are looked up once, and those
+# of whole comments are kept in an LRU cache keyed on (text, size), since the
+# same comments, such as "233333", come up again and again.
+#
+
+class TextWidthModel(object):
+    CacheSize = 65536
+
+    def __init__(self):
+        self.char_widths = {}
+        self.Measure = functools.lru_cache(maxsize=self.CacheSize)(self.MeasureText)
+
+    # Result: the width of text in pixels at font size, same as c[8]
+    def MeasureText(self, text, size):
+        return max(map(self.MeasureLine, str(text).split('\n')))*size
+
+    # Result: the width of a line in ems
+    def MeasureLine(self, line):
+        char_widths = self.char_widths
+        try:
+            return sum(map(char_widths.__getitem__, line))
+        except KeyError:
+            for char in line:
+                if char not in char_widths:
+                    char_widths[char] = self.CharWidth(char)
+            return sum(map(char_widths.__getitem__, line))
+
+    def CharWidth(self, char):
+        raise NotImplementedError
+
+
+class EastAsianWidthModel(TextWidthModel):
+    # Wide, fullwidth and ambiguous characters take one em, as they do in CJK
+    # fonts, other characters half an em, and combining marks nothing
+    FullWidth = 1.0
+    HalfWidth = 0.5
+
+    def CharWidth(self, char):
+        if unicodedata.combining(char) or unicodedata.category(char) in ('Mn', 'Me', 'Cf'):
+            return 0.0
+        elif unicodedata.east_asian_width(char) in ('W', 'F', 'A'):
+            return self.FullWidth
+        else:
+            return self.HalfWidth
+
+
+class FontWidthModel(EastAsianWidthModel):
+    # Takes the advance widths from a TrueType or OpenType font file (the first
+    # font of a collection), and falls back to East Asian widths for characters
+    # the font does not have
+    def __init__(self, font_file):
+        super().__init__()
+        with open(font_file, 'rb') as f:
+            self.font = f.read()
+        try:
+            self.ParseFont()
+        except (struct.error, KeyError, IndexError) as e:
+            raise ValueError(_('Unsupported font file: %s (%s)') % (font_file, e)) from None
+
+    def ParseFont(self):
+        font = self.font
+        base = 0
+        if font[:4] == b'ttcf':
+            base = struct.unpack_from('>L', font, 12)[0]
+        num_tables = struct.unpack_from('>H', font, base+4)[0]
+        tables = {}
+        for i in range(num_tables):
+            tag, checksum, offset, length = struct.unpack_from('>4sLLL', font, base+12+16*i)
+            tables[tag] = offset
+        self.units_per_em = struct.unpack_from('>H', font, tables[b'head']+18)[0] or 1000
+        num_hmetrics = struct.unpack_from('>H', font, tables[b'hhea']+34)[0]
+        self.advances = array.array('H', (struct.unpack_from('>H', font, tables[b'hmtx']+4*i)[0] for i in range(num_hmetrics)))
+        if not self.advances:
+            raise IndexError('no horizontal metrics')
+        cmap = tables[b'cmap']
+        subtables = {}
+        for i in range(struct.unpack_from('>H', font, cmap+2)[0]):
+            platform, encoding, offset = struct.unpack_from('>HHL', font, cmap+4+8*i)
+            subtables.setdefault(struct.unpack_from('>H', font, cmap+offset)[0], {})[(platform, encoding)] = cmap+offset
+        # Prefer the full Unicode subtables, then the BMP ones
+        for fmt, encodings in ((12, ((3, 10), (0, 4), (0, 6))), (4, ((3, 1), (0, 3), (0, 4), (0, 1), (0, 0)))):
+            for encoding in encodings:
+                if encoding in subtables.get(fmt, ()):
+                    self.ParseCmap(fmt, subtables[fmt][encoding])
+                    return
+        raise KeyError('no Unicode cmap')
+
+    def ParseCmap(self, fmt, offset):
+        font = self.font
+        self.cmap_format = fmt
+        if fmt == 12:
+            num_groups = struct.unpack_from('>L', font, offset+12)[0]
+            groups = [struct.unpack_from('>LLL', font, offset+16+12*i) for i in range(num_groups)]
+            self.cmap_ends = [group[1] for group in groups]
+            self.cmap_groups = groups
+        else:
+            seg_count = struct.unpack_from('>H', font, offset+6)[0]//2
+            ends = struct.unpack_from('>%dH' % seg_count, font, offset+14)
+            starts = struct.unpack_from('>%dH' % seg_count, font, offset+16+2*seg_count)
+            deltas = struct.unpack_from('>%dh' % seg_count, font, offset+16+4*seg_count)
+            range_offsets_at = offset+16+6*seg_count
+            range_offsets = struct.unpack_from('>%dH' % seg_count, font, range_offsets_at)
+            self.cmap_ends = list(ends)
+            self.cmap_groups = [(starts[i], deltas[i], range_offsets[i], range_offsets_at+2*i) for i in range(seg_count)]
+
+    # Result: the glyph index of a code point, or 0 if it is missing
+    def GetGlyph(self, codepoint):
+        i = bisect.bisect_left(self.cmap_ends, codepoint)
+        if i >= len(self.cmap_ends):
+            return 0
+        if self.cmap_format == 12:
+            start, end, start_glyph = self.cmap_groups[i]
+            return start_glyph+codepoint-start if codepoint >= start else 0
+        start, delta, range_offset, range_offset_at = self.cmap_groups[i]
+        if codepoint < start:
+            return 0
+        if range_offset == 0:
+            return (codepoint+delta) & 0xffff
+        glyph = struct.unpack_from('>H', self.font, range_offset_at+range_offset+2*(codepoint-start))[0]
+        return (glyph+delta) & 0xffff if glyph else 0
+
+    def CharWidth(self, char):
+        if char == '\t' or unicodedata.combining(char) or unicodedata.category(char) in ('Mn', 'Me', 'Cf'):
+            return super().CharWidth(char)
+        try:
+            glyph = self.GetGlyph(ord(char))
+        except struct.error:
+            glyph = 0
+        if not glyph:
+            return super().CharWidth(char)
+        return self.advances[min(glyph, len(self.advances)-1)]/self.units_per_em
+
+
 def ConvertTimestamp(timestamp):
-    timestamp = round(timestamp*100.0)
-    hour, minute = divmod(timestamp, 360000)
-    minute, second = divmod(minute, 6000)
-    second, centsecond = divmod(second, 100)
-    return '%d:%02d:%02d.%02d' % (int(hour), int(minute), int(second), int(centsecond))
+    second, centsecond = divmod(round(timestamp*100.0), 100)
+    return '%s.%02d' % (ConvertSeconds(int(second)), int(centsecond))
+
+
+# Thousands of comments share each second of a video, so keep the results
+@functools.lru_cache(maxsize=65536)
+def ConvertSeconds(second):
+    hour, minute = divmod(second, 3600)
+    minute, second = divmod(minute, 60)
+    return '%d:%02d:%02d' % (hour, minute, second)
 
 
+@functools.lru_cache(maxsize=4096)
 def ConvertColor(RGB, width=1280, height=576):
     if RGB == 0x000000:
         return '000000'
@@ -771,18 +1732,110 @@ def ConvertToFile(filename_or_file, *args, **kwargs):
         return filename_or_file
 
 
+# Opens a comment file held in a bytes-like object (bytearray, memoryview or
+# mmap) as a text stream decoded one chunk at a time, without copying it
+def OpenCommentBuffer(data):
+    return io.TextIOWrapper(io.BufferedReader(BufferReader(data)), encoding='utf-8', errors='replace')
+
+
+def IsCommentBuffer(input_file):
+    return isinstance(input_file, (bytearray, memoryview, mmap.mmap))
+
+
+class BufferReader(io.RawIOBase):
+    def __init__(self, data):
+        self.data = memoryview(data).cast('B')
+        self.pos = 0
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        size = min(len(b), len(self.data)-self.pos)
+        b[:size] = self.data[self.pos:self.pos+size]
+        self.pos += size
+        return size
+
+    def close(self):
+        # Release the view, so that an mmap can be closed afterwards
+        self.data.release()
+        super().close()
+
+
 def FilterBadChars(f):
-    s = f.read()
-    s = re.sub('[\\x00-\\x08\\x0b\\x0c\\x0e-\\x1f]', '\ufffd', s)
-    return io.StringIO(s)
+    return BadCharFilter(f)
+
+
+class BadCharFilter(io.TextIOBase):
+    # Replaces control characters that are illegal in XML while reading, one
+    # chunk at a time instead of copying the whole document
+    BadChars = re.compile('[\\x00-\\x08\\x0b\\x0c\\x0e-\\x1f]')
+
+    def __init__(self, f):
+        self.f = f
+
+    def readable(self):
+        return True
+
+    def read(self, size=-1):
+        if size is None:
+            size = -1
+        return self.BadChars.sub('\ufffd', self.f.read(size))
+
+
+class ASSWriter(io.TextIOBase):
+    # Writes an ASS file to a binary file: the text written is collected and
+    # encoded one large chunk at a time, with the BOM and the CRLF line
+    # endings that utf-8-sig and newline='\r\n' would give
+    ChunkSize = 262144
+
+    def __init__(self, f, close_file=True, stats=None):
+        self.f = f
+        self.close_file = close_file
+        self.stats = stats
+        self.pending = []
+        self.pending_size = 0
+        self.f.write(b'\xef\xbb\xbf')
+        if stats:
+            stats.Count('bytes_written', 3)
+
+    def writable(self):
+        return True
+
+    def write(self, s):
+        self.pending.append(s)
+        self.pending_size += len(s)
+        if self.pending_size >= self.ChunkSize:
+            self.WritePending()
+        return len(s)
+
+    def WritePending(self):
+        if self.pending:
+            start = time.perf_counter()
+            data = ''.join(self.pending).replace('\n', '\r\n').encode('utf-8', 'replace')
+            self.f.write(data)
+            self.pending = []
+            self.pending_size = 0
+            if self.stats:
+                self.stats.AddTime('encode', time.perf_counter()-start)
+                self.stats.Count('bytes_written', len(data))
+
+    def flush(self):
+        self.WritePending()
+        self.f.flush()
+
+    def close(self):
+        if not self.closed:
+            try:
+                self.flush()
+            finally:
+                super().close()
+                if self.close_file:
+                    self.f.close()
 
 
-class safe_list(list):
-    def get(self, index, default=None):
-        try:
-            return self[index]
-        except IndexError:
-            return default
+def IsBinaryFile(f):
+    return isinstance(f, (io.RawIOBase, io.BufferedIOBase)) or 'b' in str(getattr(f, 'mode', ''))
 
 
 def export(func):
@@ -794,42 +1847,751 @@ def export(func):
     return func
 
 
+#
+# CommentTable
+#
+# Holds the tuples yielded by ReadComments**** column by column: the numeric
+# fields are kept in typed arrays, the comments in a list, and the extra fields
+# of positioned comments in a dict keyed by storage index.
+#
+# Sorting only computes a permutation of the storage indices; indexing or
+# iterating over the table gives the tuples back in that order, one at a time.
+#
+
 @export
-def Danmaku2ASS(input_files, output_file, stage_width, stage_height, reserve_blank=0, font_face=_('(FONT) sans-serif')[7:], font_size=25.0, text_opacity=1.0, duration_marquee=5.0, duration_still=5.0, is_reduce_comments=False, progress_callback=None):
-    fo = None
-    comments = ReadComments(input_files, font_size)
+class CommentTable(object):
+    def __init__(self):
+        self.timeline = array.array('d')
+        self.timestamp = array.array('q')
+        self.no = array.array('q')
+        self.comment = []
+        self.pos = array.array('i')  # Negative values index into pos_names
+        self.color = array.array('q')
+        self.size = array.array('d')
+        self.height = array.array('d')
+        self.width = array.array('d')
+        self.pos_names = []
+        self.extra = {}
+        self.order = None
+
+    def Columns(self):
+        return (self.timeline, self.timestamp, self.no, self.comment, self.pos, self.color, self.size, self.height, self.width)
+
+    def EncodePos(self, pos):
+        if isinstance(pos, int) and 0 <= pos < 0x80000000:
+            return pos
+        try:
+            return -1-self.pos_names.index(pos)
+        except ValueError:
+            self.pos_names.append(pos)
+            return -len(self.pos_names)
+
+    def Append(self, c):
+        idx = len(self.comment)
+        try:
+            self.timeline.append(c[0])
+            self.timestamp.append(c[1])
+            self.no.append(c[2])
+            self.comment.append(c[3])
+            self.pos.append(self.EncodePos(c[4]))
+            self.color.append(c[5])
+            self.size.append(c[6])
+            self.height.append(c[7])
+            self.width.append(c[8])
+        except (IndexError, OverflowError, TypeError):
+            for column in self.Columns():
+                del column[idx:]
+            logging.warning(_('Invalid comment: %r') % (c,))
+            return
+        if len(c) > 9:
+            self.extra[idx] = tuple(c[9:])
+        if self.order is not None:
+            self.order.append(idx)
+
+    def Extend(self, comments):
+        for c in comments:
+            self.Append(c)
+
+    def __len__(self):
+        return len(self.comment)
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return self.Take(range(*idx.indices(len(self))))
+        if self.order is not None:
+            idx = self.order[idx]
+        elif idx < 0:
+            idx += len(self)
+        pos = self.pos[idx]
+        if pos < 0:
+            pos = self.pos_names[-1-pos]
+        c = (self.timeline[idx], self.timestamp[idx], self.no[idx], self.comment[idx], pos, self.color[idx], self.size[idx], self.height[idx], self.width[idx])
+        extra = self.extra.get(idx)
+        return c+extra if extra else c
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self[idx]
+
+    # Result: a new, compact table with the rows at the given indices
+    def Take(self, indices):
+        if self.order is not None:
+            indices = list(map(self.order.__getitem__, indices))
+        else:
+            indices = list(indices)
+        res = CommentTable()
+        for column, res_column in zip(self.Columns(), res.Columns()):
+            res_column.extend(map(column.__getitem__, indices))
+        res.pos_names = list(self.pos_names)
+        if self.extra:
+            res.extra = {new_idx: self.extra[idx] for new_idx, idx in enumerate(indices) if idx in self.extra}
+        return res
+
+    # Result: the storage indices ordered by (timeline, timestamp, no)
+    def ArgSort(self):
+        order = list(range(len(self)))
+        # Stable sorts from the least significant key, without building tuples
+        order.sort(key=self.no.__getitem__)
+        order.sort(key=self.timestamp.__getitem__)
+        order.sort(key=self.timeline.__getitem__)
+        return order
+
+    def Sort(self):
+        self.order = array.array('q', self.ArgSort())
+
+    # Replaces the estimated widths with those measured by a TextWidthModel,
+    # keeping those of positioned comments, whose text is not a plain string
+    def Measure(self, width_model):
+        measure, comment, pos, size, width = width_model.Measure, self.comment, self.pos, self.size, self.width
+        self.width = array.array('d', (measure(comment[idx], size[idx]) if 0 <= pos[idx] <= 3 else width[idx] for idx in range(len(comment))))
+
+
+#
+# CommentFilter
+#
+# Cuts down the comments before the layout, in the order of the timeline:
+#
+#     blocklist:      Drops the comments matching any of the keywords or
+#                     regular expressions, see CompileBlocklist
+#     merge_window:   Merges the comments that repeat an earlier one of the
+#                     same mode within this many seconds into it, which then
+#                     ends with a counter, e.g. "233333 \u00d712". Comments
+#                     that differ only in case, width, spaces, punctuation or
+#                     how long a character is repeated count as the same, see
+#                     NormalizeComment.
+#     max_density:    Keeps at most this many comments starting within any
+#                     density_window seconds, dropping the others
+#
+# Positioned comments are only checked against the blocklist, with the text
+# they show, see GetPositionedText.
+#
+
+@export
+class CommentFilter(object):
+    def __init__(self, max_density=None, density_window=5.0, merge_window=None, blocklist=None):
+        self.max_density = max_density
+        self.density_window = density_window
+        self.merge_window = merge_window
+        self.blocklist = blocklist
+
+    # Result: a JSON-serializable description, to tell filters apart
+    def Describe(self):
+        return [self.max_density, self.density_window, self.merge_window, self.blocklist.pattern if self.blocklist else None]
+
+    # Result: a new, sorted CommentTable with the comments that pass
+    def Apply(self, comments, width_model=None):
+        timeline, comment, pos = comments.timeline, comments.comment, comments.pos
+        order = comments.order if comments.order is not None else range(len(comments))
+        blocklist_search = self.blocklist.search if self.blocklist else None
+        keep = []
+        groups = {}
+        merged = []
+        recent = collections.deque()
+        for i, idx in enumerate(order):
+            text = comment[idx]
+            mode = pos[idx]
+            if not 0 <= mode <= 3:
+                # Match what the comment shows, not its positions or fonts
+                shown = GetPositionedText(text, comments.pos_names[-1-mode]) if blocklist_search and mode < 0 else None
+                if shown is None or not blocklist_search(shown):
+                    keep.append(i)
+                continue
+            if blocklist_search and blocklist_search(text):
+                continue
+            start = timeline[idx]
+            if self.merge_window is not None:
+                key = (mode, NormalizeComment(text))
+                group = groups.get(key)
+                if group is not None and start-group[0] <= self.merge_window:
+                    group[2] += 1
+                    continue
+            if self.max_density is not None:
+                while recent and recent[0] <= start-self.density_window:
+                    recent.popleft()
+                if len(recent) >= self.max_density:
+                    continue
+                recent.append(start)
+            if self.merge_window is not None:
+                groups[key] = group = [start, len(keep), 1]
+                merged.append(group)
+            keep.append(i)
+        res = comments.Take(keep)
+        for start, new_idx, count in merged:
+            if count > 1:
+                text = '%s \u00d7%d' % (res.comment[new_idx], count)
+                res.comment[new_idx] = text
+                res.width[new_idx] = width_model.Measure(text, res.size[new_idx]) if width_model else CalculateLength(text)*res.size[new_idx]
+        if len(res) != len(comments):
+            logging.info(_('Filtered %d comments down to %d') % (len(comments), len(res)))
+        return res
+
+
+CommentNoise = re.compile('[\\s\\W_]+')
+RepeatedChars = re.compile('(.)\\1{2,}')
+
+
+# Result: the text that near-identical comments have in common
+@functools.lru_cache(maxsize=65536)
+def NormalizeComment(text):
+    text = unicodedata.normalize('NFKC', str(text)).casefold()
+    text = CommentNoise.sub('', text) or text  # Keep comments made of punctuation or emoji
+    return RepeatedChars.sub('\\1\\1', text)
+
+
+# Result: a regular expression matching any of the keywords or patterns,
+#         ignoring case, or None if there are none
+#
+# The keywords are merged into a trie first, so that the expression tries each
+# character once however many keywords share it.
+def CompileBlocklist(keywords=(), patterns=()):
+    trie = {}
+    for keyword in keywords:
+        if keyword:
+            node = trie
+            for char in keyword.casefold():
+                node = node.setdefault(char, {})
+            node[''] = None
+    alternatives = list(patterns)
+    if trie:
+        alternatives.append(TrieToRegex(trie))
+    if not alternatives:
+        return None
+    return re.compile('|'.join('(?:%s)' % i for i in alternatives), re.IGNORECASE)
+
+
+def TrieToRegex(trie):
+    if '' in trie:
+        return ''  # A shorter keyword already matches
+    branches, chars = [], []
+    for char, node in sorted(trie.items()):
+        tail = TrieToRegex(node)
+        if tail:
+            branches.append(re.escape(char)+tail)
+        else:
+            chars.append(re.escape(char))
+    if chars:
+        branches.append(chars[0] if len(chars) == 1 else '[%s]' % ''.join(chars))
+    return branches[0] if len(branches) == 1 else '(?:%s)' % '|'.join(branches)
+
+
+# Result: the regular expression of a blocklist file, with one keyword on each
+#         line, or one regular expression written as /pattern/
+def ReadBlocklist(filename):
+    keywords, patterns = [], []
+    with open(filename, 'r', encoding='utf-8', errors='replace') as f:
+        for line in f:
+            line = line.strip()
+            if len(line) > 2 and line.startswith('/') and line.endswith('/'):
+                patterns.append(line[1:-1])
+            elif line:
+                keywords.append(line)
+    return CompileBlocklist(keywords, patterns)
+
+
+#
+# ConversionStats
+#
+# Records what a conversion spends its time on. Pass one to Danmaku2ASS or
+# ReadComments as stats; without it, nothing is measured and the layout runs
+# exactly as before.
+#
+# Stages, timed from start to stop:
+#     read, measure (with a width model), sort, filter (with a CommentFilter),
+#     convert (layout and output)
+#
+# Timers, accumulated during convert:
+#     layout                Time spent in the layout engine
+#     encode                Time spent encoding and writing the output, when
+#                           ASSWriter encodes it
+# The rest of convert goes to formatting the ASS lines.
+#
+# Counters:
+#     comments_read         Comments read from the input files
+#     invalid_comments      "Invalid comment" warnings logged
+#     comments_filtered     Comments dropped or merged by the CommentFilter
+#     row_probes            Calls to TestFreeRows of the layout engine, each
+#                           testing a run of rows from a given one
+#     free_row_placements   Comments placed where they do not collide
+#     fallback_placements   Comments overlapping others as the stage is full
+#     comments_dropped      Comments dropped as the stage is full, if reduced
+#     bytes_written         Bytes of output, when ASSWriter encodes it
+#
+# With jobs > 1 the layout runs in worker processes, whose timers and counters
+# are not collected.
+#
+# event_callback, if given, is called with a dict for every stage started and
+# stopped: {'event': 'start' or 'stop', 'stage': name, 'time': seconds since
+# the stats were created}, plus 'start' and 'duration' in seconds on stop.
+#
+# With profile=True the conversion runs under cProfile, and with
+# trace_memory=True under tracemalloc; the report then also lists the
+# functions taking the most time and the lines holding the most memory.
+#
+
+@export
+class ConversionStats(object):
+    ReportLimit = 30
+
+    def __init__(self, event_callback=None, profile=False, trace_memory=False):
+        self.event_callback = event_callback
+        self.profile = profile
+        self.trace_memory = trace_memory
+        self.created = time.perf_counter()
+        self.stages = []
+        self.started = {}
+        self.timers = collections.defaultdict(float)
+        self.counters = collections.Counter()
+        self.capturing = 0
+        self.log_filter = None
+        self.profiler = None
+        self.profile_result = None
+        self.memory_started = False
+        self.memory_result = None
+
+    def Count(self, name, n=1):
+        self.counters[name] += n
+
+    def AddTime(self, name, seconds):
+        self.timers[name] += seconds
+
+    def StageStart(self, name):
+        now = time.perf_counter()
+        self.started[name] = now
+        if self.event_callback:
+            self.event_callback({'event': 'start', 'stage': name, 'time': now-self.created})
+
+    def StageStop(self, name):
+        now = time.perf_counter()
+        start = self.started.pop(name)
+        stage = {'stage': name, 'start': start-self.created, 'duration': now-start}
+        self.stages.append(stage)
+        if self.event_callback:
+            self.event_callback(dict(stage, event='stop', time=now-self.created))
+
+    # Starts counting the warnings and the profilers asked for; calls may nest,
+    # as Danmaku2ASS captures around ReadComments which captures on its own
+    def StartCapture(self):
+        self.capturing += 1
+        if self.capturing > 1:
+            return
+        self.log_filter = InvalidCommentCounter(self)
+        logging.getLogger().addFilter(self.log_filter)
+        if self.trace_memory:
+            import tracemalloc
+            self.memory_started = not tracemalloc.is_tracing()
+            if self.memory_started:
+                tracemalloc.start()
+        if self.profile:
+            import cProfile
+            self.profiler = cProfile.Profile()
+            self.profiler.enable()
+
+    def StopCapture(self):
+        self.capturing -= 1
+        if self.capturing > 0:
+            return
+        logging.getLogger().removeFilter(self.log_filter)
+        self.log_filter = None
+        if self.profiler:
+            self.profiler.disable()
+            import pstats
+            # pstats keys functions by (file, line, name), with (primitive calls, calls, own time, cumulative time, callers)
+            entries = sorted(pstats.Stats(self.profiler).stats.items(), key=lambda i: i[1][3], reverse=True)[:self.ReportLimit]
+            self.profile_result = [{'function': '%s:%d(%s)' % key, 'calls': value[1], 'time': value[2], 'cumulative_time': value[3]} for key, value in entries]
+            self.profiler = None
+        if self.trace_memory:
+            import tracemalloc
+            if tracemalloc.is_tracing():
+                top = tracemalloc.take_snapshot().statistics('lineno')[:self.ReportLimit]
+                self.memory_result = {'peak': tracemalloc.get_traced_memory()[1], 'top': [{'line': str(i.traceback[0]), 'size': i.size, 'count': i.count} for i in top]}
+            if self.memory_started:
+                tracemalloc.stop()
+                self.memory_started = False
+
+    # Result: a JSON-serializable dict of everything recorded
+    def Report(self):
+        report = {'stages': list(self.stages), 'timers': dict(self.timers), 'counters': dict(self.counters)}
+        if self.profile_result is not None:
+            report['profile'] = self.profile_result
+        if self.memory_result is not None:
+            report['memory'] = self.memory_result
+        return report
+
+    def WriteReport(self, filename):
+        with open(filename, 'w', encoding='utf-8') as f:
+            json.dump(self.Report(), f, indent=2, sort_keys=True)
+
+
+class InvalidCommentCounter(logging.Filter):
+    # Counts the "Invalid comment" warnings of the thread capturing, without
+    # filtering anything out
+    def __init__(self, stats):
+        super().__init__()
+        self.stats = stats
+        self.thread = threading.get_ident()
+        self.prefixes = tuple(_(i).split('%', 1)[0] for i in ('Invalid comment: %s', 'Invalid comment: %r'))
+
+    def filter(self, record):
+        if record.thread == self.thread and isinstance(record.msg, str) and record.msg.startswith(self.prefixes):
+            self.stats.Count('invalid_comments')
+        return True
+
+
+class safe_list(list):
+    def get(self, index, default=None):
+        try:
+            return self[index]
+        except IndexError:
+            return default
+
+
+@export
+def Danmaku2ASS(input_files, output_file, stage_width, stage_height, reserve_blank=0, font_face=_('(FONT) sans-serif')[7:], font_size=25.0, text_opacity=1.0, duration_marquee=5.0, duration_still=5.0, is_reduce_comments=False, progress_callback=None, layout_engine='interval', stream_window=None, window_callback=None, jobs=1, exact_layout=True, use_mmap=False, width_model='length', font_file=None, comment_filter=None, stats=None):
+    if stats:
+        stats.StartCapture()
+    try:
+        width_model = GetTextWidthModel(width_model, font_file)
+        comments = ReadComments(input_files, font_size, use_mmap=use_mmap, width_model=width_model, stats=stats)
+        if comment_filter:
+            if stats:
+                stats.StageStart('filter')
+            count = len(comments)
+            comments = comment_filter.Apply(comments, width_model)
+            if stats:
+                stats.Count('comments_filtered', count-len(comments))
+                stats.StageStop('filter')
+        WriteASS(comments, output_file, stage_width, stage_height, reserve_blank, font_face, font_size, text_opacity, duration_marquee, duration_still, is_reduce_comments, progress_callback, layout_engine, stream_window, window_callback, jobs, exact_layout, stats)
+        return len(comments)
+    finally:
+        if stats:
+            stats.StopCapture()
+
+
+# Same as Danmaku2ASS, but renders one output file for each (width, height) in
+# stage_sizes, parsing and sorting the input only once. With jobs > 1 the
+# layouts run concurrently in a process pool.
+@export
+def Danmaku2ASSMultiStage(input_files, output_files, stage_sizes, reserve_blank=0, font_face=_('(FONT) sans-serif')[7:], font_size=25.0, text_opacity=1.0, duration_marquee=5.0, duration_still=5.0, is_reduce_comments=False, layout_engine='interval', jobs=1, use_mmap=False, width_model='length', font_file=None, comment_filter=None):
+    if len(output_files) != len(stage_sizes):
+        raise ValueError(_('Expected %d output files, got %d') % (len(stage_sizes), len(output_files)))
+    width_model = GetTextWidthModel(width_model, font_file)
+    comments = ReadComments(input_files, font_size, use_mmap=use_mmap, width_model=width_model)
+    if comment_filter:
+        comments = comment_filter.Apply(comments, width_model)
+    tasks = [(comments, output_file, stage_width, stage_height, reserve_blank, font_face, font_size, text_opacity, duration_marquee, duration_still, is_reduce_comments, None, layout_engine) for output_file, (stage_width, stage_height) in zip(output_files, stage_sizes)]
+    if jobs > 1 and len(tasks) > 1:
+        import concurrent.futures
+        with concurrent.futures.ProcessPoolExecutor(max_workers=min(jobs, len(tasks))) as executor:
+            for future in [executor.submit(WriteASS, *task) for task in tasks]:
+                future.result()
+    else:
+        for task in tasks:
+            WriteASS(*task)
+    return len(comments)
+
+
+# Converts every input file on its own into output_dir, skipping the files
+# whose outputs are up to date, and reports failures without stopping.
+#
+# input_paths may be files, directories (searched recursively) or glob
+# patterns. With skip='mtime', an output is up to date when it is newer than
+# its input; with skip='hash', when the input content and the conversion
+# parameters match those recorded in output_dir by the previous run.
+#
+# Result: (converted, skipped, failed)
+@export
+def Danmaku2ASSBatch(input_paths, output_dir, stage_sizes, reserve_blank=0, font_face=_('(FONT) sans-serif')[7:], font_size=25.0, text_opacity=1.0, duration_marquee=5.0, duration_still=5.0, is_reduce_comments=False, layout_engine='interval', jobs=1, skip='mtime', use_mmap=False, width_model='length', font_file=None, comment_filter=None):
+    import concurrent.futures
+    import hashlib
+    conversion_args = (reserve_blank, font_face, font_size, text_opacity, duration_marquee, duration_still, is_reduce_comments)
+    conversion_kwargs = {'layout_engine': layout_engine, 'use_mmap': use_mmap, 'width_model': width_model, 'font_file': font_file, 'comment_filter': comment_filter}
+    GetTextWidthModel(width_model, font_file)  # Fail early on a bad model or font file
+    params_digest = hashlib.sha1(json.dumps([stage_sizes, conversion_args, layout_engine, width_model, font_file, comment_filter.Describe() if comment_filter else None]).encode('utf-8')).hexdigest() if skip == 'hash' else None
+    manifest_file = os.path.join(output_dir, BatchManifestName)
+    manifest = LoadBatchManifest(manifest_file) if skip == 'hash' else {}
+    inputs = [(input_file, os.path.splitext(output_name)[0]+'.ass') for input_file, output_name in ExpandInputPaths(input_paths, output_dir)]
+    input_files = collections.defaultdict(list)
+    for input_file, manifest_key in inputs:
+        input_files[manifest_key].append(input_file)
+    duplicates = ['%s (%s)' % (manifest_key, ', '.join(files)) for manifest_key, files in input_files.items() if len(files) > 1]
+    if duplicates:
+        raise ValueError(_('Several input files would be converted to the same output file: %s') % '; '.join(duplicates))
+    tasks = []
+    manifest_keys = []
+    skipped = 0
+    for input_file, manifest_key in inputs:
+        output_name = os.path.join(output_dir, manifest_key)
+        output_files = [output_name] if len(stage_sizes) == 1 else [GetStageOutputName(output_name, width, height) for width, height in stage_sizes]
+        if skip == 'mtime' and IsOutputNewer(input_file, output_files):
+            skipped += 1
+            continue
+        tasks.append((input_file, output_files, stage_sizes, conversion_args, conversion_kwargs, params_digest, manifest.get(manifest_key)))
+        manifest_keys.append(manifest_key)
+    converted, failed, total_comments = 0, 0, 0
+    start_time = time.time()
+    if jobs > 1 and len(tasks) > 1:
+        executor = concurrent.futures.ProcessPoolExecutor(max_workers=jobs)
+        results = executor.map(ConvertBatchFile, tasks, chunksize=max(1, min(64, len(tasks)//(jobs*4))))
+    else:
+        executor = None
+        results = map(ConvertBatchFile, tasks)
     try:
-        if output_file:
-            fo = ConvertToFile(output_file, 'w', encoding='utf-8-sig', errors='replace', newline='\r\n')
+        for task, manifest_key, (comment_count, digest, error) in zip(tasks, manifest_keys, results):
+            if error:
+                failed += 1
+                logging.error(_('Failed to convert %s: %s') % (task[0], error))
+            elif comment_count is None:
+                skipped += 1
+            else:
+                converted += 1
+                total_comments += comment_count
+            if digest:
+                manifest[manifest_key] = digest
+    finally:
+        if executor:
+            executor.shutdown()
+        if skip == 'hash':
+            SaveBatchManifest(manifest_file, manifest)
+    elapsed = max(time.time()-start_time, 1e-6)
+    logging.info(_('Converted %d files (%d skipped, %d failed) with %d comments in %.2fs: %.1f files/s, %.0f comments/s') % (converted, skipped, failed, total_comments, elapsed, converted/elapsed, total_comments/elapsed))
+    return converted, skipped, failed
+
+
+BatchManifestName = '.danmaku2ass-batch.json'
+
+
+# Result: [(input_file, output_name relative to the output directory)], where
+#         directories and glob patterns only give the comment files they hold,
+#         leaving out exclude_dir, and keep their paths below the directory or
+#         the fixed part of the pattern
+def ExpandInputPaths(input_paths, exclude_dir=None):
+    exclude_dir = os.path.realpath(exclude_dir) if exclude_dir else None
+    res = []
+    for path in input_paths:
+        if os.path.isdir(path):
+            for dirpath, dirnames, filenames in os.walk(path):
+                dirnames[:] = sorted(i for i in dirnames if os.path.realpath(os.path.join(dirpath, i)) != exclude_dir)
+                for filename in sorted(filenames):
+                    input_file = os.path.join(dirpath, filename)
+                    if IsCommentFile(input_file):
+                        res.append((input_file, os.path.relpath(input_file, path)))
+        elif os.path.exists(path):
+            res.append((path, os.path.basename(path)))
         else:
+            base = GetGlobBase(path)
+            res.extend((input_file, os.path.relpath(input_file, base)) for input_file in sorted(glob.glob(path)) if os.path.isfile(input_file) and IsCommentFile(input_file))
+    return res
+
+
+# Result: the longest leading directory of a glob pattern without wildcards
+def GetGlobBase(pattern):
+    base = os.path.dirname(pattern)
+    while glob.escape(base) != base:
+        base = os.path.dirname(base)
+    return base or os.curdir
+
+
+def IsCommentFile(input_file):
+    try:
+        with open(input_file, 'rb') as f:
+            return ProbeCommentFormatBuffer(f.read(ProbePrefixLength*4)) is not None
+    except OSError:
+        return False
+
+
+def IsOutputNewer(input_file, output_files):
+    try:
+        input_mtime = os.path.getmtime(input_file)
+        return all(os.path.getmtime(output_file) >= input_mtime for output_file in output_files)
+    except OSError:
+        return False
+
+
+# Runs in a worker process
+# Result: (comment_count or None if skipped, digest to record, error message)
+def ConvertBatchFile(task):
+    input_file, output_files, stage_sizes, conversion_args, conversion_kwargs, params_digest, recorded_digest = task
+    try:
+        digest = None
+        if params_digest:
+            digest = '%s-%s' % (HashCommentFile(input_file, conversion_kwargs['use_mmap']), params_digest)
+            if digest == recorded_digest and all(os.path.exists(output_file) for output_file in output_files):
+                return None, digest, None
+        for output_file in output_files:
+            os.makedirs(os.path.dirname(output_file) or '.', exist_ok=True)
+        if len(stage_sizes) == 1:
+            comment_count = Danmaku2ASS([input_file], output_files[0], stage_sizes[0][0], stage_sizes[0][1], *conversion_args, **conversion_kwargs)
+        else:
+            comment_count = Danmaku2ASSMultiStage([input_file], output_files, stage_sizes, *conversion_args, **conversion_kwargs)
+        return comment_count, digest, None
+    except Exception as e:
+        return None, None, '%s: %s' % (type(e).__name__, e)
+
+
+def HashCommentFile(input_file, use_mmap=False):
+    import hashlib
+    mapped = MapCommentFile(input_file) if use_mmap else None
+    if mapped is None:
+        with open(input_file, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    try:
+        return hashlib.sha1(mapped).hexdigest()
+    finally:
+        mapped.close()
+
+
+def LoadBatchManifest(manifest_file):
+    try:
+        with open(manifest_file, 'r', encoding='utf-8') as f:
+            return dict(json.load(f))
+    except (OSError, ValueError, TypeError):
+        return {}
+
+
+def SaveBatchManifest(manifest_file, manifest):
+    os.makedirs(os.path.dirname(manifest_file) or '.', exist_ok=True)
+    with open(manifest_file+'.tmp', 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, sort_keys=True)
+    os.replace(manifest_file+'.tmp', manifest_file)
+
+
+def WriteASS(comments, output_file, stage_width, stage_height, reserve_blank, font_face, font_size, text_opacity, duration_marquee, duration_still, is_reduce_comments, progress_callback, layout_engine, stream_window=None, window_callback=None, jobs=1, exact_layout=True, stats=None):
+    fo = None
+    if stats:
+        stats.StageStart('convert')
+    try:
+        if not output_file:
             fo = sys.stdout
-        ProcessComments(comments, fo, stage_width, stage_height, reserve_blank, font_face, font_size, text_opacity, duration_marquee, duration_still, is_reduce_comments, progress_callback)
+        elif IsBinaryFile(output_file):
+            fo = ASSWriter(output_file, close_file=False, stats=stats)
+        else:
+            fo = ConvertToFile(output_file, 'wb')
+            fo = ASSWriter(fo, stats=stats) if fo is not output_file else fo
+        ProcessComments(comments, fo, stage_width, stage_height, reserve_blank, font_face, font_size, text_opacity, duration_marquee, duration_still, is_reduce_comments, progress_callback, layout_engine, stream_window, window_callback, jobs, exact_layout, stats)
     finally:
-        if output_file and fo != output_file:
+        if output_file and fo is not None and fo is not output_file:
             fo.close()
+        if stats:
+            stats.StageStop('convert')
 
 
 @export
-def ReadComments(input_files, font_size=25.0, progress_callback=None):
+def ReadComments(input_files, font_size=25.0, progress_callback=None, use_mmap=False, width_model=None, stats=None):
     if isinstance(input_files, bytes):
         input_files = str(bytes(input_files).decode('utf-8', 'replace'))
     if isinstance(input_files, str):
         input_files = [input_files]
     else:
         input_files = list(input_files)
-    comments = []
-    for idx, i in enumerate(input_files):
+    if stats:
+        stats.StartCapture()
+    try:
+        if stats:
+            stats.StageStart('read')
+        comments = CommentTable()
+        for idx, i in enumerate(input_files):
+            if progress_callback:
+                progress_callback(idx, len(input_files))
+            if IsCommentBuffer(i):
+                ReadCommentBuffer(comments, i, _('(data in memory)'), font_size)
+                continue
+            if use_mmap and isinstance(i, (str, bytes)):
+                mapped = MapCommentFile(i)
+                if mapped is not None:
+                    try:
+                        ReadCommentBuffer(comments, mapped, i, font_size)
+                    finally:
+                        mapped.close()
+                    continue
+            with ConvertToFile(i, 'r', encoding='utf-8', errors='replace') as f:
+                CommentProcessor = GetCommentProcessor(f)
+                if not CommentProcessor:
+                    raise ValueError(_('Unknown comment file format: %s') % i)
+                comments.Extend(CommentProcessor(FilterBadChars(f), font_size))
         if progress_callback:
-            progress_callback(idx, len(input_files))
-        with ConvertToFile(i, 'r', encoding='utf-8', errors='replace') as f:
-            CommentProcessor = GetCommentProcessor(f)
-            if not CommentProcessor:
-                raise ValueError(_('Unknown comment file format: %s') % i)
-            comments.extend(CommentProcessor(FilterBadChars(f), font_size))
-    if progress_callback:
-        progress_callback(len(input_files), len(input_files))
-    comments.sort()
-    return comments
+            progress_callback(len(input_files), len(input_files))
+        if stats:
+            stats.StageStop('read')
+            stats.Count('comments_read', len(comments))
+        if width_model is not None:
+            if stats:
+                stats.StageStart('measure')
+            comments.Measure(width_model)
+            if stats:
+                stats.StageStop('measure')
+        if stats:
+            stats.StageStart('sort')
+        comments.Sort()
+        if stats:
+            stats.StageStop('sort')
+        return comments
+    finally:
+        if stats:
+            stats.StopCapture()
+
+
+def ReadCommentBuffer(comments, data, name, font_size):
+    CommentProcessor = CommentFormatMap[ProbeCommentFormatBuffer(data)]
+    if not CommentProcessor:
+        raise ValueError(_('Unknown comment file format: %s') % name)
+    with OpenCommentBuffer(data) as f:
+        comments.Extend(CommentProcessor(FilterBadChars(f), font_size))
+
+
+# Maps a comment file into memory, so that the conversions reading the same
+# file at once share its pages in the OS page cache
+#
+# Result: an mmap, or None if the file cannot be mapped (e.g. it is empty
+#         or a pipe)
+def MapCommentFile(filename):
+    if isinstance(filename, bytes):
+        filename = str(bytes(filename).decode('utf-8', 'replace'))
+    with open(filename, 'rb') as f:
+        try:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return None
+    if hasattr(mapped, 'madvise'):
+        mapped.madvise(mmap.MADV_SEQUENTIAL)
+    return mapped
+
+
+# 'length' keeps the estimate of the readers, see CalculateLength
+TextWidthModelMap = {'length': None, 'eastasian': EastAsianWidthModel}
+
+
+# Result: the TextWidthModel for a name in TextWidthModelMap, or for the font
+#         file if given, or None to keep the estimate of the readers
+@export
+@functools.lru_cache(maxsize=8)
+def GetTextWidthModel(width_model='length', font_file=None):
+    if font_file:
+        return FontWidthModel(font_file)
+    try:
+        WidthModelClass = TextWidthModelMap[width_model]
+    except KeyError:
+        raise ValueError(_('Unknown width model: %s') % width_model) from None
+    return WidthModelClass() if WidthModelClass else None
 
 
 @export
@@ -837,13 +2599,28 @@ def GetCommentProcessor(input_file):
     return CommentFormatMap[ProbeCommentFormat(input_file)]
 
 
+def ParseStageSize(size):
+    try:
+        width, height = str(size).split('x', 1)
+        return int(width), int(height)
+    except ValueError:
+        raise ValueError(_('Invalid stage size: %r') % size)
+
+
+# Result: output.ass -> output.1280x720.ass
+def GetStageOutputName(output_file, width, height):
+    root, ext = os.path.splitext(output_file)
+    return '%s.%dx%d%s' % (root, width, height, ext)
+
+
 def main():
+    import argparse
     logging.basicConfig(format='%(levelname)s: %(message)s')
     if len(sys.argv) == 1:
         sys.argv.append('--help')
     parser = argparse.ArgumentParser()
     parser.add_argument('-o', '--output', metavar=_('OUTPUT'), help=_('Output file'))
-    parser.add_argument('-s', '--size', metavar=_('WIDTHxHEIGHT'), required=True, help=_('Stage size in pixels'))
+    parser.add_argument('-s', '--size', metavar=_('WIDTHxHEIGHT'), required=True, help=_('Stage size in pixels, separate several sizes with commas to render one output for each'))
     parser.add_argument('-fn', '--font', metavar=_('FONT'), help=_('Specify font face [default: %s]') % _('(FONT) sans-serif')[7:], default=_('(FONT) sans-serif')[7:])
     parser.add_argument('-fs', '--fontsize', metavar=_('SIZE'), help=(_('Default font size [default: %s]') % 25), type=float, default=25.0)
     parser.add_argument('-a', '--alpha', metavar=_('ALPHA'), help=_('Text opacity'), type=float, default=1.0)
@@ -851,15 +2628,45 @@ def main():
     parser.add_argument('-ds', '--duration-still', metavar=_('SECONDS'), help=_('Duration of still comment display [default: %s]') % 5, type=float, default=5.0)
     parser.add_argument('-p', '--protect', metavar=_('HEIGHT'), help=_('Reserve blank on the bottom of the stage'), type=int, default=0)
     parser.add_argument('-r', '--reduce', action='store_true', help=_('Reduce the amount of comments if stage is full'))
+    parser.add_argument('--layout', metavar=_('ENGINE'), help=_('Layout engine, one of %s [default: %s]') % (', '.join(sorted(LayoutEngineMap)), 'interval'), choices=sorted(LayoutEngineMap), default='interval')
+    parser.add_argument('-w', '--stream-window', metavar=_('SECONDS'), help=_('Flush the output every time this much of the timeline has been converted'), type=float)
+    parser.add_argument('-j', '--jobs', metavar=_('JOBS'), help=_('Number of worker processes [default: %s]') % 1, type=int, default=1)
+    parser.add_argument('--approximate-layout', action='store_true', help=_('With several jobs for a single output, only check the comments on the stage against the sequential layout at each checkpoint; after the stage was full, comments may take other rows for up to one comment duration'))
+    parser.add_argument('--width-model', metavar=_('MODEL'), help=_('How to estimate the width of comments, one of %s [default: %s]') % (', '.join(sorted(TextWidthModelMap)), 'length'), choices=sorted(TextWidthModelMap), default='length')
+    parser.add_argument('--font-file', metavar=_('FILE'), help=_('Measure comments with the glyph widths of this TrueType or OpenType font'))
+    parser.add_argument('--max-density', metavar=_('COUNT'), help=_('Keep at most this many comments starting within the duration of a scrolling comment'), type=int)
+    parser.add_argument('--merge-window', metavar=_('SECONDS'), help=_('Merge comments repeating an earlier one within this many seconds into it, with a counter'), type=float)
+    parser.add_argument('--blocklist', metavar=_('FILE'), help=_('Drop comments containing any keyword in this file, one on each line, or matching a regular expression written as /pattern/'))
+    parser.add_argument('--mmap', action='store_true', help=_('Map input files into memory instead of reading them, sharing their pages between conversions'))
+    parser.add_argument('--report', metavar=_('FILE'), help=_('Write the stage timings and counters of the conversion to this JSON file'))
+    parser.add_argument('--profile', action='store_true', help=_('With --report, also profile the conversion with cProfile and tracemalloc'))
+    parser.add_argument('-B', '--batch-output', metavar=_('DIRECTORY'), help=_('Convert each input file, directory or glob pattern on its own into this directory'))
+    parser.add_argument('--batch-skip', metavar=_('CHECK'), help=_('How to tell that a batch output is up to date, one of mtime, hash [default: %s]') % 'mtime', choices=['mtime', 'hash'], default='mtime')
     parser.add_argument('file', metavar=_('FILE'), nargs='+', help=_('Comment file to be processed'))
     args = parser.parse_args()
-    try:
-        width, height = str(args.size).split('x', 1)
-        width = int(width)
-        height = int(height)
-    except ValueError:
-        raise ValueError(_('Invalid stage size: %r') % args.size)
-    Danmaku2ASS(args.file, args.output, width, height, args.protect, args.font, args.fontsize, args.alpha, args.duration_marquee, args.duration_still, args.reduce)
+    stage_sizes = [ParseStageSize(i) for i in str(args.size).split(',')]
+    comment_filter = None
+    if args.max_density is not None or args.merge_window is not None or args.blocklist:
+        comment_filter = CommentFilter(args.max_density, args.duration_marquee, args.merge_window, ReadBlocklist(args.blocklist) if args.blocklist else None)
+    if args.report and (args.batch_output or len(stage_sizes) > 1):
+        raise ValueError(_('A report can only be written for a single stage size'))
+    if args.batch_output:
+        logging.getLogger().setLevel(logging.INFO)
+        converted, skipped, failed = Danmaku2ASSBatch(args.file, args.batch_output, stage_sizes, args.protect, args.font, args.fontsize, args.alpha, args.duration_marquee, args.duration_still, args.reduce, layout_engine=args.layout, jobs=args.jobs, skip=args.batch_skip, use_mmap=args.mmap, width_model=args.width_model, font_file=args.font_file, comment_filter=comment_filter)
+        if failed:
+            sys.exit(1)
+        return
+    if len(stage_sizes) > 1:
+        if not args.output:
+            raise ValueError(_('An output file is required to render several stage sizes'))
+        output_files = [GetStageOutputName(args.output, width, height) for width, height in stage_sizes]
+        Danmaku2ASSMultiStage(args.file, output_files, stage_sizes, args.protect, args.font, args.fontsize, args.alpha, args.duration_marquee, args.duration_still, args.reduce, layout_engine=args.layout, jobs=args.jobs, use_mmap=args.mmap, width_model=args.width_model, font_file=args.font_file, comment_filter=comment_filter)
+        return
+    width, height = stage_sizes[0]
+    stats = ConversionStats(profile=args.profile, trace_memory=args.profile) if args.report else None
+    Danmaku2ASS(args.file, args.output, width, height, args.protect, args.font, args.fontsize, args.alpha, args.duration_marquee, args.duration_still, args.reduce, layout_engine=args.layout, stream_window=args.stream_window, jobs=args.jobs, exact_layout=not args.approximate_layout, use_mmap=args.mmap, width_model=args.width_model, font_file=args.font_file, comment_filter=comment_filter, stats=stats)
+    if stats:
+        stats.WriteReport(args.report)
 
 
 if __name__ == '__main__':
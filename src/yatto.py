@@ -1,75 +1,516 @@
 import argparse
 import math
+import os
 import re
 import logging
 import json
 import subprocess
-import io
 import tempfile
+import threading
+import time
+import socket
+import socketserver
+import stat
+import concurrent.futures
 
-from pip._vendor.requests.packages import chardet
-
-import danmaku2ass
+# danmaku2ass, chardet, hashlib, asyncio and the HTTP client modules are
+# imported by the stages using them, so that runs not needing them, such as -i
+# or those handed over to the daemon, start faster
 import traceback
-import urllib.request as urllib2
+import urllib.error
 import urllib.parse
 import zlib
 
 DEFAULT_USER_AGENT = "Mozilla/5.0 (Windows NT 10.0) AppleWebKit/537.36 (KHTML, \
                       like Gecko) Chrome/47.0.2526.106 Safari/537.36"
 
+DANMAKU_SEGMENT_JOBS = 8
+DANMAKU_SEGMENT_RETRIES = 3
+DANMAKU_SEGMENT_BACKOFF = 0.5
+
+DANMAKU_STREAM_WINDOW = 60
+
+HTTP_TIMEOUT = 60
+HTTP_CACHE_MAX_SIZE = 64 * 1024 * 1024
+
+RESOLUTION_CACHE_TTL = 3600
+RESOLUTION_CACHE_MAX_SIZE = 4 * 1024 * 1024
+
+ASS_CACHE_MAX_SIZE = 256 * 1024 * 1024
+ASS_CACHE_VERSION = 1  # Bump when the conversion output changes
+
+MPV_IPC_TIMEOUT = 30
+
+DAEMON_PREFETCH_JOBS = 2
+DAEMON_PROBE_TIMEOUT = 1
+
+ASYNC_SITE_PREPARES = 4
+ASYNC_HOST_CONNECTIONS = 8
+ASYNC_PROCESS_JOBS = 8
+ASYNC_PROCESS_TERMINATE_TIMEOUT = 2
+
 logger = logging.getLogger(__name__)
 
 
-def simply_get_url(url):
-    request = urllib2.Request(url)
-    request.add_header('User-Agent', DEFAULT_USER_AGENT)
-
-    response = urllib2.urlopen(request)
-
-    content_encoding = response.getheader('Content-Encoding')
-    raw_data = response.read()
-    if content_encoding == 'gzip' or raw_data.startswith(b'\x1F\x8B'):
-        return zlib.decompress(raw_data, 16 + zlib.MAX_WBITS)
-    elif content_encoding == 'deflate':
-        decompressobj = zlib.decompressobj(-zlib.MAX_WBITS)
-        return decompressobj.decompress(raw_data) + decompressobj.flush()
+def get_cache_dir():
+    if os.name == 'nt':
+        base = os.environ.get('LOCALAPPDATA') or tempfile.gettempdir()
     else:
-        return raw_data
+        base = os.environ.get('XDG_CACHE_HOME') or os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'yatto')
+
+
+# A directory of files named by key, evicted least recently used first once
+# their total size exceeds max_size. Files are written under a temporary name
+# and renamed into place, so readers never see a partial entry.
+class FileCache:
+    STALE_TEMP_SECONDS = 24 * 3600
+
+    def __init__(self, name, max_size):
+        self.name = name
+        self.directory = os.path.join(get_cache_dir(), name)
+        self.max_size = max_size
+        self.enabled = True
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+
+    def path(self, key):
+        return os.path.join(self.directory, key)
+
+    # Result: the path of the entry, or None on a miss or if the cache is
+    # disabled, in which case entries are still written but never read back
+    def get(self, key):
+        if not self.enabled:
+            return None
+        path = self.path(key)
+        try:
+            os.utime(path)  # Mark as recently used
+        except OSError:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return path
+
+    def invalidate(self, key):
+        try:
+            os.remove(self.path(key))
+            self.invalidations += 1
+        except OSError:
+            pass
+
+    def stats(self):
+        return '{} {} hits, {} misses, {} invalidated'.format(self.name, self.hits, self.misses, self.invalidations)
+
+    def new_temp_file(self, **kwargs):
+        os.makedirs(self.directory, exist_ok=True)
+        kwargs.setdefault('prefix', 'tmp-')
+        if not kwargs['prefix'].startswith('tmp-'):
+            kwargs['prefix'] = 'tmp-' + kwargs['prefix']
+        return tempfile.NamedTemporaryFile(dir=self.directory, delete=False, **kwargs)
+
+    def commit(self, key, temp_path):
+        path = self.path(key)
+        os.replace(temp_path, path)
+        self.evict(keep=path)
+        return path
+
+    def evict(self, keep=None):
+        entries = []
+        total_size = 0
+        now = time.time()
+        for entry in os.scandir(self.directory):
+            try:
+                entry_stat = entry.stat()
+                if entry.name.startswith('tmp-'):
+                    if now - entry_stat.st_mtime > self.STALE_TEMP_SECONDS:
+                        os.remove(entry.path)  # Left behind by an interrupted run
+                    continue
+            except OSError:
+                continue
+            entries.append((entry_stat.st_mtime, entry_stat.st_size, entry.path))
+            total_size += entry_stat.st_size
+        entries.sort()
+        for mtime, size, path in entries:
+            if total_size <= self.max_size:
+                break
+            if path == keep:
+                continue
+            try:
+                os.remove(path)
+                total_size -= size
+            except OSError:
+                pass
+
+
+ass_cache = FileCache('ass', ASS_CACHE_MAX_SIZE)
+
+
+# Result: (expires, must_store), expires being the time until which the
+# response may be used without revalidation
+def get_cache_lifetime(headers, now):
+    cache_control = [i.strip().lower() for i in (headers.get('Cache-Control') or '').split(',')]
+    if 'no-store' in cache_control:
+        return 0, False
+    has_validator = bool(headers.get('ETag') or headers.get('Last-Modified'))
+    if 'no-cache' in cache_control:
+        return 0, has_validator
+    for directive in cache_control:
+        if directive.startswith('max-age='):
+            try:
+                max_age = int(directive[8:]) - int(headers.get('Age') or 0)
+            except ValueError:
+                break
+            return now + max_age, max_age > 0 or has_validator
+    if headers.get('Expires'):
+        import email.utils
+        try:
+            expires = email.utils.parsedate_to_datetime(headers['Expires']).timestamp()
+            return expires, expires > now or has_validator
+        except (TypeError, ValueError):
+            return 0, has_validator
+    return 0, has_validator
+
+
+# Decompresses a response body while reading it instead of after the whole body
+# has arrived
+class BodyDecoder:
+    def __init__(self, content_encoding):
+        self.content_encoding = content_encoding
+        self.decompressobj = None
+        self.chunks = []
+
+    def feed(self, chunk):
+        if not self.chunks and self.decompressobj is None:
+            if self.content_encoding == 'gzip' or chunk.startswith(b'\x1F\x8B'):
+                self.decompressobj = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            elif self.content_encoding == 'deflate':
+                self.decompressobj = zlib.decompressobj(-zlib.MAX_WBITS)
+        self.chunks.append(self.decompressobj.decompress(chunk) if self.decompressobj else chunk)
+
+    def finish(self):
+        if self.decompressobj:
+            self.chunks.append(self.decompressobj.flush())
+        return b''.join(self.chunks)
+
+
+# Keeps a pool of keep-alive connections per host, and optionally an on-disk
+# response cache honoring Cache-Control, ETag and Last-Modified
+class HttpClient:
+    MAX_REDIRECTS = 10
+    REDIRECT_STATUS = (301, 302, 303, 307, 308)
+    READ_SIZE = 64 * 1024
+
+    def __init__(self, cache=None, timeout=HTTP_TIMEOUT):
+        self.cache = cache
+        self.timeout = timeout
+        self.pool = {}
+        self.lock = threading.Lock()
+
+    def get(self, url):
+        now = time.time()
+        cache_key, cached, headers = self.prepare_get(url, now)
+        if cached and cached[0]['expires'] > now:
+            logger.debug('HTTP cache hit {}'.format(url))
+            return cached[1]
+        response, body = self.request('GET', url, headers)
+        return self.finish_get(url, now, cache_key, cached, response, body)
+
+    # Result: (cache_key, (meta, body) of the cached response or None, request
+    # headers), shared with AsyncHttpClient like finish_get
+    def prepare_get(self, url, now):
+        import hashlib
+        cache_key = hashlib.sha256(url.encode('utf-8')).hexdigest() + '.http' if self.cache else None
+        cached = self.load_cached(cache_key) if cache_key else None
+        headers = {'User-Agent': DEFAULT_USER_AGENT, 'Accept-Encoding': 'gzip'}
+        if cached:
+            meta = cached[0]
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+        return cache_key, cached, headers
+
+    def finish_get(self, url, now, cache_key, cached, response, body):
+        if response.status == 304 and cached:
+            meta, cached_body = cached
+            logger.debug('HTTP cache revalidated {}'.format(url))
+            meta['expires'] = get_cache_lifetime(response.headers, now)[0]
+            self.store(cache_key, meta, cached_body)
+            return cached_body
+        if response.status >= 400:
+            raise urllib.error.HTTPError(url, response.status, response.reason, response.headers, None)
+        if cache_key:
+            expires, must_store = get_cache_lifetime(response.headers, now)
+            if must_store:
+                self.store(cache_key, {'url': url, 'expires': expires, 'etag': response.headers.get('ETag'),
+                                       'last_modified': response.headers.get('Last-Modified')}, body)
+        return body
+
+    def head(self, url):
+        response, body = self.request('HEAD', url, {'User-Agent': DEFAULT_USER_AGENT})
+        return response.status
+
+    def request(self, method, url, headers):
+        import urllib.request as urllib2
+        for i in range(self.MAX_REDIRECTS + 1):
+            parts = urllib.parse.urlsplit(url)
+            if urllib2.getproxies().get(parts.scheme) and not urllib2.proxy_bypass(parts.hostname):
+                return self.request_via_proxy(method, url, headers)
+            response, body = self.send(parts, method, headers)
+            redirect = self.get_redirect(url, method, response)
+            if not redirect:
+                return response, body
+            url, method = redirect
+        raise urllib.error.HTTPError(url, response.status, 'Too many redirects', response.headers, None)
+
+    # Result: (url, method) of the request to follow the response with, or None
+    def get_redirect(self, url, method, response):
+        location = response.headers.get('Location')
+        if response.status not in self.REDIRECT_STATUS or not location:
+            return None
+        return urllib.parse.urljoin(url, location), 'GET' if response.status == 303 else method
+
+    def send(self, parts, method, headers):
+        import http.client
+        pool_key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        for attempt in range(2):
+            connection, reused = self.acquire(pool_key)
+            try:
+                connection.request(method, path, headers=headers)
+                response = connection.getresponse()
+                body = self.read_body(response) if method != 'HEAD' else b''
+            except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                connection.close()
+                # The server may have dropped an idle connection, retry once with a new one
+                if reused and not attempt:
+                    continue
+                raise
+            except Exception:
+                connection.close()
+                raise
+            if response.will_close:
+                connection.close()
+            else:
+                self.release(pool_key, connection)
+            return response, body
+
+    def acquire(self, pool_key):
+        import http.client
+        with self.lock:
+            idle = self.pool.get(pool_key)
+            if idle:
+                return idle.pop(), True
+        scheme, host, port = pool_key
+        if scheme == 'https':
+            return http.client.HTTPSConnection(host, port, timeout=self.timeout), False
+        return http.client.HTTPConnection(host, port, timeout=self.timeout), False
+
+    def release(self, pool_key, connection):
+        with self.lock:
+            self.pool.setdefault(pool_key, []).append(connection)
+
+    def close(self):
+        with self.lock:
+            for idle in self.pool.values():
+                for connection in idle:
+                    connection.close()
+            self.pool.clear()
+
+    def read_body(self, response):
+        decoder = BodyDecoder(response.headers.get('Content-Encoding'))
+        while True:
+            chunk = response.read(self.READ_SIZE)
+            if not chunk:
+                break
+            decoder.feed(chunk)
+        return decoder.finish()
+
+    def request_via_proxy(self, method, url, headers):
+        # http.client knows nothing about proxies, let urllib deal with them
+        import urllib.request as urllib2
+        request = urllib2.Request(url, headers=headers, method=method)
+        try:
+            response = urllib2.urlopen(request, timeout=self.timeout)
+        except urllib.error.HTTPError as e:
+            if e.code != 304:
+                raise
+            response = e
+        return response, self.read_body(response) if method != 'HEAD' else b''
+
+    def load_cached(self, cache_key):
+        path = self.cache.get(cache_key)
+        if not path:
+            return None
+        try:
+            with open(path, 'rb') as f:
+                meta = json.loads(f.readline().decode('utf-8'))
+                return meta, f.read()
+        except (OSError, ValueError):
+            return None
+
+    def store(self, cache_key, meta, body):
+        try:
+            with self.cache.new_temp_file(mode='wb', suffix='.http') as f:
+                f.write(json.dumps(meta).encode('utf-8') + b'\n')
+                f.write(body)
+            self.cache.commit(cache_key, f.name)
+        except OSError as e:
+            logger.warning('Store HTTP response into cache failed, {}'.format(e))
+
+
+http_cache = FileCache('http', HTTP_CACHE_MAX_SIZE)
+http_client = HttpClient(http_cache)
+
+
+def simply_get_url(url):
+    return http_client.get(url)
 
 
 def you_get(url, print_info, extra_args):
     try:
-        command = ['you-get', '-u']
-        if print_info:
-            command.append('-i')
-        if extra_args:
-            command.append(extra_args)
-        command.append(url)
-        process = subprocess.Popen(command, stdout=subprocess.PIPE)
+        process = subprocess.Popen(get_you_get_command(url, print_info, extra_args), stdout=subprocess.PIPE)
         try:
             output = process.communicate()[0]
-            output = output.decode(chardet.detect(output).get('encoding', 'utf-8'), 'replace')
+            output = decode_output(output)
         except KeyboardInterrupt:
             process.terminate()
             return '', []
         if print_info:
             print(output)
             return '', []
-        name_match = re.compile(r'title:\s*(.*?)(\r|\n)').search(output)
-        name = name_match.group(1) if name_match else 'Unknown'
-        url_re = re.compile(r'(http.*?)(\r|\n)')
-        url_match = url_re.search(output)
-        video_url = []
-        while url_match:
-            video_url.append(url_match.group(1))
-            url_match = url_re.search(output, url_match.end(0))
-        return name, video_url
+        return parse_you_get_output(output)
     except Exception as e:
         logger.error('parse video failed {}'.format(e))
         return '', []
 
 
+def get_you_get_command(url, print_info, extra_args):
+    command = ['you-get', '-u']
+    if print_info:
+        command.append('-i')
+    if extra_args:
+        command.append(extra_args)
+    command.append(url)
+    return command
+
+
+# Result: (name, media URLs)
+def parse_you_get_output(output):
+    name_match = re.compile(r'title:\s*(.*?)(\r|\n)').search(output)
+    name = name_match.group(1) if name_match else 'Unknown'
+    url_re = re.compile(r'(http.*?)(\r|\n)')
+    url_match = url_re.search(output)
+    video_url = []
+    while url_match:
+        video_url.append(url_match.group(1))
+        url_match = url_re.search(output, url_match.end(0))
+    return name, video_url
+
+
+# The output is UTF-8 most of the time, only detect its charset otherwise
+def decode_output(output):
+    try:
+        return output.decode('utf-8')
+    except UnicodeDecodeError:
+        pass
+    try:
+        import chardet
+    except ImportError:
+        from pip._vendor import chardet
+    return output.decode(chardet.detect(output).get('encoding') or 'utf-8', 'replace')
+
+
+resolution_cache = FileCache('resolve', RESOLUTION_CACHE_MAX_SIZE)
+
+
+def is_media_url_alive(url):
+    try:
+        status = http_client.head(url)
+    except Exception as e:
+        logger.debug('HEAD {} failed, {}'.format(url, e))
+        return False
+    return is_media_status_alive(status)
+
+
+def is_media_status_alive(status):
+    # Some servers do not implement HEAD at all, assume the URL is fine then
+    return status < 400 or status in (405, 501)
+
+
+# Same as you_get without print_info, but the result is reused for ttl seconds
+# as long as its first media URL still responds, since CDN URLs expire
+def resolve_video(url, extra_args, ttl=RESOLUTION_CACHE_TTL):
+    cache_key = get_resolution_cache_key(url, extra_args)
+    cached = load_cached_resolution(cache_key, ttl)
+    if cached:
+        if is_media_url_alive(cached['urls'][0]):
+            logger.info('Resolution cache hit, skipping you-get')
+            return cached['name'], cached['urls']
+        drop_cached_resolution(cache_key)
+
+    name, urls = you_get(url, False, extra_args)
+    if urls:
+        store_resolution(cache_key, name, urls)
+    return name, urls
+
+
+def get_resolution_cache_key(url, extra_args):
+    import hashlib
+    return hashlib.sha256(json.dumps([url, extra_args]).encode('utf-8')).hexdigest() + '.json'
+
+
+# Result: the cached resolution if it is younger than ttl seconds, whether its
+# media URL still responds is left to the caller
+def load_cached_resolution(cache_key, ttl):
+    cached_path = resolution_cache.get(cache_key)
+    if not cached_path:
+        return None
+    try:
+        with open(cached_path, encoding='utf-8') as f:
+            cached = json.load(f)
+        if 'name' in cached and time.time() - cached['time'] < ttl and cached['urls'][0]:
+            return cached
+    except (OSError, ValueError, KeyError, IndexError):
+        pass
+    drop_cached_resolution(cache_key)
+    return None
+
+
+def drop_cached_resolution(cache_key):
+    logger.info('Resolution cache entry expired or its media URL is gone, re-resolving')
+    resolution_cache.invalidate(cache_key)
+
+
+def store_resolution(cache_key, name, urls):
+    try:
+        with resolution_cache.new_temp_file(mode='w', encoding='utf-8', suffix='.json') as f:
+            json.dump({'time': time.time(), 'name': name, 'urls': urls}, f)
+        resolution_cache.commit(cache_key, f.name)
+    except OSError as e:
+        logger.warning('Store resolution into cache failed, {}'.format(e))
+
+
+def log_cache_stats():
+    logger.info('Cache stats: ' + '; '.join(i.stats() for i in (resolution_cache, http_cache, ass_cache)))
+
+
+# Result: the settings of the caches, for another process to apply with
+# apply_cache_settings instead of using its own
+def get_cache_settings():
+    return {cache.name: {'directory': cache.directory, 'max_size': cache.max_size, 'enabled': cache.enabled}
+            for cache in (resolution_cache, http_cache, ass_cache)}
+
+
+def apply_cache_settings(settings):
+    for cache in (resolution_cache, http_cache, ass_cache):
+        for k, v in settings[cache.name].items():
+            setattr(cache, k, v)
+
+
 """Functions(get_video_size, convert_comments, launch_player) from BiliDan
 Link: https://github.com/m13253/BiliDan/blob/master/bilidan.py
 License: MIT
@@ -86,39 +527,54 @@ THE SOFTWARE IS PROVIDED "AS IS", WITHOUT WARRANTY OF ANY KIND, EXPRESS OR IMPLI
 
 def get_video_size(media_urls):
     try:
-        if media_urls[0].startswith('http:') or media_urls[0].startswith('https:'):
-            ffprobe_command = ['ffprobe', '-icy', '0', '-loglevel', 'repeat+error', '-print_format', 'json',
-                               '-select_streams', 'v', '-show_streams', '-timeout', '60000000', '-user-agent',
-                               DEFAULT_USER_AGENT, '--', media_urls[0]]
-        else:
-            ffprobe_command = ['ffprobe', '-loglevel', 'repeat+error', '-print_format', 'json', '-select_streams', 'v',
-                               '-show_streams', '--', media_urls[0]]
-        ffprobe_process = subprocess.Popen(ffprobe_command, stdout=subprocess.PIPE)
+        ffprobe_process = subprocess.Popen(get_ffprobe_command(media_urls), stdout=subprocess.PIPE)
         try:
-            ffprobe_output = json.loads(ffprobe_process.communicate()[0].decode('utf-8', 'replace'))
+            ffprobe_output = ffprobe_process.communicate()[0]
         except KeyboardInterrupt:
             logging.warning('Cancelling getting video size, press Ctrl-C again to terminate.')
             ffprobe_process.terminate()
             return 0, 0
-        width, height, widthxheight = 0, 0, 0
-        for stream in dict.get(ffprobe_output, 'streams') or []:
-            if dict.get(stream, 'width') * dict.get(stream, 'height') > widthxheight:
-                width, height = dict.get(stream, 'width'), dict.get(stream, 'height')
-        return width, height
+        return parse_ffprobe_output(ffprobe_output)
     except Exception as e:
         logger.error('get video size failed {}'.format(e))
         return 0, 0
 
 
-def convert_comments(danmaku_url_or_raw, video_size):
+def get_ffprobe_command(media_urls):
+    if media_urls[0].startswith('http:') or media_urls[0].startswith('https:'):
+        return ['ffprobe', '-icy', '0', '-loglevel', 'repeat+error', '-print_format', 'json',
+                '-select_streams', 'v', '-show_streams', '-timeout', '60000000', '-user-agent',
+                DEFAULT_USER_AGENT, '--', media_urls[0]]
+    return ['ffprobe', '-loglevel', 'repeat+error', '-print_format', 'json', '-select_streams', 'v',
+            '-show_streams', '--', media_urls[0]]
+
+
+# Result: (width, height) of the largest video stream
+def parse_ffprobe_output(output):
+    ffprobe_output = json.loads(output.decode('utf-8', 'replace'))
+    width, height, widthxheight = 0, 0, 0
+    for stream in dict.get(ffprobe_output, 'streams') or []:
+        if dict.get(stream, 'width') * dict.get(stream, 'height') > widthxheight:
+            width, height = dict.get(stream, 'width'), dict.get(stream, 'height')
+    return width, height
+
+
+def get_ass_cache_key(danmaku_raw, d2a_args):
+    import hashlib
+    key = hashlib.sha256()
+    key.update(json.dumps([ASS_CACHE_VERSION, d2a_args], sort_keys=True).encode('utf-8'))
+    key.update(danmaku_raw)
+    return key.hexdigest() + '.ass'
+
+
+# report: None, 'stats' to write the timings and counters of the conversion
+# next to the ASS file, or 'profile' to add a cProfile and tracemalloc summary
+def convert_comments(danmaku_url_or_raw, video_size, window_callback=None, report=None):
+    import danmaku2ass
     if isinstance(danmaku_url_or_raw, str):
         resp_comment = simply_get_url(danmaku_url_or_raw)
     else:
         resp_comment = danmaku_url_or_raw
-    comment_in = io.StringIO(resp_comment.decode('utf-8', 'replace'))
-    comment_out = tempfile.NamedTemporaryFile(mode='w', encoding='utf-8-sig', newline='\r\n', prefix='tmp-danmaku2ass-',
-                                              suffix='.ass', delete=False)
-    logging.info('Invoking Danmaku2ASS, converting to %s' % comment_out.name)
     d2aflags = {}
     d2a_args = dict({'stage_width': video_size[0], 'stage_height': video_size[1], 'font_face': 'SimHei',
                      'font_size': math.ceil(video_size[1] / 21.6), 'text_opacity': 0.8,
@@ -129,25 +585,74 @@ def convert_comments(danmaku_url_or_raw, video_size):
         for k in i:
             if k in d2aflags:
                 d2a_args[k] = j(d2aflags[k])
+
+    cache_key = get_ass_cache_key(resp_comment, d2a_args)
+    cached_path = ass_cache.get(cache_key)
+    if cached_path:
+        logging.info('ASS cache hit, using %s' % cached_path)
+        if window_callback:
+            window_callback(cached_path, None)
+        if report:
+            logging.info('No conversion report is written for a cached ASS file')
+        return cached_path
+
+    # Danmaku2ASS decodes the downloaded body chunk by chunk while parsing it
+    comment_in = memoryview(resp_comment)
+    # Danmaku2ASS encodes the subtitles itself, in large chunks
+    comment_out = ass_cache.new_temp_file(mode='wb', prefix='tmp-danmaku2ass-', suffix='.ass')
+    logging.info('ASS cache miss, invoking Danmaku2ASS, converting to %s' % comment_out.name)
+    if window_callback:
+        d2a_args['stream_window'] = DANMAKU_STREAM_WINDOW
+        d2a_args['window_callback'] = lambda window_end: window_callback(comment_out.name, window_end)
+    stats = None
+    if report:
+        stats = danmaku2ass.ConversionStats(profile=report == 'profile', trace_memory=report == 'profile')
+        d2a_args['stats'] = stats
     try:
         danmaku2ass.Danmaku2ASS([comment_in], comment_out, **d2a_args)
     except Exception as e:
         logging.error('Danmaku2ASS failed, comments are disabled. {}'.format(e))
+        comment_out.close()
+        os.remove(comment_out.name)
+        return None
     comment_out.flush()
     comment_out.close()  # Close the temporary file early to fix an issue related to Windows NT file sharing
-    return comment_out
+    path = ass_cache.commit(cache_key, comment_out.name)
+    if stats:
+        write_conversion_report(stats, path + '.report.json')
+    return path
+
+
+def write_conversion_report(stats, path):
+    try:
+        stats.WriteReport(path)
+    except OSError as e:
+        logger.warning('Write conversion report failed, {}'.format(e))
+        return
+    report = stats.Report()
+    logger.info('Conversion report written to {}: {}'.format(path, ', '.join(
+        '{} {:.2f}s'.format(stage['stage'], stage['duration']) for stage in report['stages'])))
 
 
-def launch_player(video_name, media_urls, comment_out):
+def start_player(video_name, media_urls, comment_file, ipc_server=None):
     command_line = ['mpv', '--autofit', '950x540']
     command_line += ['--force-media-title', video_name]
     if len(media_urls) > 1:
         command_line += ['--cache=1000', '--cache-backbuffer=1000', '--cache-secs=5', '--merge-files']
-    if comment_out and comment_out.name:
-        command_line += ['--no-video-aspect', '--sub-ass', '--sub-file', comment_out.name]
+    if comment_file:
+        command_line += ['--no-video-aspect', '--sub-ass', '--sub-file', comment_file]
+    elif ipc_server:
+        # The danmaku will be added through the IPC server once it is ready
+        command_line += ['--no-video-aspect', '--sub-ass']
+    if ipc_server:
+        command_line += ['--input-ipc-server=' + ipc_server]
 
-    command_line += media_urls
-    player_process = subprocess.Popen(command_line)
+    # The media URLs may come from the daemon, never let them pass for options
+    command_line += ['--'] + media_urls
+    return subprocess.Popen(command_line)
+
+
+def wait_player(player_process):
     try:
         player_process.wait()
     except KeyboardInterrupt:
@@ -165,8 +670,106 @@ def launch_player(video_name, media_urls, comment_out):
         return player_process.returncode
 
 
-def parse_youku_danmaku(url):
-    page = simply_get_url(url).decode('utf-8')
+def launch_player(video_name, media_urls, comment_file):
+    return wait_player(start_player(video_name, media_urls, comment_file))
+
+
+def get_mpv_ipc_path():
+    if os.name == 'nt':
+        return r'\\.\pipe\yatto-mpv-{}'.format(os.getpid())
+    return os.path.join(tempfile.gettempdir(), 'yatto-mpv-{}.sock'.format(os.getpid()))
+
+
+# Client of the mpv JSON IPC protocol, see https://mpv.io/manual/stable/#json-ipc
+class MpvIpcClient:
+    def __init__(self, path, timeout=MPV_IPC_TIMEOUT, player_process=None):
+        self.path = path
+        self.request_id = 0
+        self.sock = None
+        deadline = time.time() + timeout
+        while True:
+            # mpv creates the server shortly after start, keep trying until then
+            try:
+                if os.name == 'nt':
+                    self.stream = open(path, 'r+b', buffering=0)
+                else:
+                    self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+                    self.sock.connect(path)
+                    self.stream = self.sock.makefile('rwb', buffering=0)
+                break
+            except OSError:
+                if self.sock:
+                    self.sock.close()
+                    self.sock = None
+                if time.time() > deadline or (player_process and player_process.poll() is not None):
+                    raise
+                time.sleep(0.1)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self.stream.close()
+        if self.sock:
+            self.sock.close()
+
+    def command(self, *args):
+        self.request_id += 1
+        request = {'command': list(args), 'request_id': self.request_id}
+        self.stream.write(json.dumps(request).encode('utf-8') + b'\n')
+        while True:
+            line = self.stream.readline()
+            if not line:
+                raise ConnectionError('mpv closed the IPC connection')
+            response = json.loads(line.decode('utf-8', 'replace'))
+            # Skip the asynchronous events mixed into the replies
+            if response.get('request_id') != self.request_id:
+                continue
+            if response.get('error', 'success') != 'success':
+                raise RuntimeError('mpv command {} failed: {}'.format(args[0], response['error']))
+            return response.get('data')
+
+    def add_subtitle(self, path, title='Danmaku'):
+        self.command('sub-add', path, 'select', title)
+        return self.command('get_property', 'sid')
+
+
+def fetch_danmaku_segment(url, retries=DANMAKU_SEGMENT_RETRIES, backoff=DANMAKU_SEGMENT_BACKOFF):
+    for attempt in range(retries + 1):
+        try:
+            segment_raw = simply_get_url(url).decode('utf-8')
+            return json.loads(segment_raw or '{}')
+        except Exception as e:
+            if attempt == retries:
+                logger.error('Danmaku segment download failed, skipped. {}'.format(e))
+                return {}
+            delay = backoff * 2 ** attempt
+            logger.warning('Danmaku segment download failed, retrying in {:.1f}s. {}'.format(delay, e))
+            time.sleep(delay)
+
+
+def fetch_danmaku_segments(urls, jobs=DANMAKU_SEGMENT_JOBS):
+    # Download the segments concurrently, but merge them in segment order
+    with concurrent.futures.ThreadPoolExecutor(max_workers=max(jobs, 1)) as executor:
+        return merge_danmaku_segments(executor.map(fetch_danmaku_segment, urls), len(urls))
+
+
+def merge_danmaku_segments(segments, count):
+    danmaku_pool = {'result': []}
+    for i, segment in enumerate(segments):
+        logger.info('Processing danmaku segment {}/{}'.format(i, count - 1))
+        if not segment.get('count', 0):
+            continue
+        danmaku_pool['result'].extend(segment.get('result', []))
+    return json.dumps(danmaku_pool).encode('utf-8')
+
+
+# The danmaku parsers find the danmaku of a video page. Result: the danmaku URL,
+# a list of danmaku segment URLs to download and merge, or '' if there is none.
+def parse_youku_danmaku(page):
     video_id_match = re.search(r'videoId\s+=\s+\'(\d+)', page)
     video_seconds_match = re.search(r'videoSeconds\s+=\s+Math\.round\((\d+)', page)
     if not video_id_match or not video_seconds_match:
@@ -176,23 +779,12 @@ def parse_youku_danmaku(url):
     video_seconds = int(video_seconds_match.group(1)) / 60
     logger.info('Youku danmaku detected')
 
-    danmaku_pool = {'result': []}
     # Download and merge every 5 minute danmaku segments
-    segments_num = (int(video_seconds) + 1) // 5
-    for i in range(0, int(video_seconds) + 1, 5):
-        logger.info('Processing danmaku segment {}/{}'.format(i // 5, segments_num))
-        danmaku_url = 'http://service.danmu.youku.com/list?mat={}&mcount=5&ct=1001&uid=0&iid={}'.format(i, video_id)
-        segment_raw = simply_get_url(danmaku_url).decode('utf-8')
-        segment = json.loads(segment_raw or '{}')
-        if not segment.get('count', 0):
-            continue
-        danmaku_pool['result'].extend(segment.get('result', []))
-
-    return json.dumps(danmaku_pool).encode('utf-8')
+    return ['http://service.danmu.youku.com/list?mat={}&mcount=5&ct=1001&uid=0&iid={}'.format(i, video_id)
+            for i in range(0, int(video_seconds) + 1, 5)]
 
 
-def parse_tudou_danmaku(url):
-    page = simply_get_url(url).decode('utf-8')
+def parse_tudou_danmaku(page):
     iid_match = re.search(r',iid: (\d+)', page)
     time_match = re.search(r',time: \'(\d+)', page)
     if not iid_match or not time_match:
@@ -202,23 +794,12 @@ def parse_tudou_danmaku(url):
     time = time_match.group(1)
     logger.info('Tudou danmaku detected')
 
-    danmaku_pool = {'result': []}
     # Download and merge every 5 minute danmaku segments
-    segments_num = (int(time) + 1) // 5
-    for i in range(0, int(time) + 1, 5):
-        logger.info('Processing danmaku segment {}/{}'.format(i // 5, segments_num))
-        danmaku_url = 'http://service.danmu.tudou.com/list?mat={}&mcount=5&ct=1001&uid=0&iid={}'.format(i, iid)
-        segment_raw = simply_get_url(danmaku_url).decode('utf-8')
-        segment = json.loads(segment_raw or '{}')
-        if not segment.get('count', 0):
-            continue
-        danmaku_pool['result'].extend(segment.get('result', []))
+    return ['http://service.danmu.tudou.com/list?mat={}&mcount=5&ct=1001&uid=0&iid={}'.format(i, iid)
+            for i in range(0, int(time) + 1, 5)]
 
-    return json.dumps(danmaku_pool).encode('utf-8')
 
-
-def parse_bilibili_danmaku(url):
-    page = simply_get_url(url).decode('utf-8')
+def parse_bilibili_danmaku(page):
     cid_re = re.compile(r'cid=(\d+)')
     match = cid_re.search(page)
     danmaku_url = ''
@@ -228,8 +809,7 @@ def parse_bilibili_danmaku(url):
     return danmaku_url
 
 
-def parse_acfun_danmaku(url):
-    page = simply_get_url(url).decode('utf-8')
+def parse_acfun_danmaku(page):
     cid_re = re.compile(r'''data-vid=['"](\d+)['"]''')
     match = cid_re.search(page)
     danmaku_url = ''
@@ -243,57 +823,858 @@ danmaku_parsers = {'tudou.com': parse_tudou_danmaku, 'bilibili.com': parse_bilib
                    'acfun': parse_acfun_danmaku, 'youku': parse_youku_danmaku}
 
 
-def parse_video(url, print_info, extra_args):
-    name, urls = you_get(url, print_info, extra_args)
-    danmaku_url = ''
-
-    danmaku_parser = None
+def find_danmaku_parser(url):
     host = urllib.parse.urlparse(url).hostname
     for k, v in danmaku_parsers.items():
         if host.find(k) > -1:
-            danmaku_parser = v
-            break
+            return v
+    return None
+
+
+# Result: the danmaku URL of the video page, or the danmaku itself when it is
+# made of segments
+def parse_danmaku(url, danmaku_parser, jobs=DANMAKU_SEGMENT_JOBS):
+    danmaku_url = danmaku_parser(simply_get_url(url).decode('utf-8'))
+    if isinstance(danmaku_url, list):
+        return fetch_danmaku_segments(danmaku_url, jobs)
+    return danmaku_url
 
+
+def parse_video(url, print_info, extra_args, jobs=DANMAKU_SEGMENT_JOBS):
+    name, urls = you_get(url, print_info, extra_args)
+    danmaku_url = ''
+
+    danmaku_parser = find_danmaku_parser(url)
     if danmaku_parser and not print_info:
-        danmaku_url = danmaku_parser(url)
+        danmaku_url = parse_danmaku(url, danmaku_parser, jobs)
 
     return name, urls, danmaku_url
 
 
-def main():
-    parser = argparse.ArgumentParser()
-    parser.add_argument('url', metavar='URL')
-    parser.add_argument('-i', '--info', default=False, action='store_true',
-                        help='Show the format and quality information of the video')
-    parser.add_argument('-e', '--extra', default='', type=str,
-                        help='Specify the you-get options, like --extra="--format=hd"')
-    args = parser.parse_args()
-    logging.basicConfig(level='INFO', format='%(asctime)s - %(levelname)s - %(message)s')
+def fetch_danmaku(url, jobs=DANMAKU_SEGMENT_JOBS):
+    danmaku_parser = find_danmaku_parser(url)
+    if not danmaku_parser:
+        return b''
+    danmaku_url_or_raw = parse_danmaku(url, danmaku_parser, jobs)
+    if isinstance(danmaku_url_or_raw, str):
+        return simply_get_url(danmaku_url_or_raw) if danmaku_url_or_raw else b''
+    return danmaku_url_or_raw
 
-    logger.info('Parsing page...')
-    name, video_url, danmaku = parse_video(args.url, args.info, args.extra)
 
-    if args.info:
+def timed_stage(name, func, *args):
+    start = time.time()
+    try:
+        return func(*args)
+    finally:
+        logger.info('Stage {} finished in {:.2f}s'.format(name, time.time() - start))
+
+
+def load_comments(danmaku_future, size_future, window_callback=None, report=None):
+    try:
+        danmaku = danmaku_future.result()
+    except Exception as e:
+        logger.error('Download danmaku failed, {}'.format(e))
+        return None
+    if not danmaku:
+        return None
+    try:
+        return timed_stage('convert', convert_comments, danmaku, size_future.result(), window_callback, report)
+    except Exception as e:
+        traceback.print_exc()
+        logger.error('Convert danmaku failed, {}'.format(e))
+        return None
+
+
+# you-get and the danmaku download start together, ffprobe starts as soon as
+# you-get has returned the media URLs, and the conversion starts as soon as both
+# the danmaku and the video size are ready.
+def prepare_video(url, extra_args, jobs=DANMAKU_SEGMENT_JOBS, resolve_ttl=RESOLUTION_CACHE_TTL, report=None):
+    start = time.time()
+    comment_file = None
+    with concurrent.futures.ThreadPoolExecutor(max_workers=3) as executor:
+        video_future = executor.submit(timed_stage, 'you-get', resolve_video, url, extra_args, resolve_ttl)
+        danmaku_future = executor.submit(timed_stage, 'danmaku', fetch_danmaku, url, jobs)
+        name, video_url = video_future.result()
+        if video_url:
+            size_future = executor.submit(timed_stage, 'ffprobe', get_video_size, video_url)
+            comment_file = load_comments(danmaku_future, size_future, report=report)
+    logger.info('Startup finished in {:.2f}s'.format(time.time() - start))
+    return name, video_url, comment_file
+
+
+# Adds the danmaku to the player as soon as its first time window has been
+# converted, then reloads it once the conversion has finished
+class DanmakuHotLoader:
+    def __init__(self, ipc_path, player_process):
+        self.ipc_path = ipc_path
+        self.player_process = player_process
+        self.mpv = None
+        self.sub_id = None
+        self.failed = False
+
+    def on_window(self, path, window_end):
+        if self.failed or self.player_process.poll() is not None:
+            return
+        try:
+            if self.mpv is None:
+                self.mpv = MpvIpcClient(self.ipc_path, player_process=self.player_process)
+                self.sub_id = self.mpv.add_subtitle(path)
+                if window_end is not None:
+                    logger.info('Danmaku of the first {:.0f}s loaded into the player'.format(window_end))
+            elif window_end is None:
+                self.mpv.command('sub-reload', self.sub_id)
+            if window_end is None:
+                logger.info('Danmaku loaded into the player')
+        except Exception as e:
+            self.failed = True
+            logger.error('Load danmaku into the player failed, {}'.format(e))
+
+    def close(self):
+        if self.mpv:
+            self.mpv.close()
+
+
+def hot_load_comments(ipc_path, player_process, danmaku_future, size_future, report=None):
+    concurrent.futures.wait([danmaku_future, size_future])
+    if player_process.poll() is not None:
+        logger.info('Player closed, skipping the danmaku conversion')
         return
+    loader = DanmakuHotLoader(ipc_path, player_process)
+    try:
+        load_comments(danmaku_future, size_future, loader.on_window, report)
+    finally:
+        loader.close()
+
+
+# Same as prepare_video, but the player starts as soon as you-get has returned
+# the media URLs, and the danmaku is added through mpv's IPC server later.
+def play_video_early(url, extra_args, jobs=DANMAKU_SEGMENT_JOBS, resolve_ttl=RESOLUTION_CACHE_TTL, report=None):
+    start = time.time()
+    # Daemon threads, so that closing the player ends yatto without waiting
+    # for the danmaku download or conversion
+    video_future = submit_daemon(timed_stage, 'you-get', resolve_video, url, extra_args, resolve_ttl)
+    danmaku_future = submit_daemon(timed_stage, 'danmaku', fetch_danmaku, url, jobs)
+    name, video_url = video_future.result()
+    if not video_url:
+        return False
+    size_future = submit_daemon(timed_stage, 'ffprobe', get_video_size, video_url)
+    ipc_path = get_mpv_ipc_path()
+    logger.info('Buffering video header, this may take a while')
+    player_process = start_player(name, video_url, None, ipc_path)
+    logger.info('Player started in {:.2f}s'.format(time.time() - start))
+    submit_daemon(hot_load_comments, ipc_path, player_process, danmaku_future, size_future, report)
+    wait_player(player_process)
+    if os.name != 'nt' and os.path.exists(ipc_path):
+        os.remove(ipc_path)
+    return True
+
+
+# Result: a future of func(*args), run on a daemon thread
+def submit_daemon(func, *args):
+    future = concurrent.futures.Future()
+
+    def run():
+        if not future.set_running_or_notify_cancel():
+            return
+        try:
+            future.set_result(func(*args))
+        except BaseException as e:
+            future.set_exception(e)
+    threading.Thread(target=run, daemon=True).start()
+    return future
+
+
+# The socket lives in a directory only the current user may write to: the
+# runtime directory, or a private one in the shared temporary directory
+def get_daemon_socket_path():
+    if os.environ.get('XDG_RUNTIME_DIR'):
+        return os.path.join(os.environ['XDG_RUNTIME_DIR'], 'yatto-{}.sock'.format(os.getuid()))
+    return os.path.join(tempfile.gettempdir(), 'yatto-{}'.format(os.getuid()), 'daemon.sock')
+
+
+# Raises PermissionError unless the directory of the socket belongs to the
+# current user and nobody else may write to it, so that another local user
+# cannot put a fake daemon in place
+def check_daemon_socket_dir(path):
+    directory = os.path.dirname(path)
+    dir_stat = os.lstat(directory)
+    if not stat.S_ISDIR(dir_stat.st_mode) or dir_stat.st_uid != os.getuid() or dir_stat.st_mode & 0o022:
+        raise PermissionError('{} is not a directory of the current user only it may write to'.format(directory))
+
 
-    danmaku_file = ''
-    if danmaku:
-        # convert danmaku to ASS
+# Same as check_daemon_socket_dir, and the socket must belong to the current
+# user too
+def check_daemon_socket(path):
+    check_daemon_socket_dir(path)
+    sock_stat = os.lstat(path)
+    if not stat.S_ISSOCK(sock_stat.st_mode) or sock_stat.st_uid != os.getuid():
+        raise PermissionError('{} is not a socket of the current user'.format(path))
+
+
+# Sends one request to the daemon and returns the result, raising OSError when
+# no daemon is listening and RuntimeError when the request failed there
+def daemon_request(command, timeout=None, **kwargs):
+    path = get_daemon_socket_path()
+    check_daemon_socket(path)
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.settimeout(timeout)
+        sock.connect(path)
+        sock.sendall(json.dumps(dict(kwargs, command=command)).encode('utf-8') + b'\n')
+        with sock.makefile('rb') as f:
+            line = f.readline()
+    finally:
+        sock.close()
+    if not line:
+        raise ConnectionError('The daemon closed the connection')
+    response = json.loads(line.decode('utf-8', 'replace'))
+    if 'error' in response:
+        raise RuntimeError('Daemon request {} failed: {}'.format(command, response['error']))
+    return response['result']
+
+
+# Result: the cache options of this process to send along with a daemon
+# request, which the daemon uses instead of its own
+def get_daemon_cache_options(resolve_ttl):
+    return {'cache_ttl': resolve_ttl,
+            'no_cache': not all(i.enabled for i in (resolution_cache, http_cache, ass_cache))}
+
+
+def is_daemon_running():
+    if not hasattr(socket, 'AF_UNIX'):
+        return False
+    try:
+        daemon_request('status', timeout=DAEMON_PROBE_TIMEOUT)
+        return True
+    except PermissionError as e:
+        logger.warning('Not using the daemon socket, {}'.format(e))
+        return False
+    except (OSError, ValueError, RuntimeError):
+        return False
+
+
+# Runs in a resident process, so that the imports, the HTTP connection pool and
+# the caches stay warm between plays. Each video is prepared once, either on
+# request or ahead of time when queued, and its result is shared by every
+# request for it until the resolution expires.
+class YattoDaemon:
+    def __init__(self, jobs=DANMAKU_SEGMENT_JOBS, resolve_ttl=RESOLUTION_CACHE_TTL, prefetch_jobs=DAEMON_PREFETCH_JOBS):
+        self.jobs = jobs
+        self.resolve_ttl = resolve_ttl
+        self.prepared = {}  # (url, extra_args) -> (time, future of prepare_video)
+        self.lock = threading.Lock()
+        self.prefetcher = concurrent.futures.ThreadPoolExecutor(max_workers=prefetch_jobs)
+
+    def handle(self, request):
+        command = request.get('command')
+        if command == 'status':
+            return self.status()
+        if command == 'resolve':
+            name, urls = resolve_video(request['url'], request.get('extra', ''), self.get_resolve_ttl(request))
+            return {'name': name, 'urls': urls}
+        if command == 'prepare':
+            name, urls, comment_file = self.prepare(request['url'], request.get('extra', ''),
+                                                    request.get('jobs', self.jobs), self.get_resolve_ttl(request),
+                                                    request.get('report'))
+            return {'name': name, 'urls': urls, 'comment_file': comment_file}
+        if command == 'queue':
+            return self.queue(request['urls'], request.get('extra', ''), self.get_resolve_ttl(request))
+        raise ValueError('Unknown command {}'.format(command))
+
+    # Result: the resolution TTL of the client, whose requests are refused if
+    # they would bypass the caches, which the daemon shares between clients
+    def get_resolve_ttl(self, request):
+        if request.get('no_cache'):
+            raise ValueError('The caches of the daemon cannot be bypassed, use --no-daemon')
+        return float(request.get('cache_ttl', self.resolve_ttl))
+
+    def status(self):
+        with self.lock:
+            pending = sum(not future.done() for start, future in self.prepared.values())
+            return {'prepared': len(self.prepared) - pending, 'pending': pending,
+                    'caches': [i.stats() for i in (resolution_cache, http_cache, ass_cache)]}
+
+    # Result: the entry of the video, added if missing or older than the
+    # resolve_ttl of the request
+    def get_entry(self, key, resolve_ttl):
+        now = time.time()
+        with self.lock:
+            for k, (start, future) in list(self.prepared.items()):
+                if future.done() and now - start > self.resolve_ttl:
+                    del self.prepared[k]
+            entry = self.prepared.get(key)
+            if entry is None or (entry[1].done() and now - entry[0] > resolve_ttl):
+                entry = self.prepared[key] = (now, concurrent.futures.Future())
+            return entry
+
+    def drop_entry(self, key, entry):
+        with self.lock:
+            if self.prepared.get(key) is entry:
+                del self.prepared[key]
+
+    # Result: True if the caller is the one to prepare the video of future
+    def claim(self, future):
+        with self.lock:
+            return not future.running() and not future.done() and future.set_running_or_notify_cancel()
+
+    def run_prepare(self, key, entry, jobs, resolve_ttl, report=None):
+        future = entry[1]
+        if not self.claim(future):
+            return False
         try:
-            logger.info('Fetching danmaku')
-            danmaku_file = convert_comments(danmaku, get_video_size(video_url))
+            result = prepare_video(key[0], key[1], jobs, resolve_ttl, report)
+        except Exception as e:
+            self.drop_entry(key, entry)
+            future.set_exception(e)
+            return True
+        if not result[1]:
+            self.drop_entry(key, entry)  # Resolve again next time
+        future.set_result(result)
+        return True
+
+    def prepare(self, url, extra_args, jobs, resolve_ttl, report=None):
+        key = (url, extra_args)
+        entry = self.get_entry(key, resolve_ttl)
+        # A video still waiting in the queue is prepared right away instead
+        if self.run_prepare(key, entry, jobs, resolve_ttl, report):
+            return entry[1].result()
+        name, video_url, comment_file = entry[1].result()
+        if video_url and is_media_url_alive(video_url[0]) and (not comment_file or os.path.exists(comment_file)):
+            logger.info('Video prepared ahead of time, {}'.format(url))
+            return name, video_url, comment_file
+        self.drop_entry(key, entry)
+        return self.prepare(url, extra_args, jobs, resolve_ttl, report)
+
+    def queue(self, urls, extra_args, resolve_ttl):
+        queued = 0
+        for url in urls:
+            key = (url, extra_args)
+            entry = self.get_entry(key, resolve_ttl)
+            if not entry[1].running() and not entry[1].done():
+                self.prefetcher.submit(self.run_prepare, key, entry, self.jobs, resolve_ttl)
+                queued += 1
+        logger.info('Queued {} videos for prefetching'.format(queued))
+        return queued
+
+    def close(self):
+        self.prefetcher.shutdown(wait=False)
+        http_client.close()
+
+
+# Requests and responses are single lines of JSON
+class DaemonRequestHandler(socketserver.StreamRequestHandler):
+    def handle(self):
+        for line in self.rfile:
+            try:
+                request = json.loads(line.decode('utf-8', 'replace'))
+                if request.get('command') == 'shutdown':
+                    # shutdown() waits for serve_forever(), which waits for this handler
+                    threading.Thread(target=self.server.shutdown).start()
+                    response = {'result': True}
+                else:
+                    response = {'result': self.server.yatto.handle(request)}
+            except Exception as e:
+                logger.error('Daemon request failed, {}'.format(e))
+                response = {'error': '{}: {}'.format(type(e).__name__, e)}
+            self.wfile.write(json.dumps(response).encode('utf-8') + b'\n')
+
+
+def serve_daemon(jobs=DANMAKU_SEGMENT_JOBS, resolve_ttl=RESOLUTION_CACHE_TTL):
+    if not hasattr(socketserver, 'ThreadingUnixStreamServer'):
+        logger.error('The daemon needs Unix domain sockets, which are not available on this system')
+        return False
+    path = get_daemon_socket_path()
+    try:
+        os.mkdir(os.path.dirname(path), 0o700)
+    except FileExistsError:
+        pass
+    try:
+        check_daemon_socket_dir(path)
+    except PermissionError as e:
+        logger.error('Refusing to listen, {}'.format(e))
+        return False
+    if os.path.exists(path):
+        if is_daemon_running():
+            logger.error('A daemon is already listening on {}'.format(path))
+            return False
+        os.remove(path)  # Left behind by a daemon that was killed
+    umask = os.umask(0o177)  # Only the current user may connect
+    try:
+        server = socketserver.ThreadingUnixStreamServer(path, DaemonRequestHandler)
+    finally:
+        os.umask(umask)
+    server.daemon_threads = True
+    server.yatto = YattoDaemon(jobs, resolve_ttl)
+    logger.info('Daemon listening on {}'.format(path))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        logger.info('Daemon stopped')
+        server.server_close()
+        server.yatto.close()
+        os.remove(path)
+    return True
+
+
+# Same as prepare_video and play_video_early, with the daemon doing the work
+def prepare_video_by_daemon(url, extra_args, jobs=DANMAKU_SEGMENT_JOBS, resolve_ttl=RESOLUTION_CACHE_TTL, report=None):
+    start = time.time()
+    result = daemon_request('prepare', url=url, extra=extra_args, jobs=jobs, report=report,
+                            **get_daemon_cache_options(resolve_ttl))
+    logger.info('Startup finished in {:.2f}s by the daemon'.format(time.time() - start))
+    return result['name'], result['urls'], result['comment_file']
+
+
+def play_video_early_by_daemon(url, extra_args, jobs=DANMAKU_SEGMENT_JOBS, resolve_ttl=RESOLUTION_CACHE_TTL,
+                               report=None):
+    start = time.time()
+    result = daemon_request('resolve', url=url, extra=extra_args, **get_daemon_cache_options(resolve_ttl))
+    if not result['urls']:
+        return False
+    ipc_path = get_mpv_ipc_path()
+    logger.info('Buffering video header, this may take a while')
+    player_process = start_player(result['name'], result['urls'], None, ipc_path)
+    logger.info('Player started in {:.2f}s'.format(time.time() - start))
+
+    def load_prepared():
+        loader = DanmakuHotLoader(ipc_path, player_process)
+        try:
+            comment_file = prepare_video_by_daemon(url, extra_args, jobs, resolve_ttl, report)[2]
+            if comment_file:
+                loader.on_window(comment_file, None)
+        except Exception as e:
+            logger.error('Load danmaku from the daemon failed, {}'.format(e))
+        finally:
+            loader.close()
+    threading.Thread(target=load_prepared, daemon=True).start()
+    wait_player(player_process)
+    if os.path.exists(ipc_path):
+        os.remove(ipc_path)
+    return True
+
+
+# Runs a blocking function, such as one reading or writing the caches, in the
+# default executor of the running event loop
+async def run_blocking(func, *args):
+    import asyncio
+    return await asyncio.get_running_loop().run_in_executor(None, func, *args)
+
+
+async def timed_stage_async(name, awaitable):
+    start = time.time()
+    try:
+        return await awaitable
+    finally:
+        logger.info('Stage {} finished in {:.2f}s'.format(name, time.time() - start))
+
+
+# The few attributes of http.client.HTTPResponse that HttpClient relies on
+class AsyncHttpResponse:
+    def __init__(self, status, reason, headers, will_close):
+        self.status = status
+        self.reason = reason
+        self.headers = headers
+        self.will_close = will_close
+
+
+# The asyncio counterpart of HttpClient, sharing its response cache. At most
+# max_connections requests run at a time per host, the others wait for a
+# connection of the pool to be released.
+class AsyncHttpClient:
+    def __init__(self, cache=None, timeout=HTTP_TIMEOUT, max_connections=ASYNC_HOST_CONNECTIONS):
+        self.client = HttpClient(cache, timeout)  # For the cache rules and the requests through a proxy
+        self.timeout = timeout
+        self.max_connections = max_connections
+        self.pool = {}
+        self.limits = {}
+
+    async def get(self, url):
+        now = time.time()
+        cache_key, cached, headers = await run_blocking(self.client.prepare_get, url, now)
+        if cached and cached[0]['expires'] > now:
+            logger.debug('HTTP cache hit {}'.format(url))
+            return cached[1]
+        response, body = await self.request('GET', url, headers)
+        return await run_blocking(self.client.finish_get, url, now, cache_key, cached, response, body)
+
+    async def head(self, url):
+        response, body = await self.request('HEAD', url, {'User-Agent': DEFAULT_USER_AGENT})
+        return response.status
+
+    async def request(self, method, url, headers):
+        import urllib.request as urllib2
+        for i in range(HttpClient.MAX_REDIRECTS + 1):
+            parts = urllib.parse.urlsplit(url)
+            if urllib2.getproxies().get(parts.scheme) and not urllib2.proxy_bypass(parts.hostname):
+                return await run_blocking(self.client.request_via_proxy, method, url, headers)
+            response, body = await self.send(parts, method, headers)
+            redirect = self.client.get_redirect(url, method, response)
+            if not redirect:
+                return response, body
+            url, method = redirect
+        raise urllib.error.HTTPError(url, response.status, 'Too many redirects', response.headers, None)
+
+    async def send(self, parts, method, headers):
+        import asyncio
+        pool_key = (parts.scheme, parts.hostname, parts.port or (443 if parts.scheme == 'https' else 80))
+        path = parts.path or '/'
+        if parts.query:
+            path += '?' + parts.query
+        lines = ['{} {} HTTP/1.1'.format(method, path), 'Host: ' + parts.netloc.rpartition('@')[2]]
+        lines.extend('{}: {}'.format(k, v) for k, v in headers.items())
+        request = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1')
+        limit = self.limits.get(pool_key)
+        if limit is None:
+            limit = self.limits[pool_key] = asyncio.Semaphore(self.max_connections)
+        async with limit:
+            for attempt in range(2):
+                connection, reused = await self.acquire(pool_key)
+                writer = connection[1]
+                try:
+                    writer.write(request)
+                    await writer.drain()
+                    response, body = await asyncio.wait_for(self.read_response(connection[0], method), self.timeout)
+                except (asyncio.IncompleteReadError, ConnectionResetError, BrokenPipeError):
+                    writer.close()
+                    # The server may have dropped an idle connection, retry once with a new one
+                    if reused and not attempt:
+                        continue
+                    raise
+                except BaseException:
+                    writer.close()
+                    raise
+                if response.will_close:
+                    writer.close()
+                else:
+                    self.release(pool_key, connection)
+                return response, body
+
+    async def acquire(self, pool_key):
+        import asyncio
+        idle = self.pool.get(pool_key)
+        while idle:
+            reader, writer = idle.pop()
+            if not reader.at_eof() and not writer.is_closing():
+                return (reader, writer), True
+            writer.close()
+        scheme, host, port = pool_key
+        connection = await asyncio.wait_for(
+            asyncio.open_connection(host, port, ssl=True if scheme == 'https' else None), self.timeout)
+        return connection, False
+
+    def release(self, pool_key, connection):
+        self.pool.setdefault(pool_key, []).append(connection)
+
+    def close(self):
+        for idle in self.pool.values():
+            for reader, writer in idle:
+                writer.close()
+        self.pool.clear()
+        self.client.close()
+
+    async def read_response(self, reader, method):
+        import http.client
+        import io
+        status_line, _, header_lines = (await reader.readuntil(b'\r\n\r\n')).partition(b'\r\n')
+        version, status, reason = (status_line.decode('latin-1').split(None, 2) + [''])[:3]
+        status = int(status)
+        headers = http.client.parse_headers(io.BytesIO(header_lines))
+        connection_header = (headers.get('Connection') or '').lower()
+        will_close = 'close' in connection_header or (version == 'HTTP/1.0' and 'keep-alive' not in connection_header)
+        decoder = BodyDecoder(headers.get('Content-Encoding'))
+        if method == 'HEAD' or status < 200 or status in (204, 304):
+            pass
+        elif 'chunked' in (headers.get('Transfer-Encoding') or '').lower():
+            while True:
+                size = int((await reader.readuntil(b'\r\n')).split(b';')[0], 16)
+                if not size:
+                    break
+                decoder.feed((await reader.readexactly(size + 2))[:-2])
+            while await reader.readuntil(b'\r\n') != b'\r\n':
+                pass  # Trailers
+        elif headers.get('Content-Length') is not None:
+            remaining = int(headers['Content-Length'])
+            while remaining:
+                chunk = await reader.readexactly(min(remaining, HttpClient.READ_SIZE))
+                decoder.feed(chunk)
+                remaining -= len(chunk)
+        else:
+            will_close = True  # The body ends with the connection
+            while True:
+                chunk = await reader.read(HttpClient.READ_SIZE)
+                if not chunk:
+                    break
+                decoder.feed(chunk)
+        return AsyncHttpResponse(status, reason, headers, will_close), decoder.finish()
+
+
+# Runs convert_comments in a worker process with the cache settings of the
+# process submitting it, which a spawned worker would not have, and a forked
+# one would have as they were when it started
+def convert_comments_in_worker(cache_settings, *args):
+    apply_cache_settings(cache_settings)
+    return convert_comments(*args)
+
+
+# Same as prepare_video, for a server preparing many videos at once in an
+# asyncio event loop: you-get and ffprobe run as asyncio subprocesses, HTTP
+# requests go through an AsyncHttpClient, and the CPU bound conversion runs in
+# a process pool. At most site_prepares videos of the same site host are
+# prepared at a time, and at most process_jobs subprocesses run at a time, the
+# other requests wait for their turn.
+#
+#     async with AsyncPreparer() as preparer:
+#         name, media_urls, comment_file = await preparer.prepare(url)
+class AsyncPreparer:
+    def __init__(self, jobs=DANMAKU_SEGMENT_JOBS, resolve_ttl=RESOLUTION_CACHE_TTL, site_prepares=ASYNC_SITE_PREPARES,
+                 host_connections=ASYNC_HOST_CONNECTIONS, process_jobs=ASYNC_PROCESS_JOBS, convert_executor=None):
+        self.jobs = jobs
+        self.resolve_ttl = resolve_ttl
+        self.site_prepares = site_prepares
+        self.process_jobs = process_jobs
+        self.http_client = AsyncHttpClient(http_cache, max_connections=host_connections)
+        self.convert_executor = convert_executor
+        self.owns_executor = convert_executor is None
+        self.limits = {}
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def close(self):
+        self.http_client.close()
+        if self.owns_executor and self.convert_executor:
+            await run_blocking(self.convert_executor.shutdown)
+            self.convert_executor = None
+
+    # Semaphores are created on first use, inside the event loop running them
+    def get_limit(self, key, value):
+        import asyncio
+        limit = self.limits.get(key)
+        if limit is None:
+            limit = self.limits[key] = asyncio.Semaphore(value)
+        return limit
+
+    # Result: (name, media URLs, ASS file or None), like prepare_video
+    async def prepare(self, url, extra_args='', report=None):
+        import asyncio
+        host = urllib.parse.urlsplit(url).hostname or ''
+        async with self.get_limit(('site', host), self.site_prepares):
+            start = time.time()
+            comment_file = None
+            danmaku_task = asyncio.ensure_future(timed_stage_async('danmaku', self.fetch_danmaku(url)))
+            try:
+                name, video_url = await timed_stage_async('you-get', self.resolve_video(url, extra_args))
+                if video_url:
+                    size = await timed_stage_async('ffprobe', self.get_video_size(video_url))
+                    comment_file = await self.load_comments(danmaku_task, size, report)
+            finally:
+                if danmaku_task.done() and not danmaku_task.cancelled():
+                    danmaku_task.exception()  # Logged by load_comments if it was awaited
+                danmaku_task.cancel()
+            logger.info('Startup finished in {:.2f}s'.format(time.time() - start))
+        return name, video_url, comment_file
+
+    async def run_process(self, command):
+        import asyncio
+        async with self.get_limit(('process',), self.process_jobs):
+            process = await asyncio.create_subprocess_exec(*command, stdout=asyncio.subprocess.PIPE)
+            try:
+                return (await process.communicate())[0]
+            except asyncio.CancelledError:
+                # Reap the process before giving up its slot, killing it if it
+                # ignores the termination
+                if process.returncode is None:
+                    process.terminate()
+                    try:
+                        await asyncio.wait_for(process.wait(), ASYNC_PROCESS_TERMINATE_TIMEOUT)
+                    except asyncio.TimeoutError:
+                        process.kill()
+                        await process.wait()
+                raise
+
+    async def you_get(self, url, extra_args):
+        try:
+            output = await self.run_process(get_you_get_command(url, False, extra_args))
+            return parse_you_get_output(decode_output(output))
+        except Exception as e:
+            logger.error('parse video failed {}'.format(e))
+            return '', []
+
+    async def resolve_video(self, url, extra_args):
+        cache_key = get_resolution_cache_key(url, extra_args)
+        cached = await run_blocking(load_cached_resolution, cache_key, self.resolve_ttl)
+        if cached:
+            if await self.is_media_url_alive(cached['urls'][0]):
+                logger.info('Resolution cache hit, skipping you-get')
+                return cached['name'], cached['urls']
+            await run_blocking(drop_cached_resolution, cache_key)
+
+        name, urls = await self.you_get(url, extra_args)
+        if urls:
+            await run_blocking(store_resolution, cache_key, name, urls)
+        return name, urls
+
+    async def is_media_url_alive(self, url):
+        try:
+            status = await self.http_client.head(url)
+        except Exception as e:
+            logger.debug('HEAD {} failed, {}'.format(url, e))
+            return False
+        return is_media_status_alive(status)
+
+    async def get_video_size(self, media_urls):
+        try:
+            return parse_ffprobe_output(await self.run_process(get_ffprobe_command(media_urls)))
+        except Exception as e:
+            logger.error('get video size failed {}'.format(e))
+            return 0, 0
+
+    async def fetch_danmaku(self, url):
+        danmaku_parser = find_danmaku_parser(url)
+        if not danmaku_parser:
+            return b''
+        danmaku_url = danmaku_parser((await self.http_client.get(url)).decode('utf-8'))
+        if isinstance(danmaku_url, list):
+            return await self.fetch_danmaku_segments(danmaku_url)
+        return await self.http_client.get(danmaku_url) if danmaku_url else b''
+
+    async def fetch_danmaku_segments(self, urls):
+        import asyncio
+        limit = asyncio.Semaphore(max(self.jobs, 1))
+
+        async def fetch(url):
+            async with limit:
+                return await self.fetch_danmaku_segment(url)
+        # Download the segments concurrently, but merge them in segment order
+        return merge_danmaku_segments(await asyncio.gather(*map(fetch, urls)), len(urls))
+
+    async def fetch_danmaku_segment(self, url, retries=DANMAKU_SEGMENT_RETRIES, backoff=DANMAKU_SEGMENT_BACKOFF):
+        import asyncio
+        for attempt in range(retries + 1):
+            try:
+                segment_raw = (await self.http_client.get(url)).decode('utf-8')
+                return json.loads(segment_raw or '{}')
+            except Exception as e:
+                if attempt == retries:
+                    logger.error('Danmaku segment download failed, skipped. {}'.format(e))
+                    return {}
+                delay = backoff * 2 ** attempt
+                logger.warning('Danmaku segment download failed, retrying in {:.1f}s. {}'.format(delay, e))
+                await asyncio.sleep(delay)
+
+    async def load_comments(self, danmaku_task, size, report=None):
+        import asyncio
+        try:
+            danmaku = await danmaku_task
         except Exception as e:
-            traceback.print_exc()
             logger.error('Download danmaku failed, {}'.format(e))
+            return None
+        if not danmaku:
+            return None
+        if self.convert_executor is None:
+            self.convert_executor = concurrent.futures.ProcessPoolExecutor()
+        loop = asyncio.get_running_loop()
+        try:
+            return await timed_stage_async('convert', loop.run_in_executor(
+                self.convert_executor, convert_comments_in_worker, get_cache_settings(), danmaku, size, None, report))
+        except Exception as e:
+            traceback.print_exc()
+            logger.error('Convert danmaku failed, {}'.format(e))
+            return None
+
+
+def play(url, args, report, use_daemon):
+    if args.fast_start:
+        if use_daemon:
+            played = play_video_early_by_daemon(url, args.extra, args.jobs, args.cache_ttl, report)
+        else:
+            played = play_video_early(url, args.extra, args.jobs, args.cache_ttl, report)
+            log_cache_stats()
+        if not played:
+            logger.error('Parse video page failed')
+        return
+
+    if use_daemon:
+        name, video_url, danmaku_file = prepare_video_by_daemon(url, args.extra, args.jobs, args.cache_ttl, report)
+    else:
+        name, video_url, danmaku_file = prepare_video(url, args.extra, args.jobs, args.cache_ttl, report)
+        log_cache_stats()
 
     if not len(video_url):
         logger.error('Parse video page failed')
-        exit(0)
+        return
 
     logger.info('Buffering video header, this may take a while')
     launch_player(name, video_url, danmaku_file)
 
 
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('url', metavar='URL', nargs='*',
+                        help='Videos to play one after another, a running daemon prefetches the next ones')
+    parser.add_argument('-i', '--info', default=False, action='store_true',
+                        help='Show the format and quality information of the video')
+    parser.add_argument('-e', '--extra', default='', type=str,
+                        help='Specify the you-get options, like --extra="--format=hd"')
+    parser.add_argument('-j', '--jobs', default=DANMAKU_SEGMENT_JOBS, type=int,
+                        help='Maximum number of danmaku segments downloaded at the same time')
+    parser.add_argument('-f', '--fast-start', default=False, action='store_true',
+                        help='Start playing before the danmaku is ready and load it into the player later')
+    parser.add_argument('--no-cache', default=False, action='store_true',
+                        help='Ignore the cached video resolutions, HTTP responses and danmaku')
+    parser.add_argument('--cache-ttl', default=RESOLUTION_CACHE_TTL, type=int,
+                        help='Seconds to reuse a video resolution for [default: %(default)s]')
+    parser.add_argument('--report', default=False, action='store_true',
+                        help='Write the stage timings and counters of the danmaku conversion as JSON next to the ASS file')
+    parser.add_argument('--profile', default=False, action='store_true',
+                        help='Same as --report, and also profile the conversion with cProfile and tracemalloc')
+    parser.add_argument('--daemon', default=False, action='store_true',
+                        help='Run as a resident service keeping the caches and connections warm for the next runs')
+    parser.add_argument('--no-daemon', default=False, action='store_true',
+                        help='Do the work in this process even if a daemon is running')
+    parser.add_argument('--stop-daemon', default=False, action='store_true',
+                        help='Stop the running daemon')
+    args = parser.parse_args()
+    logging.basicConfig(level='INFO', format='%(asctime)s - %(levelname)s - %(message)s')
+    if args.no_cache:
+        for cache in (resolution_cache, http_cache, ass_cache):
+            cache.enabled = False
+    report = 'profile' if args.profile else 'stats' if args.report else None
+
+    if args.daemon:
+        serve_daemon(args.jobs, args.cache_ttl)
+        return
+    if args.stop_daemon:
+        if is_daemon_running():
+            daemon_request('shutdown', timeout=DAEMON_PROBE_TIMEOUT)
+            logger.info('Daemon stopped')
+        else:
+            logger.error('No daemon is running')
+        return
+    if not args.url:
+        parser.error('the following arguments are required: URL')
+
+    logger.info('Parsing page...')
+    if args.info:
+        for url in args.url:
+            parse_video(url, args.info, args.extra, args.jobs)
+        return
+
+    # The caches of the daemon cannot be bypassed
+    use_daemon = not args.no_daemon and not args.no_cache and is_daemon_running()
+    if use_daemon:
+        logger.info('Using the daemon listening on {}'.format(get_daemon_socket_path()))
+        if len(args.url) > 1:
+            daemon_request('queue', urls=args.url[1:], extra=args.extra, **get_daemon_cache_options(args.cache_ttl))
+    for url in args.url:
+        play(url, args, report, use_daemon)
+
+
 if __name__ == '__main__':
     try:
         main()